@@ -5,6 +5,7 @@ import sys
 from rich import print
 
 from .__version__ import version
+from .helpers import child_processes, governor, progress
 from .subcommands import bind, cover, labels, slide, split
 
 
@@ -14,6 +15,37 @@ def _print_version():
     return 0
 
 
+def _pop_option(argv, option):
+    """Take a global option out of the arguments, wherever it is, so the subcommands never see it.
+
+    :param argv: The argument list, e.g. sys.argv. It is modified in place.
+    :param option: The option, e.g. '--progress'.
+    :return: The option's value, or None if it wasn't given.
+    """
+    value = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == option and i + 1 < len(argv):
+            value = argv[i + 1]
+            del argv[i:i + 2]
+        elif argv[i].startswith(f"{option}="):
+            value = argv[i].split("=", 1)[1]
+            del argv[i]
+        else:
+            i += 1
+    return value
+
+
+def _pop_limits(argv):
+    """Take the global options that limit ffmpeg's use of the machine out of the arguments.
+
+    :return: A governor.Limits.
+    :raises ValueError: If any of the options can't be read.
+    """
+    names = ("nice", "ionice", "cpus", "max_writers")
+    return governor.from_options(**{name: _pop_option(argv, "--" + name.replace("_", "-")) for name in names})
+
+
 # Set up the dictionary of commands. The values are tuples, first the function to run, second the description.
 allowed_commands = {
     "cover": (cover.run, "Manipulate audio file cover images."),
@@ -33,7 +65,15 @@ def main():
              )
     for name, (_, description) in allowed_commands.items():
         usage += f"{name:18}: {description}\n"
-    usage += ("\nFor more help with a command, use m4b-util <command> --help\n"
+    usage += ("\nGlobal Options:\n"
+              f"--progress {{{','.join(progress.PROGRESS_MODES)}}}: How to show progress. 'jsonl' writes JSON events to "
+              "stderr, one per line.\n"
+              "--nice N: Run every ffmpeg at this nice level, from -20 to 19.\n"
+              f"--ionice {{{','.join(governor.IO_CLASSES)}}}[:LEVEL]: Run every ffmpeg in this I/O scheduling class. "
+              "best-effort takes a level, from 0 to 7.\n"
+              "--cpus LIST: Run every ffmpeg on these CPUs, e.g. 0-3,8.\n"
+              "--max-writers N: Let no more than this many ffmpeg commands write files at once.\n"
+              "\nFor more help with a command, use m4b-util <command> --help\n"
               " \n"
               )
 
@@ -43,6 +83,22 @@ def main():
         usage=usage
     )
     parser.add_argument('command', help='Subcommand to run')
+
+    # Pick the progress mode, and the limits on ffmpeg, before anything can start drawing or running.
+    progress_mode = _pop_option(sys.argv, "--progress")
+    try:
+        if progress_mode is not None:
+            progress.set_mode(progress_mode)
+        governor.configure(_pop_limits(sys.argv))
+    except ValueError as e:
+        print(f"[bold red]Error:[/] {e}")
+        exit(-1)
+    try:
+        governor.apply()  # Before any threads start, so they, and every ffmpeg they run, inherit the limits.
+    except OSError as e:
+        print(f"[bold red]Error:[/] Couldn't apply the limits on ffmpeg: {e.strerror or e}")
+        exit(-1)
+
     # parse_args defaults to [1:] for args, but we need to exclude the rest of the args so they can be picked up by
     # the subcommands.
     args = parser.parse_args(sys.argv[1:2])
@@ -55,6 +111,9 @@ def main():
         print(parser.print_help())
         exit(-1)
 
+    # Make sure that being terminated stops every ffmpeg we started, and removes our temporary files.
+    child_processes.install()
+
     # Invoke the subcommand
     retcode = allowed_commands[args.command][0]()
 
@@ -0,0 +1,292 @@
+"""Run ffmpeg and ffprobe from asyncio.
+
+These mirror FFProgress and ParallelFFmpeg, but let a single event loop look after as many ffmpeg processes as we
+like, without tying up a thread or a worker process for each one.
+"""
+import asyncio
+from asyncio.subprocess import DEVNULL, PIPE
+import threading
+import time
+
+from . import child_processes, governor, probe_cache
+from .ffprobe import DEFAULT_PROBE_WORKERS, Probe
+from .ffprogress import decode_line, FFmpegCancelledError, FFmpegTimeoutError, FFProgress, READ_SIZE, split_lines
+from .media_backend import probe_cmd
+from .parallel_ffmpeg import available_cpus, task_costs, TaskResult
+from .progress import make_progress
+
+
+async def gather_limited(aws, limit, return_exceptions=False):
+    """Like asyncio.gather, but never running more than a set number of awaitables at once.
+
+    :param aws: Awaitables to run. Coroutines aren't started until there is room for them.
+    :param limit: The most to run at any one time.
+    :param return_exceptions: Passed on to asyncio.gather.
+    :return: A list of results, in the same order as aws.
+    """
+    semaphore = asyncio.Semaphore(max(limit, 1))
+
+    async def _limited(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(_limited(aw) for aw in aws), return_exceptions=return_exceptions)
+
+
+async def run_probe(file, profile="full"):
+    """Probe the specified file with ffprobe, without blocking the event loop.
+
+    Results are kept in the persistent probe cache, just like ffprobe.run_probe.
+
+    :param file: File to probe.
+    :param profile: Which of PROBE_PROFILES to ask for.
+    :return: A Probe, or None if the file couldn't be probed.
+    """
+    cache = probe_cache.get_cache()
+    output = cache.get(file, profile) if cache else None
+    if output is None:
+        p = await asyncio.create_subprocess_exec(*probe_cmd(file, profile), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                                                 **child_processes.popen_kwargs())
+        child = child_processes.AsyncChild(p)
+        child_processes.register(child)
+        try:
+            stdout, _ = await p.communicate()
+        except BaseException:  # Don't leave ffprobe running if we were cancelled.
+            p.kill()
+            raise
+        finally:
+            child_processes.unregister(child)
+        if p.returncode != 0:
+            return None
+        output = stdout.decode('utf-8')
+        if cache:
+            cache.put(file, output, profile)
+    return Probe(output, profile=profile)
+
+
+async def run_probe_many(files, limit=DEFAULT_PROBE_WORKERS, profile="full"):
+    """Run ffprobe on many files at once.
+
+    :param files: Files to probe.
+    :param limit: The most ffprobe processes to run at any one time.
+    :param profile: Which of PROBE_PROFILES to ask ffprobe for.
+    :return: A list of Probes (or None, for files that couldn't be probed), in the same order as files.
+    """
+    return await gather_limited((run_probe(file, profile) for file in files), limit)
+
+
+async def _pump(name, stream, lines):
+    """Split everything read from a stream into lines, and put them in the lines queue along with the stream name.
+
+    A line of None is added once the stream closes.
+    """
+    buffer = b""
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if not chunk:
+            break
+        complete, buffer = split_lines(buffer, chunk)
+        for line in complete:
+            lines.put_nowait((name, decode_line(line)))
+    lines.put_nowait((name, decode_line(buffer)))
+    lines.put_nowait((name, None))
+
+
+class AsyncFFProgress(FFProgress):
+    """Represents a single run of an ffmpeg command, supervised by the event loop."""
+
+    async def events(self):
+        """Run an ffmpeg command, reading its progress reports and log messages separately.
+
+        The log, on stderr, is kept for output and lines(). The -progress reports, on stdout, are parsed as they arrive.
+        If we stop listening before ffmpeg is done, or the watchdog decides it is stuck, it is killed. If the command
+        writes a file, it waits for a free writer slot first (see governor.writer_slot).
+
+        Yields a ProgressEvent for every progress report.
+        """
+        async with governor.async_writer_slot(self.cmd, self._check_cancelled):
+            self._start()
+            p = await asyncio.create_subprocess_exec(*self._progress_cmd(), stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                                                     **child_processes.popen_kwargs())
+            child = child_processes.AsyncChild(p)
+            child_processes.register(child)
+
+            lines = asyncio.Queue()
+            pumps = [asyncio.ensure_future(_pump("stdout", p.stdout, lines)),
+                     asyncio.ensure_future(_pump("stderr", p.stderr, lines))]
+            open_pipes = len(pumps)
+            try:
+                while open_pipes:
+                    try:
+                        stream, line = await asyncio.wait_for(lines.get(), self._poll)
+                    except asyncio.TimeoutError:
+                        stream, line = None, ""
+                    self._check_watchdog()
+                    if line is None:
+                        open_pipes -= 1
+                        continue
+                    event = self._handle_line(stream, line)
+                    if event is not None:
+                        yield event
+            except (FFmpegTimeoutError, FFmpegCancelledError):
+                p.kill()
+                self.returncode = await p.wait()
+                raise
+            finally:
+                for pump in pumps:
+                    pump.cancel()
+                if p.returncode is None and open_pipes:
+                    p.kill()
+                child_processes.unregister(child)
+
+            self.returncode = await p.wait()
+        self._finish(p.returncode)
+
+    async def retrying_events(self):
+        """Like events(), but run ffmpeg again from the start whenever the watchdog kills it, as often as it allows.
+
+        Yields a ProgressEvent for every progress report, and None whenever a retry starts.
+        """
+        while True:
+            try:
+                async for event in self.events():
+                    yield event
+                return
+            except FFmpegTimeoutError as e:
+                await asyncio.sleep(self.retry_delay(e))
+                yield None
+
+    async def run(self):
+        """Run an ffmpeg command, capturing the process output and calculating the progress.
+
+        If the watchdog kills ffmpeg, it is run again from the start, as many times as the watchdog allows.
+
+        Yields the progress in percent.
+        """
+        yield 0
+        async for event in self.retrying_events():
+            if event is None:
+                yield 0
+            elif event.percent is not None:
+                yield event.percent
+
+        # We've got nothing else to give, so mark it as 100% done
+        yield 100
+
+
+async def run(cmd, on_progress=None, keep_log=False, watchdog=None):
+    """Run an ffmpeg command.
+
+    :param cmd: Command to run
+    :param on_progress: Called with a ProgressEvent for every progress report ffmpeg sends.
+    :param keep_log: Keep every line of output, so it can be read back with AsyncFFProgress.lines().
+    :param watchdog: A Watchdog, to kill and retry ffmpeg if it takes too long or stops making progress.
+    :raises RuntimeError: If ffmpeg fails. FFmpegTimeoutError if the watchdog had to kill it too many times.
+    :return: AsyncFFProgress instance
+    """
+    ff = AsyncFFProgress(cmd, keep_log=keep_log, watchdog=watchdog)
+    try:
+        async for event in ff.retrying_events():
+            if event is not None and on_progress:
+                on_progress(event)
+    except RuntimeError:
+        ff.close()
+        raise
+    return ff
+
+
+class AsyncParallelFFmpeg:
+    """Process audio files concurrently, from a single event loop.
+
+    This behaves like ParallelFFmpeg.process(): jobs are started longest first, progress is weighted by cost, each
+    task gets a TaskResult, and with fail_fast the first failure cancels everything that hasn't finished yet.
+    """
+
+    def __init__(self, purpose, limit=None, show_progress=True, watchdog=None, fail_fast=False):
+        """Initialize everything.
+
+        :param purpose: Description of overall purpose. Printed in front of the overall progress bar.
+        :param limit: The most ffmpeg processes to run at once. Defaults to the number of CPUs we may use.
+        :param show_progress: Report progress, in the current progress mode. If False, nothing is shown.
+        :param watchdog: A Watchdog, to kill and retry jobs that take too long or stop making progress.
+        :param fail_fast: As soon as one task fails, kill the running ones and skip the rest.
+        """
+        self._purpose = purpose
+        self.limit = limit or available_cpus()
+        self.watchdog = watchdog
+        self.fail_fast = fail_fast
+        self._cancel = threading.Event()
+
+        # Progress Tracker
+        self.progress = make_progress(None if show_progress else "none")
+
+    async def _job(self, task, cost, master_task):
+        """Run a single ffmpeg command, and keep its progress bar up to date.
+
+        :return: A TaskResult.
+        """
+        name = task.get("name", "unknown")
+        if self._cancel.is_set():
+            self.progress.update(master_task, advance=cost)
+            return TaskResult(name, "cancelled")
+        task_id = self.progress.add_task(f"[dark_cyan]|- Processing '[white]{name}[/]'.", total=100)
+
+        def _on_retry(retry, error):
+            self.progress.update(task_id, completed=0,
+                                 description=f"[dark_cyan]|- Processing '[white]{name}[/]' (retry {retry}).")
+
+        ff = AsyncFFProgress(task["command"], watchdog=self.watchdog, on_retry=_on_retry, cancel=self._cancel)
+        started = time.monotonic()
+        status, error = "finished", None
+        try:
+            async for percent in ff.run():
+                self.progress.update(task_id, completed=percent, speed=ff.last_event and ff.last_event.speed)
+        except FFmpegTimeoutError as e:
+            retries = ff.attempts - 1
+            note = f" after {retries} {'retry' if retries == 1 else 'retries'}" if retries else ""
+            self.progress.console.print(f"[red]Error:[/] Timed out processing {name}{note}")
+            status, error = "timed out", e
+        except FFmpegCancelledError as e:
+            status, error = "cancelled", e
+        except (RuntimeError, OSError) as e:
+            self.progress.console.print(f"[red]Error:[/] Failed to process {name}")
+            status, error = "failed", e
+        finally:
+            self.progress.update(master_task, advance=cost)
+        if status == "finished":
+            self.progress.update(task_id, completed=100, visible=False)
+        else:
+            self.progress.update(task_id, visible=False)
+        if status in ("failed", "timed out") and self.fail_fast:
+            self._cancel.set()
+        return TaskResult(name, status, returncode=ff.returncode, log_tail=ff.output or (str(error) if error else None),
+                          elapsed=round(time.monotonic() - started, 3), retries=max(ff.attempts - 1, 0))
+
+    async def process(self, tasks):
+        """Run all ffmpeg commands, no more than limit at a time, longest first.
+
+        :param tasks: A list of dictionaries with two keys: 'name' and 'command'. Name will be printed by the progress
+                      tracker while command is being run. They may also have a 'cost'. See task_costs().
+        :return: A TaskResult for each task, in the same order as tasks. None if there were no tasks.
+        """
+        # Make sure we have tasks
+        if len(tasks) == 0:
+            return None
+
+        costs = task_costs(tasks)
+        order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+        self._cancel.clear()
+        self.progress.start()
+        try:
+            master_task = self.progress.add_task(f"[cyan]{self._purpose}", total=sum(costs))
+            started = await gather_limited((self._job(tasks[i], costs[i], master_task) for i in order), self.limit)
+            self.progress.update(master_task, completed=sum(costs))
+            cancelled = sum(1 for result in started if result.status == "cancelled")
+            if cancelled and self._cancel.is_set():
+                self.progress.console.print(f"[bold yellow]Warning:[/] Cancelled {cancelled} job(s).")
+        finally:
+            self.progress.stop()
+        results = [None] * len(tasks)
+        for i, result in zip(order, started):
+            results[i] = result
+        return results
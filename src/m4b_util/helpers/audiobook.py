@@ -5,11 +5,11 @@ from tempfile import mkdtemp
 
 from natsort import natsorted
 from rich import print
-from rich.status import Status
 
-from . import cover_utils, ffprobe, ffprogress
+from . import child_processes, cover_utils, ffprobe, ffprogress
 from .finders import find_chapters
 from .parallel_ffmpeg import ParallelFFmpeg
+from .progress import make_status
 from .segment_data import SegmentData
 
 
@@ -25,6 +25,12 @@ class Audiobook:
     output_name: str = None
     title: str = None
     keep_temp_files: bool = False
+    probe_session: ffprobe.ProbeSession = field(default_factory=ffprobe.ProbeSession, repr=False, compare=False)
+    duration_checks: list = field(default_factory=lambda: [], repr=False, compare=False)
+    watchdog: ffprogress.Watchdog = field(default=None, repr=False, compare=False)
+    jobs: int = field(default=None, repr=False, compare=False)
+    threads_per_job: int = field(default=None, repr=False, compare=False)
+    adaptive_jobs: bool = field(default=False, repr=False, compare=False)
     _tmp_dir: Path = field(init=False, repr=False, default=None)
 
     @property
@@ -32,6 +38,8 @@ class Audiobook:
         """Only create our temporary directory if we need it."""
         if not self._tmp_dir:
             self._tmp_dir = Path(mkdtemp(suffix="m4b"))
+            if not self.keep_temp_files:
+                child_processes.remove_on_exit(self._tmp_dir)  # Even if we're interrupted, or something goes wrong.
         if not self._tmp_dir.exists():
             self._tmp_dir.mkdir()
         return self._tmp_dir
@@ -88,7 +96,7 @@ class Audiobook:
         if self.chapters:
             time_shift = self.chapters[-1].end_time
             id_shift = self.chapters[-1].id + 1
-        new_chapters = find_chapters(input_path)
+        new_chapters = find_chapters(input_path, session=self.probe_session)
         for chapter in new_chapters:
             chapter.start_time = chapter.start_time + time_shift
             chapter.end_time = chapter.end_time + time_shift
@@ -96,7 +104,7 @@ class Audiobook:
 
         self.chapters.extend(new_chapters)
         # Run ffprobe and parse the output.
-        probe = ffprobe.run_probe(input_path)
+        probe = self.probe_session.run_probe(input_path, profile="tags")
         if not probe or probe.audio is None:
             print(f"[bold yellow]Warning:[/] Unable to parse '[bold white]{input_path}[/]'. Skipping.")
             return
@@ -112,39 +120,58 @@ class Audiobook:
 
         :param input_dir: Directory to scan.
         :param use_filenames: Use filenames as chapter titles, instead of embedded metadata.
-        :param decode_durations: Find duration by fully decoding file, instead of relying on metadata.
+        :param decode_durations: How to find each file's duration: 'metadata', 'decode', or 'demux'. True and False
+                                 are shorthand for 'decode' and 'metadata'.
         """
         return self.add_chapters_from_filelist(self.scan_dir(input_dir), use_filenames, decode_durations)
 
+    def _take_cover(self, input_files):
+        """Use any cover image in the list as our cover, and return the rest of the files."""
+        audio_files = list()
+        for file in input_files:
+            if file.stem == "cover" and file.suffix.lower() in [".png", ".jpg", ".jpeg"]:
+                self.cover = file
+            else:
+                audio_files.append(file)
+        return audio_files
+
     def add_chapters_from_filelist(self, input_files, use_filenames=False, decode_durations=False):
         """Read files from a list of files that represent an audiobook.
 
         :param input_files: Directory to scan.
         :param use_filenames: Use filenames as chapter titles, instead of embedded metadata.
-        :param decode_durations: Find duration by fully decoding file, instead of relying on metadata.
+        :param decode_durations: How to find each file's duration: 'metadata', 'decode', or 'demux'. True and False
+                                 are shorthand for 'decode' and 'metadata'.
         """
         # Set up variables
         time_counter = 0.0
         if self.chapters:  # If we already have chapters, add these on to the end.
             time_counter = self.chapters[-1].end_time
         segment_counter = len(self.chapters)
+        checks_start = len(self.duration_checks)
 
         # Start our status tracker
         print("[cyan]Collecting file data...[/]")
-        file_scan_status = Status("Starting")
+        file_scan_status = make_status("Starting")
+        file_scan_status.start()
+
+        # Pick out the cover file, if any, so we don't waste time probing it.
+        audio_files = self._take_cover(input_files)
+
+        # Run ffprobe on everything up front, since that's where most of the time goes.
+        file_scan_status.update(f"Probing {len(audio_files)} files")
+        probes = self.probe_session.run_probe_many(audio_files, profile="tags")
+
+        # Any decoding happens in parallel, with its own progress display.
+        file_scan_status.stop()
+        ffprobe.prefetch_durations(audio_files, decode_durations, self.probe_session)
         file_scan_status.start()
 
         # Scan all the files
-        for file in input_files:
+        for file, probe in zip(audio_files, probes):
             file_scan_status.update(f"Scanning {file.name}")
 
-            # Check for cover file
-            if file.stem == "cover" and file.suffix.lower() in [".png", ".jpg", ".jpeg"]:
-                self.cover = file
-                continue
-
-            # Run ffprobe and parse the output.
-            probe = ffprobe.run_probe(file)
+            # Parse the ffprobe output.
             if not probe or probe.audio is None:
                 print(f"[bold yellow]Warning:[/] Unable to parse '[bold white]{file}[/]'. Skipping.")
                 continue
@@ -168,7 +195,8 @@ class Audiobook:
             # Get the duration, and calculate start/end times.
             start_time = time_counter
             try:
-                duration = ffprobe.get_file_duration(file, decode_durations)
+                duration = ffprobe.get_file_duration(file, decode_durations, session=self.probe_session,
+                                                     checks=self.duration_checks)
             except RuntimeError:
                 print(f"[yellow]Warning:[/] Failed to determine duration of '[bold white]{file}[/]'. Ignoring.")
                 continue
@@ -186,8 +214,22 @@ class Audiobook:
 
         # Shut off the status tracker and alert the user
         file_scan_status.stop()
+        self._print_duration_checks(self.duration_checks[checks_start:])
         print("[green]File scan complete.")
 
+    @staticmethod
+    def _print_duration_checks(checks):
+        """Report which files had to be decoded in adaptive mode, and how far off their metadata was."""
+        if not checks:
+            return
+        print(f"[cyan]Decoded {len(checks)} file(s) with unreliable durations:[/]")
+        for check in checks:
+            if check.drift is None:
+                result = "duration could not be compared"
+            else:
+                result = f"metadata was off by {check.drift:+.3f}s"
+            print(f"  '[bold white]{check.file.name}[/]': {check.reason}; {result}.")
+
     def bind(self, output_path):
         """Bind together an audiobook, based on what we know."""
         if self.keep_temp_files:
@@ -211,7 +253,7 @@ class Audiobook:
             # Keep info on the first file we see
             if not first_file:
                 first_file = segment.backing_file
-                unaccounted_duration = ffprobe.get_file_duration(first_file)
+                unaccounted_duration = ffprobe.get_file_duration(first_file, session=self.probe_session)
 
             # If we see a file different from the first one, switch to multi-segment bind mode
             if segment.backing_file != first_file:
@@ -230,8 +272,10 @@ class Audiobook:
         return self._finish_bind(out_file, output_path)
 
     def _bind_multiple_segments(self, output_path):
-        # First, convert all audios to m4a, in parallel.
-        p = ParallelFFmpeg("Converting files to m4a")
+        # First, convert all audios to m4a, in parallel. If any of them fail, the book is broken anyway, so don't spend
+        # any more time on the rest.
+        p = ParallelFFmpeg("Converting files to m4a", watchdog=self.watchdog, jobs=self.jobs,
+                           threads_per_job=self.threads_per_job, fail_fast=True, adaptive=self.adaptive_jobs)
         tasks = list()
         temp_files = list()
         finished_file = self._tmp_path / "finished.m4b"
@@ -255,12 +299,15 @@ class Audiobook:
             if segment.title:
                 cmd.extend(["-metadata", f"title={segment.title}"])
             cmd.extend(["-filter_complex", "[0:a]asetpts=N/SR/TB[s0]", "-map", "[s0]",
-                        "-c:a", "aac", out_m4a, "-y"])
+                        "-c:a", "aac", *p.threads_args, out_m4a, "-y"])
             tasks.append({
                 "name": file.stem,
-                "command": cmd
+                "command": cmd,
+                "cost": segment.end_time - segment.start_time
             })
-        p.process(tasks)
+        if not self._convert_segments(p, tasks, temp_files):
+            print("[bold red]Error:[/] Could not convert every file, so the book can't be bound.")
+            return False
 
         # Save our original chapter info, so we can restore it later.
         old_chapters = self.chapters
@@ -291,15 +338,36 @@ class Audiobook:
 
         return self._finish_bind(finished_file, output_path)
 
+    def _convert_segments(self, p, tasks, temp_files):
+        """Run the conversions, probing each converted file as soon as it is ready, while the rest are still running.
+
+        :param p: The ParallelFFmpeg to run them with.
+        :param tasks: The conversion tasks.
+        :param temp_files: The file each task writes, in the same order as tasks.
+        :return: True if every file was converted.
+        """
+        with p:
+            futures = p.submit_many(tasks)
+            files = dict(zip(futures, temp_files))
+            for future in p.as_completed(futures):
+                if not future.result().ok:
+                    break  # The rest have been cancelled.
+                file = files[future]
+                self.probe_session.forget(file)  # A previous bind may have left a different file at the same path.
+                self.probe_session.run_probe(file, profile="tags")
+        return all(future.result().ok for future in futures)
+
     def _finish_bind(self, input_path, output_path):
         """Copy the output and cleanup."""
         # Copy the output into place
         print("[cyan]Copying output.")
         shutil.copy(input_path, output_path)
+        self.probe_session.forget(output_path)
 
         # Clean up
         if not self.keep_temp_files:
             shutil.rmtree(self._tmp_path)
+            child_processes.unregister_temp(self._tmp_dir)
 
         return True
 
@@ -336,8 +404,9 @@ class Audiobook:
         return output_file
 
     def _run_ffmpeg(self, cmd, message):
-        if not ffprogress.run(cmd, message):
+        if not ffprogress.run(cmd, message, watchdog=self.watchdog):
             print("[bold red]Error:[/] ffmpeg failed.")
             if not self.keep_temp_files:
                 shutil.rmtree(self._tmp_path)
+                child_processes.unregister_temp(self._tmp_dir)
             exit(1)
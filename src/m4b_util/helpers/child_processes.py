@@ -0,0 +1,203 @@
+"""Keep track of the ffmpeg and ffprobe processes we start, so none are left running if we are interrupted.
+
+Every child is started in a process group of its own. That way it can be stopped along with anything it starts, and
+a Ctrl-C at the terminal comes to us, rather than going straight to every encoder. However we stop, whether from
+SIGINT, SIGTERM (once install() has been called), an error, or exit(), every child still running is asked to stop with
+SIGTERM, and killed with SIGKILL if it hasn't after TERM_GRACE seconds. Temporary directories registered with
+remove_on_exit() are removed after that.
+"""
+import atexit
+import os
+from pathlib import Path
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# How long, in seconds, to give children to stop after SIGTERM, before sending SIGKILL.
+TERM_GRACE = 3.0
+
+# How often, in seconds, to check whether children have stopped.
+_STOP_POLL = 0.05
+
+_children = set()
+_temp_dirs = set()
+_lock = threading.Lock()
+_stopping = False
+
+
+def popen_kwargs():
+    """Extra arguments for Popen, or asyncio.create_subprocess_exec, that start a child in its own process group."""
+    if sys.platform == "win32":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def _signal(child, force=False):
+    """Ask a child's whole process group to stop, with SIGTERM, or make it stop, with SIGKILL."""
+    try:
+        if sys.platform != "win32":
+            os.killpg(child.pid, signal.SIGKILL if force else signal.SIGTERM)
+        elif force:
+            child.kill()
+        else:
+            child.terminate()
+    except (ProcessLookupError, PermissionError):
+        pass  # It already stopped.
+
+
+def register(child):
+    """Keep track of a child until it is unregistered.
+
+    :param child: Anything with pid, poll(), terminate() and kill(), like a Popen.
+    """
+    with _lock:
+        _children.add(child)
+        stopping = _stopping
+    if stopping:  # Something started a child while we were on our way out.
+        _signal(child)
+
+
+def unregister(child):
+    """Stop keeping track of a child, once it has been waited for."""
+    with _lock:
+        _children.discard(child)
+
+
+class Popen(subprocess.Popen):
+    """A Popen that starts its child in its own process group, and keeps track of it until it has been waited for."""
+
+    def __init__(self, args, **kwargs):
+        """Start the child. Takes the same arguments as subprocess.Popen."""
+        super().__init__(args, **popen_kwargs(), **kwargs)
+        register(self)
+
+    def wait(self, timeout=None):
+        """Wait for the child to stop, then stop keeping track of it."""
+        returncode = super().wait(timeout)
+        unregister(self)
+        return returncode
+
+
+def run(cmd, capture_output=False, **kwargs):
+    """Like subprocess.run, but the child is tracked, and stopped if we are interrupted while waiting for it.
+
+    :return: A subprocess.CompletedProcess.
+    """
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    with Popen(cmd, **kwargs) as p:
+        try:
+            stdout, stderr = p.communicate()
+        except BaseException:
+            stop([p])
+            raise
+    return subprocess.CompletedProcess(p.args, p.returncode, stdout, stderr)
+
+
+class AsyncChild:
+    """Lets an asyncio Process be tracked like a Popen."""
+
+    def __init__(self, process):
+        """Wrap an asyncio Process."""
+        self._process = process
+        self.pid = process.pid
+
+    def poll(self):
+        """The return code, or None if the child is still running.
+
+        The event loop only hears that the child stopped while it is running, which it usually isn't on the way out, so
+        ask the OS directly. WNOWAIT leaves the child for the event loop to reap as usual.
+        """
+        if self._process.returncode is not None or not hasattr(os, "waitid"):
+            return self._process.returncode
+        try:
+            status = os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return 255  # Already reaped by the event loop's child watcher, which keeps the return code until it runs.
+        if status is None:
+            return None
+        return status.si_status if status.si_code == os.CLD_EXITED else -status.si_status
+
+    def terminate(self):
+        """Ask the child to stop."""
+        self._process.terminate()
+
+    def kill(self):
+        """Make the child stop."""
+        self._process.kill()
+
+
+def stop(children, grace=TERM_GRACE):
+    """Stop some children: SIGTERM first, then SIGKILL for any still going after grace seconds.
+
+    :param children: The children to stop.
+    :param grace: How long to give them to stop on their own.
+    """
+    children = [child for child in children if child.poll() is None]
+    for child in children:
+        _signal(child)
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline and any(child.poll() is None for child in children):
+        time.sleep(_STOP_POLL)
+    for child in children:
+        if child.poll() is None:
+            _signal(child, force=True)
+        if isinstance(child, subprocess.Popen):
+            child.wait()
+        unregister(child)
+
+
+def stop_all(grace=TERM_GRACE):
+    """Stop every child that is still running.
+
+    :param grace: How long to give them to stop on their own, before they are killed.
+    :return: How many were still running.
+    """
+    with _lock:
+        children = [child for child in _children if child.poll() is None]
+    stop(children, grace)
+    return len(children)
+
+
+def remove_on_exit(path):
+    """Remove a temporary directory on the way out, if nothing else has by then."""
+    with _lock:
+        _temp_dirs.add(Path(path))
+
+
+def unregister_temp(path):
+    """Forget a temporary directory given to remove_on_exit(), once it has been cleaned up some other way."""
+    with _lock:
+        _temp_dirs.discard(Path(path))
+
+
+def shutdown():
+    """Stop every child, and remove every registered temporary directory. Runs at exit."""
+    global _stopping
+    with _lock:
+        _stopping = True
+    stop_all()
+    with _lock:
+        temp_dirs = list(_temp_dirs)
+        _temp_dirs.clear()
+    for path in temp_dirs:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _on_sigterm(signum, frame):
+    """Turn SIGTERM into an ordinary exit, so that everything gets cleaned up on the way out."""
+    raise SystemExit(128 + signum)
+
+
+def install():
+    """Clean up after SIGTERM, too, rather than dying on the spot. Only call this from the main thread.
+
+    SIGINT already becomes a KeyboardInterrupt, which ends in an ordinary exit.
+    """
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
+
+atexit.register(shutdown)
@@ -1,19 +1,81 @@
 """Helper functions for running ffprobe."""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
 import json
-import re
-from subprocess import run
+import os
+from pathlib import Path
+import threading
+
+from . import media_backend, mp3_reader, mp4_reader
+from .media_backend import PROBE_PROFILES
+from .parallel_ffmpeg import available_cpus
+from .progress import make_progress
+
+# ffprobe spends most of its time waiting on disk (or network) reads, so we can run more of them than we have cores.
+DEFAULT_PROBE_WORKERS = 8
+
+# Ways get_file_duration can find a file's duration.
+DURATION_MODES = ("metadata", "decode", "demux", "adaptive")
+
+# How far a constant-bitrate file's listed duration can stray from what its size implies before we stop trusting it.
+SIZE_MISMATCH_TOLERANCE = 0.05
+
+
+def _covers(profile, requested):
+    """Check whether the results of one probe profile include everything in another."""
+    profiles = list(PROBE_PROFILES)
+    return profiles.index(profile) >= profiles.index(requested)
 
 
 class Probe:
-    """Holds the results from an ffprobe run."""
-    def __init__(self, ffprobe_output):
-        """Set up attributes."""
-        self.data = json.loads(ffprobe_output)
-        self.streams = self.data.get('streams', None)
-        self.audio = self.first_stream_of(codec_type="audio")
-        self.format = self.data.get('format')
-        self.tags = self.data.get('format', dict()).get('tags', None)
-        self.chapters = self.data.get('chapters')
+    """Holds the results from an ffprobe run.
+
+    Nothing is parsed until it is first used, so probes that are only checked for a duration stay cheap.
+    """
+    def __init__(self, ffprobe_output=None, data=None, profile="full", native=False):
+        """Set up attributes.
+
+        :param ffprobe_output: JSON text, as written by ffprobe.
+        :param data: Already-parsed results laid out like ffprobe's JSON, such as those from the native readers.
+        :param profile: The probe profile the results were gathered with.
+        :param native: Whether the results came from one of the native readers instead of ffprobe.
+        """
+        self._output = ffprobe_output
+        if data is not None:
+            self.data = data
+        self.profile = profile
+        self.native = native
+
+    @cached_property
+    def data(self):
+        """The full results, as parsed from ffprobe's JSON."""
+        return json.loads(self._output)
+
+    @cached_property
+    def streams(self):
+        """All streams in the file."""
+        return self.data.get('streams', None)
+
+    @cached_property
+    def audio(self):
+        """The first audio stream."""
+        return self.first_stream_of(codec_type="audio")
+
+    @cached_property
+    def format(self):
+        """Container-level info."""
+        return self.data.get('format')
+
+    @cached_property
+    def tags(self):
+        """Container-level tags."""
+        return self.data.get('format', dict()).get('tags', None)
+
+    @cached_property
+    def chapters(self):
+        """Chapter list."""
+        return self.data.get('chapters')
 
     def first_stream_of(self, codec_type):
         """Get the first stream matching the requested arguments.
@@ -23,7 +85,7 @@ class Probe:
         :param codec_type: Stream type. Usually "audio" or "video".
         :return: List representing the first matching stream
         """
-        for stream in self.data.get('streams'):
+        for stream in self.streams or list():
             if stream.get("codec_type") == codec_type:
                 return stream
 
@@ -31,62 +93,338 @@ class Probe:
         return None
 
 
-def run_probe(file):
-    """Run ffprobe on the specified file and return a JSON representation of the output."""
-    cmd = ["ffprobe", "-show_format", "-show_streams", "-show_chapters", "-of", "json", "-i", file]
+def run_probe(file, profile="full"):
+    """Probe the specified file with the current media backend.
+
+    With the default backend, this runs ffprobe and keeps the results in the persistent probe cache, so unchanged
+    files are only ever probed once.
 
-    p = run(cmd, capture_output=True)
-    if p.returncode != 0:
+    :param file: File to probe.
+    :param profile: Which of PROBE_PROFILES to ask for. Narrower profiles are faster to run and parse.
+    :return: A Probe, or None if the file couldn't be probed.
+    """
+    output = media_backend.get_backend().probe(file, profile)
+    if output is None:
         return None
-    return Probe(p.stdout.decode('utf-8'))
+    if isinstance(output, str):
+        return Probe(output, profile=profile)
+    return Probe(data=output, profile=profile)
+
+
+def run_probe_many(files, max_workers=DEFAULT_PROBE_WORKERS, profile="full"):
+    """Run ffprobe on many files at once.
 
+    :param files: Files to probe.
+    :param max_workers: The most ffprobe processes to run at any one time.
+    :param profile: Which of PROBE_PROFILES to ask ffprobe for.
+    :return: A list of Probes (or None, for files that couldn't be probed), in the same order as files.
+    """
+    files = list(files)
+    if len(files) <= 1 or max_workers <= 1:
+        return [run_probe(file, profile) for file in files]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        return list(executor.map(lambda file: run_probe(file, profile), files))
+
+
+def read_native(file):
+    """Read a file's info without running ffprobe, if it is a format we know how to parse ourselves.
+
+    :return: A Probe, or None if the file needs to go through ffprobe.
+    """
+    extension = os.path.splitext(os.fspath(file))[1].lower()
+    data = None
+    if extension in mp4_reader.EXTENSIONS:
+        data = mp4_reader.read_mp4(file)
+    elif extension in mp3_reader.EXTENSIONS:
+        data = mp3_reader.read_mp3(file)
+    if data is not None:
+        return Probe(data=data, native=True)
+    return None
+
+
+class ProbeSession:
+    """Remember probe results for the life of a single operation, so that each file is only probed once.
+
+    Files we can parse natively are read directly, and everything else goes through ffprobe. Anything that writes to
+    a file which may have already been probed should call forget() on it afterwards.
+    """
+
+    def __init__(self):
+        """Set up attributes."""
+        self._probes = dict()
+        self._measured = dict()
+        self._lock = threading.Lock()
 
-def get_file_duration(file, decode_duration=False):
+    @staticmethod
+    def _key(file):
+        return os.path.abspath(os.fspath(file))
+
+    def _lookup(self, key, profile):
+        """Find a remembered result that covers the requested profile. Caller must hold the lock.
+
+        :return: (True, result) if there is one, otherwise (False, None).
+        """
+        if key in self._probes:
+            probe = self._probes[key]
+            if probe is None or _covers(probe.profile, profile):
+                return True, probe
+        return False, None
+
+    def _remember(self, key, probe):
+        """Store a result, unless we already have a broader one. Caller must hold the lock."""
+        current = self._probes.get(key)
+        if current is None or (probe is not None and not _covers(current.profile, probe.profile)):
+            self._probes[key] = probe
+        return self._probes[key]
+
+    def run_probe(self, file, profile="full"):
+        """Probe a file, unless we have already done so during this session.
+
+        :param file: File to probe.
+        :param profile: Which of PROBE_PROFILES is needed. Any earlier probe with a broader profile is reused.
+        :return: A Probe, or None if the file couldn't be probed.
+        """
+        key = self._key(file)
+        with self._lock:
+            found, probe = self._lookup(key, profile)
+        if found:
+            return probe
+        probe = read_native(file) or run_probe(file, profile)
+        with self._lock:
+            return self._remember(key, probe)
+
+    def run_probe_many(self, files, max_workers=DEFAULT_PROBE_WORKERS, profile="full"):
+        """Probe many files at once, skipping any we have already probed during this session.
+
+        :param files: Files to probe.
+        :param max_workers: The most ffprobe processes to run at any one time.
+        :param profile: Which of PROBE_PROFILES is needed.
+        :return: A list of Probes (or None, for files that couldn't be probed), in the same order as files.
+        """
+        files = list(files)
+        with self._lock:
+            missing = dict()
+            for file in files:
+                key = self._key(file)
+                if not self._lookup(key, profile)[0]:
+                    missing.setdefault(key, file)
+
+        # Read what we can natively, then hand the rest to ffprobe.
+        new_probes = {key: read_native(file) for key, file in missing.items()}
+        needs_ffprobe = {key: file for key, file in missing.items() if new_probes[key] is None}
+        new_probes.update(zip(needs_ffprobe.keys(), run_probe_many(needs_ffprobe.values(), max_workers, profile)))
+        with self._lock:
+            for key, probe in new_probes.items():
+                self._remember(key, probe)
+            return [self._probes[self._key(file)] for file in files]
+
+    def measure(self, file, mode, on_progress=None):
+        """Find a file's duration by running it through ffmpeg, unless we have already done so during this session.
+
+        :param file: File to measure.
+        :param mode: 'decode' or 'demux'. See get_file_duration().
+        :param on_progress: Called with the number of seconds processed so far, as ffmpeg works through the file.
+        :return: The duration in seconds, or None if ffmpeg didn't report one.
+        """
+        key = (self._key(file), mode)
+        with self._lock:
+            if key in self._measured:
+                return self._measured[key]
+        duration = _run_for_duration(file, mode, on_progress)
+        with self._lock:
+            return self._measured.setdefault(key, duration)
+
+    def measure_many(self, files, mode, max_workers=None, purpose="Measuring durations"):
+        """Measure many files at once, showing overall progress.
+
+        :param files: Files to measure.
+        :param mode: 'decode' or 'demux'. See get_file_duration().
+        :param max_workers: The most ffmpeg processes to run at any one time. Decoding is CPU-bound, so by default
+                            it is as many as we have CPUs to use.
+        :param purpose: Description printed in front of the overall progress bar.
+        """
+        with self._lock:
+            files = [file for file in files if (self._key(file), mode) not in self._measured]
+        if not files:
+            return
+
+        progress = make_progress()
+        progress.start()
+        master_task = progress.add_task(f"[cyan]{purpose}", total=len(files))
+
+        def _measure(file):
+            # Without a listed duration we can't show a percentage, so the bar just spins until we are done.
+            probe = self._probes.get(self._key(file))
+            expected = (probe and probe.audio or dict()).get('duration')
+            task = progress.add_task(f"[dark_cyan]|- Processing '[white]{file.name}[/]'.",
+                                     total=float(expected) if expected else None)
+            self.measure(file, mode, on_progress=lambda seconds: progress.update(task, completed=seconds))
+            progress.update(task, visible=False)
+            progress.update(master_task, advance=1)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers or available_cpus(), len(files)))) as executor:
+                list(executor.map(_measure, files))
+        finally:
+            progress.stop()
+
+    def forget(self, file):
+        """Drop any remembered result for a file, e.g. because it has been rewritten."""
+        key = self._key(file)
+        with self._lock:
+            self._probes.pop(key, None)
+            for mode in DURATION_MODES:
+                self._measured.pop((key, mode), None)
+
+
+def _duration_mode(decode_duration):
+    """Turn the decode_duration argument into one of DURATION_MODES, accepting True/False for 'decode'/'metadata'."""
+    if decode_duration is True:
+        return "decode"
+    if not decode_duration:
+        return "metadata"
+    if decode_duration not in DURATION_MODES:
+        raise ValueError(f"Unknown duration mode '{decode_duration}'. Expected one of {', '.join(DURATION_MODES)}.")
+    return decode_duration
+
+
+def _run_for_duration(file, mode, on_progress=None):
+    """Read through a whole file with the current media backend to find its duration.
+
+    :param file: The file to read.
+    :param mode: 'decode' to decode every frame, or 'demux' to only read packets.
+    :param on_progress: Called with the number of seconds processed so far, as the backend works through the file.
+    :return: The duration in seconds, or None if it couldn't be found.
+    """
+    return media_backend.get_backend().measure_duration(file, mode, on_progress)
+
+
+def prefetch_durations(files, decode_duration, session, max_workers=None):
+    """Measure all the durations get_file_duration() will need to run ffmpeg for, in parallel.
+
+    The results are kept in the session, so later calls to get_file_duration() with the same session return
+    immediately.
+
+    :param files: Files that are about to have their durations checked.
+    :param decode_duration: The duration mode that will be used. See get_file_duration().
+    :param session: ProbeSession to keep the results in.
+    :param max_workers: The most ffmpeg processes to run at any one time. By default, as many as we have CPUs to use.
+    """
+    mode = _duration_mode(decode_duration)
+    files = list(files)
+    if mode == "metadata":
+        return
+    if mode == "adaptive":
+        probes = session.run_probe_many(files, profile="duration")
+        files = [file for file, probe in zip(files, probes)
+                 if probe and probe.audio is not None and duration_suspect_reason(probe)]
+        mode = "decode"
+    session.measure_many(files, mode, max_workers,
+                         purpose="Decoding durations" if mode == "decode" else "Demuxing durations")
+
+
+def duration_suspect_reason(probe):
+    """Decide whether the duration listed in a file's headers can be trusted.
+
+    Results from the native readers are exact, since they come from frame counts or sample tables. For anything
+    ffprobe had to look at, we watch for the usual signs of a guessed duration.
+
+    :param probe: Probe of the file, with at least the 'duration' profile.
+    :return: A short description of why the duration is suspect, or None if it looks reliable.
+    """
+    audio = probe.audio
+    if audio is None or audio.get('duration') is None:
+        return "no duration in metadata"
+    if probe.native:
+        return None
+    if "mp3" in probe.format.get('format_name', ""):
+        # The native reader handles every mp3 with a usable header, so this one was estimated from its bitrate.
+        return "mp3 without a usable VBR header"
+    bit_rate, size = audio.get('bit_rate'), probe.format.get('size')
+    if bit_rate and size and probe.format.get('nb_streams') == 1:
+        duration = float(audio['duration'])
+        expected = int(size) * 8 / int(bit_rate)
+        if abs(expected - duration) > max(1.0, duration * SIZE_MISMATCH_TOLERANCE):
+            return f"duration doesn't match file size at {int(bit_rate) // 1000}kbps"
+    return None
+
+
+@dataclass
+class DurationCheck:
+    """Record of a file whose duration was verified by decoding it."""
+    file: Path
+    reason: str
+    metadata_duration: float = None
+    measured_duration: float = None
+
+    @property
+    def drift(self):
+        """How far the metadata was off, in seconds, or None if one of the durations is unknown."""
+        if self.metadata_duration is None or self.measured_duration is None:
+            return None
+        return self.metadata_duration - self.measured_duration
+
+
+def _metadata_duration(probe):
+    """Read the audio duration from a probe's metadata."""
+    if not probe or probe.audio is None:
+        raise RuntimeError("Could not get audio stream.")
+    try:
+        return float(probe.audio.get('duration'))
+    except TypeError:
+        raise RuntimeError("Cannot parse duration listed in file.")
+
+
+def _adaptive_duration(file, session, checks):
+    """Use the metadata duration, unless it looks unreliable. Then, decode the file to find out for sure."""
+    probe = session.run_probe(file, profile="duration")
+    if not probe or probe.audio is None:
+        raise RuntimeError("Could not get audio stream.")
+    reason = duration_suspect_reason(probe)
+    if reason is None:
+        return _metadata_duration(probe)
+
+    check = DurationCheck(file=file, reason=reason, measured_duration=session.measure(file, "decode"))
+    try:
+        check.metadata_duration = _metadata_duration(probe)
+    except RuntimeError:
+        pass
+    if checks is not None:
+        checks.append(check)
+    if check.measured_duration:
+        return check.measured_duration
+    return _metadata_duration(probe)
+
+
+def get_file_duration(file, decode_duration=False, session=None, checks=None):
     """Determine the duration of a file.
 
-    If self.decode_durations is set, run the file through ffmpeg to get the time.
-    Otherwise, get it from the metadata.
+    There are four ways to find it:
+      - metadata: Trust the duration listed in the file. Fast, but can be wrong (e.g. VBR mp3s without a header).
+      - decode: Run the file through ffmpeg, decoding every frame. Accurate, but slow.
+      - demux: Run the file through ffmpeg, copying packets without decoding them. As accurate as decoding, at
+        roughly the speed the file can be read from disk.
+      - adaptive: Use the metadata, but decode any file where it looks unreliable. See duration_suspect_reason().
 
     :param file: The audio file to run through ffmpeg
-    :param decode_duration: Actually decode the file to find duration, instead of relying on metadata.
+    :param decode_duration: How to find the duration: one of DURATION_MODES. True and False are accepted as shorthand
+                            for 'decode' and 'metadata'.
+    :param session: ProbeSession to reuse probe results from. If unset, a new one is used.
+    :param checks: If set, a list to append a DurationCheck to whenever adaptive mode decodes the file.
 
     :return The duration of the file, in seconds
     """
-    duration = None
-    if decode_duration:
-        # Setup variables
-        time_regex = re.compile(r"time=(?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})\.(?P<ms>\d{2})")
-        time_match = None
-
-        # Run the decoder
-        cmd = ["ffmpeg", "-i", file, "-loglevel", "info", "-nostats", "-f", "null", "-"]
-        p = run(cmd, capture_output=True)
-
-        # Search for time messages
-        for line in p.stderr.decode('utf-8', errors="replace").splitlines():
-            match = time_regex.search(line)
-            if match:
-                time_match = match  # Only keep the most recent
-
-        # Set the duration if we found any
-        if time_match:
-            match = time_match.groupdict()
-            duration = ((int(match["hour"]) * 60 * 60)
-                        + (int(match["min"]) * 60)
-                        + int(match["sec"])
-                        + (int(match["ms"]) / 100))
-        else:
-            print(f"[bold yellow]Warning:[/] Unable to find duration of '[bold white]{file.name}[/]' "
-                  "during decoding. Falling back to metadata.")
-
-    if not duration:  # Use the metadata as given
-        probe = run_probe(file)
-        if not probe or probe.audio is None:
-            raise RuntimeError("Could not get audio stream.")
-        try:
-            seconds = float(probe.audio.get('duration'))
-        except TypeError:
-            raise RuntimeError("Cannot parse duration listed in file.")
-        duration = seconds
+    mode = _duration_mode(decode_duration)
+    session = session or ProbeSession()
+    if mode == "adaptive":
+        return _adaptive_duration(file, session, checks)
+
+    if mode != "metadata":
+        duration = session.measure(file, mode)
+        if duration:
+            return duration
+        print(f"[bold yellow]Warning:[/] Unable to find duration of '[bold white]{file.name}[/]' "
+              f"during {'decoding' if mode == 'decode' else 'demuxing'}. Falling back to metadata.")
 
-    return duration
+    # Use the metadata as given
+    return _metadata_duration(session.run_probe(file, profile="duration"))
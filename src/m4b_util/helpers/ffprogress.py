@@ -1,8 +1,34 @@
 """Helper functions for running FFMPEG."""
+from collections import deque
+from dataclasses import dataclass
+import io
+import os
+import queue
 import re
+import selectors
 import subprocess
+from tempfile import SpooledTemporaryFile
+import threading
+import time
 
-from rich.progress import Progress, SpinnerColumn
+from . import child_processes, governor
+from .progress import make_progress
+
+
+# How many of the most recent lines of output to keep for error messages.
+TAIL_LINES = 200
+
+# How much of a full log to hold in memory before moving it to a temporary file.
+LOG_SPOOL_BYTES = 1024 * 1024
+
+# How much to read from a pipe at a time.
+READ_SIZE = 64 * 1024
+
+# How often, in seconds, to check on a job that has a watchdog, or can be cancelled, when it isn't saying anything.
+WATCHDOG_POLL = 1.0
+
+_LINE_BREAK_REGEX = re.compile(rb"[\r\n]")
+_NUMBER_REGEX = re.compile(r"(?P<num>[\d.]+)")
 
 
 def to_ms(hour=0, min=0, sec=0, ms=0):
@@ -11,97 +37,464 @@ def to_ms(hour=0, min=0, sec=0, ms=0):
     return result
 
 
+def parse_time(spec):
+    """Convert an ffmpeg time duration, like "90", "1:30.5", "01:01:30" or "1500ms", to seconds.
+
+    :param spec: The time, as it would be given to ffmpeg on the command line.
+    :return: The time in seconds, or None if it couldn't be understood.
+    """
+    spec = str(spec).strip()
+    sign = -1 if spec.startswith("-") else 1
+    spec = spec.lstrip("+-")
+    try:
+        if ":" in spec:
+            seconds = 0.0
+            for part in spec.split(":"):
+                seconds = seconds * 60 + float(part)
+        elif spec.endswith("ms"):
+            seconds = float(spec[:-2]) / 1000
+        elif spec.endswith("us"):
+            seconds = float(spec[:-2]) / 1000000
+        else:
+            seconds = float(spec.rstrip("s"))
+    except ValueError:
+        return None
+    return sign * seconds
+
+
+def requested_duration(cmd):
+    """Find how much of the input an ffmpeg command asks for with -t, -to and -ss.
+
+    :param cmd: A list of command line elements, e.g. ["ffmpeg", "-ss", "10", "-t", "30", "-i", ...]
+    :return: A tuple of (duration, seek), in seconds. Either is None if the command doesn't set it.
+    """
+    options = dict()
+    for option, value in zip(cmd, cmd[1:]):
+        if option in ("-ss", "-t", "-to"):
+            options[option] = parse_time(value)
+    seek = options.get("-ss")
+    if options.get("-t") is not None:
+        return options["-t"], seek
+    if options.get("-to") is not None:
+        return options["-to"] - (seek or 0), seek
+    return None, seek
+
+
+@dataclass
+class ProgressEvent:
+    """A single block of ffmpeg's -progress output."""
+
+    out_time: float = 0.0  # Seconds of output written so far.
+    speed: float = None  # How many times faster than realtime ffmpeg is going.
+    bitrate: float = None  # Output bitrate, in kbits/s.
+    total_size: int = None  # Bytes of output written so far.
+    finished: bool = False  # True for the final block, sent as ffmpeg exits.
+    percent: float = None  # How far along we are, if we know how long the output will be.
+
+    @classmethod
+    def from_block(cls, block, total_dur=None):
+        """Build an event from the key=value pairs of one -progress block.
+
+        :param block: Dictionary of the keys and values ffmpeg sent.
+        :param total_dur: How long the output will be, in seconds. Used to calculate percent.
+        :return: ProgressEvent
+        """
+        event = cls(finished=block.get("progress") == "end")
+        # out_time_ms is actually in microseconds too, but older versions of ffmpeg only send that one.
+        out_time_us = _to_number(block.get("out_time_us", block.get("out_time_ms")), int)
+        if out_time_us is not None:
+            event.out_time = out_time_us / 1000000
+        event.speed = _to_number(block.get("speed"))
+        event.bitrate = _to_number(block.get("bitrate"))
+        event.total_size = _to_number(block.get("total_size"), int)
+        if total_dur:
+            event.percent = min(event.out_time / total_dur * 100, 100)
+        return event
+
+
+def _to_number(value, kind=float):
+    """Pull the number out of a -progress value like "1.5x" or "128.0kbits/s". N/A, or nothing, gives None."""
+    match = _NUMBER_REGEX.match(value or "")
+    if match is None:
+        return None
+    try:
+        return kind(match.group("num"))
+    except ValueError:
+        return None
+
+
+class FFmpegTimeoutError(RuntimeError):
+    """ffmpeg ran for too long, or stopped making progress, and was killed."""
+
+
+class FFmpegCancelledError(RuntimeError):
+    """ffmpeg was killed because its job was cancelled."""
+
+
+@dataclass
+class Watchdog:
+    """Limits on how long an ffmpeg job may take, and how often to retry it when it goes over."""
+
+    timeout: float = None  # The most seconds a single attempt may run for.
+    stall_timeout: float = None  # The most seconds to wait for ffmpeg's out_time to move forward.
+    retries: int = 0  # How many times to retry a job that had to be killed.
+    backoff: float = 1.0  # Seconds to wait before the first retry. Doubles for every retry after that.
+
+    @property
+    def poll(self):
+        """How often to check on a job, in seconds, or None if there's nothing to check."""
+        limits = [limit for limit in (self.timeout, self.stall_timeout) if limit]
+        if not limits:
+            return None
+        return min(WATCHDOG_POLL, *limits)
+
+    def delay(self, retry):
+        """How long to wait before a retry.
+
+        :param retry: Which retry this is, starting from 1.
+        :return: The delay, in seconds.
+        """
+        return self.backoff * (2 ** (retry - 1))
+
+
+def split_lines(buffer, chunk):
+    """Add a chunk to what's left of the last one, and split off all the complete lines.
+
+    :return: A tuple of (complete lines, leftover bytes)
+    """
+    lines = _LINE_BREAK_REGEX.split(buffer + chunk)
+    return lines[:-1], lines[-1]
+
+
+def decode_line(line):
+    """Turn a raw line of output into clean text."""
+    return line.decode("utf-8", errors="replace").strip()
+
+
+def _read_lines_selected(p, poll=None):
+    """Yield (stream name, line) pairs from a process's stdout and stderr as soon as either has something to say.
+
+    :param p: A Popen instance with both stdout and stderr piped.
+    :param poll: If set, yield (None, "") whenever this many seconds go by with nothing to read, so the caller gets a
+                 chance to check on the process.
+    """
+    buffers = {"stdout": b"", "stderr": b""}
+    with selectors.DefaultSelector() as selector:
+        selector.register(p.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(p.stderr, selectors.EVENT_READ, "stderr")
+        while selector.get_map():
+            ready = selector.select(poll)
+            if not ready:
+                yield None, ""
+            for key, _ in ready:
+                name = key.data
+                chunk = os.read(key.fileobj.fileno(), READ_SIZE)
+                if not chunk:  # The pipe was closed, so pass along whatever is left.
+                    selector.unregister(key.fileobj)
+                    lines, buffers[name] = [buffers[name]], b""
+                else:
+                    lines, buffers[name] = split_lines(buffers[name], chunk)
+                for line in lines:
+                    yield name, decode_line(line)
+
+
+def _read_lines_threaded(p, poll=None):
+    """Yield (stream name, line) pairs from a process's stdout and stderr, reading each pipe on its own thread.
+
+    Windows can't select() on pipes, so this stands in for _read_lines_selected there.
+
+    :param p: A Popen instance with both stdout and stderr piped.
+    :param poll: If set, yield (None, "") whenever this many seconds go by with nothing to read.
+    """
+    lines = queue.Queue()
+
+    def pump(name, pipe):
+        for line in iter(pipe.readline, b""):
+            lines.put((name, line))
+        lines.put((name, None))
+
+    for name in ("stdout", "stderr"):
+        threading.Thread(target=pump, args=(name, getattr(p, name)), daemon=True).start()
+
+    open_pipes = 2
+    while open_pipes:
+        try:
+            name, line = lines.get(timeout=poll)
+        except queue.Empty:
+            yield None, ""
+            continue
+        if line is None:
+            open_pipes -= 1
+            continue
+        yield name, decode_line(line)
+
+
 class FFProgress:
     """Represents a single run of an ffmpeg command."""
     DUR_REGEX = re.compile(r"Duration: (?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})\.(?P<ms>\d{2})")
-    TIME_REGEX = re.compile(r"out_time=(?P<hour>\d{2}):(?P<min>\d{2}):(?P<sec>\d{2})\.(?P<ms>\d{2})")
 
-    def __init__(self, cmd) -> None:
+    def __init__(self, cmd, keep_log=False, tail_lines=TAIL_LINES, watchdog=None, on_retry=None, cancel=None) -> None:
         """Initialize the FfmpegProgress class.
 
         :param cmd: A list of command line elements, e.g. ["ffmpeg", "-i", ...]
+        :param keep_log: Keep every line of output, not just the last few. It is held in memory until it gets large,
+                         and then moved to a temporary file.
+        :param tail_lines: How many of the most recent lines to keep for error messages.
+        :param watchdog: A Watchdog, to kill and retry ffmpeg if it takes too long or stops making progress.
+        :param on_retry: Called with the retry number and the FFmpegTimeoutError that caused it, before each retry.
+        :param cancel: A threading or multiprocessing Event. Once it is set, ffmpeg is killed and FFmpegCancelledError
+                       is raised.
         """
         self.cmd = cmd
-        self.output = None
+        self.watchdog = watchdog or Watchdog()
+        self.on_retry = on_retry
+        self.cancel = cancel
+        self.attempts = 0
+        self.returncode = None
+        self.last_event = None
+        self._started_at = None
+        self._last_advance = None
+        self._input_dur = None
+        self._block = dict()
+        self._tail = deque(maxlen=tail_lines)
+        self._log = SpooledTemporaryFile(max_size=LOG_SPOOL_BYTES, mode="w+", encoding="utf-8") if keep_log else None
+        self._line_count = 0
 
-    def run(self):
-        """Run an ffmpeg command, trying to capture the process output and calculate the duration / progress.
+    @property
+    def output(self):
+        """Text output from the command: all of it if keep_log was set, otherwise just the most recent lines.
 
-        Yields the progress in percent.
+        None until the command has been run.
+        """
+        if self._line_count == 0:
+            return None
+        return "\n".join(self.lines())
+
+    def lines(self):
+        """Iterate over the lines of output, without loading them all into memory at once.
+
+        Without keep_log, only the most recent lines are available.
         """
-        total_dur = None
+        if self._log is None:
+            yield from list(self._tail)
+            return
+        self._log.seek(0)
+        for line in self._log:
+            yield line.rstrip("\n")
 
-        # Make sure the command has -progress and -nostats
-        cmd_with_progress = ([self.cmd[0]] + ["-progress", "-", "-nostats"] + self.cmd[1:])
+    def close(self):
+        """Throw away the full log, if we were keeping one."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
 
-        stdout = []
+    def _record(self, line):
+        """Keep a line of output."""
+        self._tail.append(line)
+        self._line_count += 1
+        if self._log is not None:
+            self._log.seek(0, io.SEEK_END)  # lines() may have moved us.
+            self._log.write(line + "\n")
 
-        p = subprocess.Popen(
-            cmd_with_progress,
-            stdin=subprocess.PIPE,  # Apply stdin isolation by creating separate pipe.
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=False,
-        )
+    def _total_duration(self):
+        """Work out how long the output will be, in seconds, from the input's duration and any -ss/-t/-to options."""
+        duration, seek = requested_duration(self.cmd)
+        if duration is not None:
+            return duration
+        if self._input_dur is not None and seek:
+            return max(self._input_dur - seek, 0)
+        return self._input_dur
 
-        yield 0
+    def _progress_cmd(self):
+        """The command, with -progress and -nostats added."""
+        return [self.cmd[0]] + ["-progress", "pipe:1", "-nostats"] + self.cmd[1:]
+
+    @property
+    def _poll(self):
+        """How often to check on ffmpeg, in seconds, or None if there's nothing to check."""
+        if self.cancel is None:
+            return self.watchdog.poll
+        return min(WATCHDOG_POLL, self.watchdog.poll or WATCHDOG_POLL)
+
+    def _start(self):
+        """Forget anything from a previous run."""
+        self.attempts += 1
+        self.returncode = None
+        self.last_event = None
+        self._input_dur = None
+        self._block = dict()
+        self._tail.clear()
+        self._line_count = 0
+        if self._log is not None:
+            self._log.seek(0)
+            self._log.truncate()
+        self._started_at = self._last_advance = time.monotonic()
+
+    def _check_cancelled(self):
+        """Make sure ffmpeg's job hasn't been cancelled.
+
+        :raises FFmpegCancelledError: If it was.
+        """
+        if self.cancel is not None and self.cancel.is_set():
+            raise FFmpegCancelledError(f"Command {str(self.cmd)} was cancelled.")
+
+    def _check_watchdog(self):
+        """Make sure ffmpeg is still within the limits set by the watchdog, and its job hasn't been cancelled.
+
+        :raises FFmpegTimeoutError: If it isn't within the limits.
+        :raises FFmpegCancelledError: If the job was cancelled.
+        """
+        self._check_cancelled()
+        now = time.monotonic()
+        timeout = self.watchdog.timeout
+        if timeout and now - self._started_at > timeout:
+            raise FFmpegTimeoutError(f"Command {str(self.cmd)} timed out after {timeout} seconds.")
+        stall_timeout = self.watchdog.stall_timeout
+        if stall_timeout and now - self._last_advance > stall_timeout:
+            raise FFmpegTimeoutError(f"Command {str(self.cmd)} stalled, with no progress for {stall_timeout} seconds.")
+
+    def _handle_line(self, stream, line):
+        """Deal with a single line of output.
+
+        :param stream: "stdout" for the -progress reports, or "stderr" for the log.
+        :param line: The line of output, already decoded and stripped.
+        :return: A ProgressEvent, if this line finished off a progress report. Otherwise None.
+        """
+        # Blank lines would just push useful ones out of the tail.
+        if not line:
+            return None
 
+        if stream == "stderr":
+            self._record(line)
+            if self._input_dur is None:  # We haven't found the input duration yet
+                dur_match = FFProgress.DUR_REGEX.search(line)
+                if dur_match:
+                    self._input_dur = to_ms(**dur_match.groupdict()) / 1000
+            return None
+
+        key, _, value = line.partition("=")
+        self._block[key.strip()] = value.strip()
+        if key != "progress":  # Every block ends with a progress line.
+            return None
+        event = ProgressEvent.from_block(self._block, self._total_duration())
+        if self.last_event is None or event.out_time > self.last_event.out_time:
+            self._last_advance = time.monotonic()
+        self.last_event = event
+        self._block = dict()
+        return event
+
+    def _finish(self, returncode):
+        """Throw an exception if ffmpeg didn't exit cleanly."""
+        if returncode != 0:
+            tail = "\n".join(self._tail)
+            raise RuntimeError(f"Error running command {str(self.cmd)}: {tail}")
+
+    def events(self):
+        """Run an ffmpeg command, reading its progress reports and log messages separately.
+
+        The log, on stderr, is kept for output and lines(). The -progress reports, on stdout, are parsed as they arrive.
+        If the command writes a file, it waits for a free writer slot first (see governor.writer_slot).
+
+        Yields a ProgressEvent for every progress report.
+        """
+        with governor.writer_slot(self.cmd, self._check_cancelled):
+            self._start()
+            p = child_processes.Popen(
+                self._progress_cmd(),
+                stdin=subprocess.PIPE,  # Apply stdin isolation by creating separate pipe.
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=False,
+            )
+
+            read_lines = _read_lines_threaded if os.name == "nt" else _read_lines_selected
+            try:
+                for stream, line in read_lines(p, self._poll):
+                    self._check_watchdog()
+                    event = self._handle_line(stream, line)
+                    if event is not None:
+                        yield event
+            # Don't leave ffmpeg running if it's stuck, cancelled, nobody's listening, or we're being interrupted.
+            except BaseException:
+                p.kill()
+                raise
+            finally:
+                self.returncode = p.wait()
+                for pipe in (p.stdin, p.stdout, p.stderr):
+                    pipe.close()
+        self._finish(p.returncode)
+
+    def retry_delay(self, error):
+        """Decide whether to retry after a timeout, and let on_retry know if we are.
+
+        :param error: The FFmpegTimeoutError that ended the last attempt.
+        :raises FFmpegTimeoutError: If we are out of retries.
+        :return: How long to wait before retrying, in seconds.
+        """
+        retry = self.attempts
+        if retry > self.watchdog.retries:
+            raise error
+        if self.on_retry:
+            self.on_retry(retry, error)
+        return self.watchdog.delay(retry)
+
+    def retrying_events(self):
+        """Like events(), but run ffmpeg again from the start whenever the watchdog kills it, as often as it allows.
+
+        Yields a ProgressEvent for every progress report, and None whenever a retry starts.
+        """
         while True:
-            # If there isn't anything new to process, just keep spinning.
-            line = p.stdout
-            if line is None:
-                continue
-
-            # Clean up the line we got from subprocess
-            stdout_line = line.readline().decode("utf-8", errors="replace").strip()
-
-            # Check if it is time to exit
-            if stdout_line == "" and p.poll() is not None:
-                break
-
-            # Add what we got to our internal track of stderr
-            stdout.append(stdout_line.strip())
-            self.output = "\n".join(stdout)
-
-            # Check out regexes
-            if total_dur is None:  # We haven't found the initial duration yet
-                total_dur_match = FFProgress.DUR_REGEX.search(stdout_line)
-                if total_dur_match:
-                    total_dur = total_dur_match.groupdict()
-                    total_dur = to_ms(**total_dur)
-            else:  # We already know our duration, lets see if we have an update
-                progress_time = FFProgress.TIME_REGEX.search(stdout_line)
-                if progress_time:
-                    elapsed_time = to_ms(**progress_time.groupdict())
-                    yield (elapsed_time / total_dur) * 100
-
-        # Throw an exception if ffmpeg didn't exit cleanly
-        if p.returncode != 0:
-            self.output = "\n".join(stdout)
-            raise RuntimeError(f"Error running command {str(self.cmd)}: {self.output}")
+            try:
+                yield from self.events()
+                return
+            except FFmpegTimeoutError as e:
+                time.sleep(self.retry_delay(e))
+                yield None
+
+    def run(self):
+        """Run an ffmpeg command, capturing the process output and calculating the progress.
+
+        If the watchdog kills ffmpeg, it is run again from the start, as many times as the watchdog allows.
+
+        Yields the progress in percent.
+        """
+        yield 0
+        for event in self.retrying_events():
+            if event is None:
+                yield 0
+            elif event.percent is not None:
+                yield event.percent
 
         # We've got nothing else to give, so mark it as 100% done
         yield 100
 
 
-def run(cmd, task_name="Thinking", print_errors=True):
+def run(cmd, task_name="Thinking", print_errors=True, keep_log=False, watchdog=None):
     """Run ffmpeg command and show progress.
 
     :param cmd: Command to run
     :param task_name: Text to print in front of progress bar
     :param print_errors: Toggle whether to print error messages, or re-throw the exception.
+    :param keep_log: Keep every line of output, so it can be read back with FFProgress.lines().
+    :param watchdog: A Watchdog, to kill and retry ffmpeg if it takes too long or stops making progress.
 
     :return FFProgress instance
     """
-    progress = Progress(SpinnerColumn(), *Progress.get_default_columns())
+    progress = make_progress()
     progress.start()
-    ff = FFProgress(cmd)
+    task = progress.add_task(f"[cyan]{task_name}", total=100)
+
+    def _on_retry(retry, error):
+        progress.console.print(f"[bold yellow]Warning:[/] {error} Retrying ({retry} of {watchdog.retries}).")
+        progress.update(task, completed=0)
+
+    ff = FFProgress(cmd, keep_log=keep_log, watchdog=watchdog, on_retry=_on_retry)
 
     try:
-        task = progress.add_task(f"[cyan]{task_name}", total=100)
         for percent in ff.run():
-            progress.update(task, completed=percent)
+            progress.update(task, completed=percent, speed=ff.last_event and ff.last_event.speed)
     except RuntimeError as e:
+        ff.close()
         if print_errors:
             progress.console.print("[bold red]Error:[/] Something went wrong with ffmpeg:")
             progress.console.print(e)
@@ -0,0 +1,262 @@
+"""Keep batch work from starving everything else running on the same machine.
+
+Every ffmpeg and ffprobe we start can be made to run at a lower CPU priority (nice), in a gentler I/O scheduling class
+(ionice), and on a chosen set of CPUs (affinity). These are applied to our own process by apply(), and every child
+inherits them from there. The number of ffmpeg commands writing files at the same time can be capped too, across every
+thread and worker process, so a batch can keep its CPUs busy without flooding the disk.
+
+The limits are process-wide, and set once with configure(), usually from the global command line options.
+"""
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import ctypes
+from dataclasses import dataclass, replace
+import multiprocessing as mp
+import os
+import platform
+import sys
+
+from rich import print
+
+# I/O scheduling classes we can put children in. Realtime is left out, since it needs root and is the opposite of what
+# we're here for.
+IO_CLASSES = {"best-effort": 2, "idle": 3}
+
+# Priority levels within the best-effort class, from highest to lowest.
+IO_LEVELS = range(8)
+
+# How often, in seconds, to check back while waiting for a free writer slot.
+WRITER_POLL = 0.25
+
+# ioprio_set() has no wrapper in libc, or in os, so it is called by number. The number depends on the architecture.
+_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+
+@dataclass(frozen=True)
+class Limits:
+    """Limits on the children we start. A limit of None means that one isn't set.
+
+    :param nice: The nice level to run children at, from -20 (highest priority) to 19 (lowest).
+    :param io_class: The I/O scheduling class to run children in. One of IO_CLASSES.
+    :param io_level: The priority within the best-effort I/O class, from 0 (highest) to 7 (lowest).
+    :param cpus: The CPUs children may run on, as a frozenset of CPU numbers.
+    :param max_writers: The most ffmpeg commands that may write files at once.
+    """
+
+    nice: int = None
+    io_class: str = None
+    io_level: int = None
+    cpus: frozenset = None
+    max_writers: int = None
+
+
+# Process-wide limits, and the writer slots that go with them.
+_limits = Limits()
+_writer_slots = None
+
+
+def parse_cpus(spec):
+    """Read a list of CPUs, like taskset's, e.g. '0-3,8'.
+
+    :raises ValueError: If spec isn't a list of CPUs.
+    :return: A frozenset of CPU numbers.
+    """
+    cpus = set()
+    for part in spec.split(","):
+        first, dash, last = part.partition("-")
+        if not first.isdigit() or (dash and not last.isdigit()) or int(last or first) < int(first):
+            raise ValueError(f"Couldn't read CPU list '{spec}'. Expected something like '0-3,8'.")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return frozenset(cpus)
+
+
+def parse_ionice(spec):
+    """Read an I/O scheduling class, with an optional priority level, e.g. 'idle' or 'best-effort:7'.
+
+    :raises ValueError: If spec isn't a class we know, or the level is out of range.
+    :return: A tuple of (io_class, io_level). io_level is None if it wasn't given.
+    """
+    io_class, _, level = spec.partition(":")
+    if io_class not in IO_CLASSES:
+        raise ValueError(f"Unknown I/O class '{io_class}'. Choose from: {', '.join(IO_CLASSES)}")
+    if not level:
+        return io_class, None
+    if io_class != "best-effort":
+        raise ValueError(f"The '{io_class}' I/O class has no priority levels.")
+    if not level.isdigit() or int(level) not in IO_LEVELS:
+        raise ValueError(f"I/O priority level must be from {IO_LEVELS[0]} to {IO_LEVELS[-1]}, not '{level}'.")
+    return io_class, int(level)
+
+
+def from_options(nice=None, ionice=None, cpus=None, max_writers=None):
+    """Build Limits from command line options, given as strings.
+
+    :param nice: A nice level, e.g. '10'.
+    :param ionice: An I/O class, for parse_ionice().
+    :param cpus: A list of CPUs, for parse_cpus().
+    :param max_writers: The most ffmpeg commands to let write files at once, e.g. '2'.
+    :raises ValueError: If any of them can't be read.
+    """
+    fields = dict()
+    for name, value in (("nice", nice), ("max_writers", max_writers)):
+        if value is not None:
+            try:
+                fields[name] = int(value)
+            except ValueError:
+                raise ValueError(f"Expected a whole number for {name.replace('_', ' ')}, not '{value}'.") from None
+    if ionice is not None:
+        fields["io_class"], fields["io_level"] = parse_ionice(ionice)
+    if cpus is not None:
+        fields["cpus"] = parse_cpus(cpus)
+    return Limits(**fields)
+
+
+def _check(limits):
+    """Make sure every limit is one we could apply.
+
+    :raises ValueError: If one is out of range, or asks for more than we're allowed.
+    """
+    if limits.nice is not None:
+        if not -20 <= limits.nice <= 19:
+            raise ValueError(f"Nice level must be from -20 to 19, not {limits.nice}.")
+        current = os.getpriority(os.PRIO_PROCESS, 0)
+        if limits.nice < current and os.geteuid() != 0:
+            raise ValueError(f"Can't run ffmpeg at nice level {limits.nice}, above our own priority of {current}, "
+                             f"without root.")
+    if limits.cpus is not None:
+        allowed = os.sched_getaffinity(0)
+        if not limits.cpus <= allowed:
+            raise ValueError(f"Can't run ffmpeg on CPUs {sorted(limits.cpus - allowed)}. Only "
+                             f"{sorted(allowed)} are available.")
+    if limits.max_writers is not None and limits.max_writers < 1:
+        raise ValueError(f"Must allow at least one writer, not {limits.max_writers}.")
+
+
+def _supported(limits):
+    """Drop any limits this platform can't apply, with a warning for each one."""
+    unsupported = list()
+    if os.name != "posix":
+        unsupported += [name for name in ("nice", "io_class", "cpus") if getattr(limits, name) is not None]
+    else:
+        if limits.io_class is not None and (sys.platform != "linux" or platform.machine() not in _IOPRIO_SET):
+            unsupported.append("io_class")
+        if limits.cpus is not None and not hasattr(os, "sched_setaffinity"):
+            unsupported.append("cpus")
+    for name in unsupported:
+        print(f"[bold yellow]Warning:[/] Setting {name.replace('_', ' ')} isn't supported here, so it will be ignored.")
+    changes = {name: None for name in unsupported}
+    if "io_class" in unsupported:
+        changes["io_level"] = None
+    return replace(limits, **changes)
+
+
+def configure(limits, writer_slots=None):
+    """Set the limits for every child started from now on, replacing any set before.
+
+    The writer cap takes effect straight away. The rest only take effect once apply() is called.
+
+    :param limits: A Limits. Any this platform can't apply are dropped, with a warning.
+    :param writer_slots: The writer slots from get_writer_slots() in the process that started this one, so a worker
+        process shares them, rather than getting max_writers of its own.
+    :raises ValueError: If a limit is out of range, or asks for more than we're allowed.
+    """
+    global _limits, _writer_slots
+    limits = _supported(limits)
+    _check(limits)
+    _limits = limits
+    if writer_slots is None and limits.max_writers:
+        writer_slots = mp.BoundedSemaphore(limits.max_writers)
+    _writer_slots = writer_slots if limits.max_writers else None
+
+
+def get_limits():
+    """Get the limits currently in force."""
+    return _limits
+
+
+def get_writer_slots():
+    """Get the semaphore behind the writer cap, to hand to worker processes, or None if there is no cap."""
+    return _writer_slots
+
+
+def _set_ioprio(io_class, io_level):
+    """Set the I/O scheduling class of the calling thread."""
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+    value = (IO_CLASSES[io_class] << _IOPRIO_CLASS_SHIFT) | (io_level or 0)
+    if syscall(_IOPRIO_SET[platform.machine()], _IOPRIO_WHO_PROCESS, 0, value) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def apply():
+    """Hold our own process to the nice level, I/O class and CPUs that were configured, so every child inherits them.
+
+    On Linux these belong to each thread, and new threads take them from the thread that starts them, so call this
+    from the main thread before any others are started. There is no going back, since only root may raise its priority
+    again.
+    """
+    limits = _limits
+    if limits.nice is not None:
+        os.setpriority(os.PRIO_PROCESS, 0, limits.nice)
+    if limits.io_class is not None:
+        _set_ioprio(limits.io_class, limits.io_level)
+    if limits.cpus is not None:
+        os.sched_setaffinity(0, limits.cpus)
+
+
+def writes_file(cmd):
+    """Guess whether an ffmpeg command writes a file. Its output, the last argument, mustn't be a pipe or null."""
+    if not cmd:
+        return False
+    output = str(cmd[-1])
+    if output == "-" or output.startswith("pipe:"):
+        return False
+    return not any(str(arg) == "-f" and str(value) == "null" for arg, value in zip(cmd, cmd[1:]))
+
+
+@contextmanager
+def writer_slot(cmd, check=None):
+    """Hold one of the max_writers slots for as long as a command runs, if it writes a file.
+
+    :param cmd: The ffmpeg command about to be run.
+    :param check: Called every WRITER_POLL seconds while waiting for a slot. It may raise to stop waiting.
+    """
+    slots = _writer_slots
+    if slots is None or not writes_file(cmd):
+        yield
+        return
+    while not slots.acquire(timeout=WRITER_POLL):
+        if check:
+            check()
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+@asynccontextmanager
+async def async_writer_slot(cmd, check=None):
+    """Like writer_slot, but waits without blocking the event loop."""
+    slots = _writer_slots
+    if slots is None or not writes_file(cmd):
+        yield
+        return
+    while not slots.acquire(False):
+        if check:
+            check()
+        await asyncio.sleep(WRITER_POLL)
+    try:
+        yield
+    finally:
+        slots.release()
@@ -0,0 +1,395 @@
+"""Pluggable backends for reading media files.
+
+By default, everything goes through the ffmpeg and ffprobe command line tools. If PyAV is installed, setting
+M4B_UTIL_BACKEND=pyav does the same work in-process through libav, which avoids starting a new process (and
+serializing results to JSON) for every file.
+"""
+import abc
+from fractions import Fraction
+import os
+import re
+from subprocess import DEVNULL, PIPE
+
+from rich import print
+
+from . import ffprogress, probe_cache
+from .child_processes import Popen, run
+
+try:
+    import av
+except ImportError:  # pragma: no cover - PyAV is optional.
+    av = None
+
+# Fields each probe profile asks ffprobe for, from narrowest to broadest. Each profile includes everything in the
+# profiles before it, so a broader probe can always stand in for a narrower one.
+_FORMAT_ENTRIES = "format=format_name,nb_streams,start_time,duration,size,bit_rate"
+_STREAM_ENTRIES = ("stream=index,codec_type,codec_name,sample_rate,channels,time_base,start_time,duration_ts,duration,"
+                   "bit_rate:stream_disposition=attached_pic")
+PROBE_PROFILES = {
+    "duration": ["-show_entries", f"{_FORMAT_ENTRIES}:{_STREAM_ENTRIES}"],
+    "tags": ["-show_entries", f"{_FORMAT_ENTRIES}:format_tags:{_STREAM_ENTRIES}:stream_tags"],
+    "chapters": ["-show_entries", f"{_FORMAT_ENTRIES}:format_tags:{_STREAM_ENTRIES}:stream_tags:chapter:chapter_tags"],
+    "full": ["-show_format", "-show_streams", "-show_chapters"],
+}
+
+# Progress lines from 'ffmpeg -progress', giving how far into the file it has got.
+_OUT_TIME_REGEX = re.compile(r"out_time=(?P<hour>\d+):(?P<min>\d{2}):(?P<sec>\d{2}(\.\d+)?)$")
+
+# Log lines from the silencedetect filter, and ffmpeg's final report.
+_SILENCE_START_REGEX = re.compile(r' silence_start: (?P<start>[0-9]+(\.?[0-9]*))$')
+_SILENCE_END_REGEX = re.compile(r' silence_end: (?P<end>[0-9]+(\.?[0-9]*)) ')
+_TOTAL_DURATION_REGEX = re.compile(
+    r'size=[^ ]+ time=(?P<hours>[0-9]{2}):(?P<minutes>[0-9]{2}):(?P<seconds>[0-9\.]{5}) bitrate=')
+
+# How far before the requested start time to seek, in seconds, so the decoder has settled by the time we get there.
+SEEK_PREROLL = 1.0
+
+# Process-wide backend, created on first use.
+_backend = None
+
+
+def probe_cmd(file, profile="full"):
+    """Build the ffprobe command for a probe profile.
+
+    :param file: File to probe.
+    :param profile: Which of PROBE_PROFILES to ask for.
+    :return: The command, as a list.
+    """
+    return ["ffprobe", *PROBE_PROFILES[profile], "-of", "json", "-i", file]
+
+
+class MediaBackend(abc.ABC):
+    """Everything we need to ask of libav, whichever way we get to it."""
+
+    name = None
+
+    @abc.abstractmethod
+    def probe(self, file, profile="full"):
+        """Read a file's streams, tags, and chapters.
+
+        :param file: File to probe.
+        :param profile: Which of PROBE_PROFILES is needed. Backends may return more than was asked for.
+        :return: Results laid out like ffprobe's JSON output, either as JSON text or already parsed. None if the file
+                 couldn't be read.
+        """
+
+    @abc.abstractmethod
+    def measure_duration(self, file, mode, on_progress=None):
+        """Find a file's duration by reading through the whole thing.
+
+        :param file: The file to read.
+        :param mode: 'decode' to decode every frame, or 'demux' to only read packets.
+        :param on_progress: Called with the number of seconds processed so far, as we work through the file.
+        :return: The duration in seconds, or None if it couldn't be found.
+        """
+
+    @abc.abstractmethod
+    def detect_silence(self, input_path, start_time, end_time, silence_duration, silence_threshold):
+        """Run a file through the silencedetect filter.
+
+        :param input_path: File to scan.
+        :param start_time: Where to start scanning, in seconds.
+        :param end_time: Where to stop scanning, in seconds. None to scan to the end.
+        :param silence_duration: Shortest silence to report, in seconds.
+        :param silence_threshold: Noise level, in dB, below which counts as silence.
+        :return: A list of ("silence_start" | "silence_end" | "duration", seconds) events, in the order they happened,
+                 with times relative to start_time.
+        """
+
+
+class SubprocessBackend(MediaBackend):
+    """Run the ffmpeg and ffprobe command line tools."""
+
+    name = "subprocess"
+
+    def probe(self, file, profile="full"):
+        """Run ffprobe, keeping the results in the persistent probe cache so unchanged files are only probed once."""
+        cache = probe_cache.get_cache()
+        output = cache.get(file, profile) if cache else None
+        if output is None:
+            p = run(probe_cmd(file, profile), capture_output=True)
+            if p.returncode != 0:
+                return None
+            output = p.stdout.decode('utf-8')
+            if cache:
+                cache.put(file, output, profile)
+        return output
+
+    def measure_duration(self, file, mode, on_progress=None):
+        """Run a file through ffmpeg, and read the duration from its final progress report.
+
+        ffmpeg's progress reports are read as they arrive, rather than buffered, so memory use stays flat no matter
+        how long the file is.
+        """
+        # Run the decoder, or just the demuxer
+        cmd = ["ffmpeg", "-nostdin", "-i", file, "-loglevel", "error", "-nostats", "-progress", "pipe:1"]
+        if mode == "demux":
+            cmd += ["-map", "0:a:0", "-c", "copy"]
+        cmd += ["-f", "null", "-"]
+
+        # Keep only the most recent time
+        duration = None
+        with Popen(cmd, stdout=PIPE, stderr=DEVNULL, text=True, errors="replace") as p:
+            for line in p.stdout:
+                match = _OUT_TIME_REGEX.match(line)
+                if match:
+                    duration = (int(match["hour"]) * 60 * 60) + (int(match["min"]) * 60) + float(match["sec"])
+                    if on_progress:
+                        on_progress(duration)
+        if duration is None:
+            return None
+        return round(duration, 3)
+
+    def detect_silence(self, input_path, start_time, end_time, silence_duration, silence_threshold):
+        """Run ffmpeg's silencedetect filter, and pick the results out of its log."""
+        cmd = ["ffmpeg"]
+        if start_time:
+            cmd.extend(["-ss", str(start_time)])
+        cmd.extend(["-i", input_path])
+        if end_time:
+            cmd.extend(["-t", str(end_time - start_time)])
+        cmd.extend([
+            "-filter_complex",
+            f"[0]silencedetect=d={silence_duration}:n={silence_threshold}dB[s0]",
+            "-map", "[s0]",
+            "-f", "null",
+            "-"
+        ])
+        ff = ffprogress.run(cmd, "Detecting Silence", keep_log=True)
+
+        # Check to see if ffmpeg exited abnormally
+        if not ff:
+            return list()
+        try:
+            return _read_silence_lines(ff.lines())
+        finally:
+            ff.close()
+
+
+def _read_silence_lines(lines):
+    """Pull the silencedetect events out of ffmpeg's log."""
+    events = list()
+    for line in lines:
+        # Check for silence start
+        silence_start_match = _SILENCE_START_REGEX.search(line)
+        if silence_start_match:
+            events.append(("silence_start", float(silence_start_match.group('start'))))
+            continue
+
+        # Check for silence end
+        silence_end_match = _SILENCE_END_REGEX.search(line)
+        if silence_end_match:
+            events.append(("silence_end", float(silence_end_match.group('end'))))
+
+        # Check for duration
+        total_duration_match = _TOTAL_DURATION_REGEX.search(line)
+        if total_duration_match:
+            hours = int(total_duration_match.group('hours'))
+            minutes = int(total_duration_match.group('minutes'))
+            seconds = float(total_duration_match.group('seconds'))
+            events.append(("duration", hours * 3600 + minutes * 60 + seconds))
+    return events
+
+
+def _seconds(value, time_base):
+    """Convert a timestamp to seconds, or None if it isn't set."""
+    if value is None or time_base is None:
+        return None
+    return float(value * time_base)
+
+
+def _format_seconds(value):
+    """Format seconds the way ffprobe does."""
+    return None if value is None else f"{value:f}"
+
+
+class PyAVBackend(MediaBackend):
+    """Call into libav directly through PyAV, without starting any new processes."""
+
+    name = "pyav"
+
+    @staticmethod
+    def _stream_data(stream):
+        """Lay out a stream's info like ffprobe does."""
+        data = {
+            "index": stream.index,
+            "codec_type": stream.type,
+            "time_base": f"{stream.time_base.numerator}/{stream.time_base.denominator}" if stream.time_base else None,
+            "start_time": _format_seconds(_seconds(stream.start_time, stream.time_base)),
+            "duration_ts": stream.duration,
+            "duration": _format_seconds(_seconds(stream.duration, stream.time_base)),
+            "disposition": {"attached_pic": int(bool(stream.disposition & av.stream.Disposition.attached_pic))},
+        }
+        if stream.codec_context is not None:
+            data["codec_name"] = stream.codec_context.name
+            if stream.type == "audio":
+                data["sample_rate"] = str(stream.codec_context.sample_rate)
+                data["channels"] = stream.codec_context.channels
+            if stream.codec_context.bit_rate:
+                data["bit_rate"] = str(stream.codec_context.bit_rate)
+        if stream.metadata:
+            data["tags"] = dict(stream.metadata)
+        return {key: value for key, value in data.items() if value is not None}
+
+    def probe(self, file, profile="full"):
+        """Open the file with libav, and read everything any profile could ask for."""
+        try:
+            with av.open(os.fspath(file)) as container:
+                streams = [self._stream_data(stream) for stream in container.streams]
+                chapters = [{
+                    "id": chapter["id"],
+                    "time_base": f"{chapter['time_base'].numerator}/{chapter['time_base'].denominator}",
+                    "start": chapter["start"],
+                    "start_time": _format_seconds(_seconds(chapter["start"], chapter["time_base"])),
+                    "end": chapter["end"],
+                    "end_time": _format_seconds(_seconds(chapter["end"], chapter["time_base"])),
+                    "tags": dict(chapter["metadata"]),
+                } for chapter in container.chapters()]
+                format_data = {
+                    "filename": os.fspath(file),
+                    "nb_streams": len(streams),
+                    "format_name": container.format.name,
+                    "start_time": _format_seconds(_seconds(container.start_time, Fraction(1, av.time_base))),
+                    "duration": _format_seconds(_seconds(container.duration, Fraction(1, av.time_base))),
+                    "size": str(os.path.getsize(file)),
+                    "bit_rate": str(container.bit_rate) if container.bit_rate else None,
+                    "tags": dict(container.metadata) or None,
+                }
+        except (av.error.FFmpegError, OSError):
+            return None
+        return {
+            "streams": streams,
+            "chapters": chapters,
+            "format": {key: value for key, value in format_data.items() if value is not None},
+        }
+
+    def measure_duration(self, file, mode, on_progress=None):
+        """Read every packet (or decode every frame) of the first audio stream, and see where the last one ends."""
+        try:
+            with av.open(os.fspath(file)) as container:
+                if not container.streams.audio:
+                    return None
+                stream = container.streams.audio[0]
+                items = container.decode(stream) if mode == "decode" else container.demux(stream)
+                return self._track_end(items, stream, on_progress)
+        except (av.error.FFmpegError, OSError):
+            return None
+
+    @staticmethod
+    def _track_end(items, stream, on_progress):
+        """Work out how far past the stream's start a series of packets or frames reaches, in seconds."""
+        # Priming samples sit before the stream's start time, and aren't part of the duration.
+        first = stream.start_time
+        end = None
+        reported = 0.0
+        for item in items:
+            if item.pts is None:
+                continue
+            first = item.pts if first is None else first
+            end = max(end or item.pts, item.pts + (item.duration or 0))
+            seconds = float((end - first) * stream.time_base)
+            if on_progress and seconds - reported >= 0.5:  # Don't flood the display with updates.
+                on_progress(seconds)
+                reported = seconds
+        if end is None:
+            return None
+        return round(float((end - first) * stream.time_base), 3)
+
+    def detect_silence(self, input_path, start_time, end_time, silence_duration, silence_threshold):
+        """Decode the file and push it through a silencedetect filter graph."""
+        try:
+            with av.open(os.fspath(input_path)) as container:
+                stream = container.streams.audio[0]
+                graph = av.filter.Graph()
+                graph.link_nodes(
+                    graph.add_abuffer(template=stream),
+                    graph.add("silencedetect", f"d={silence_duration}:n={silence_threshold}dB"),
+                    graph.add("abuffersink"),
+                ).configure()
+
+                # Timestamps are reported relative to where we start, like the command line tool does with -ss.
+                origin = _seconds(stream.start_time, stream.time_base) or 0.0
+                if start_time:
+                    # Seek a little early, since the first frames after a seek can be garbled while the decoder
+                    # catches up. They are skipped, along with everything else before the start time.
+                    preroll = max(0.0, start_time - SEEK_PREROLL)
+                    container.seek(int(preroll / stream.time_base) + (stream.start_time or 0), stream=stream)
+                    origin += start_time
+                limit = end_time - (start_time or 0.0) if end_time else None
+                return self._run_silence_graph(graph, container.decode(stream), origin, limit)
+        except (av.error.FFmpegError, OSError, IndexError):
+            return list()
+
+    @staticmethod
+    def _pull_silence_events(graph, events, skip_until, origin):
+        """Collect the silence events silencedetect has attached to any frames that are ready."""
+        while True:
+            try:
+                frame = graph.pull()
+            except (av.error.BlockingIOError, av.error.EOFError):
+                return
+            for key, kind in (("lavfi.silence_start", "silence_start"), ("lavfi.silence_end", "silence_end")):
+                if key in frame.metadata:
+                    # Anything at the first frame we used counts as the very start, like it would with -ss.
+                    timestamp = float(frame.metadata[key])
+                    events.append((kind, 0.0 if timestamp <= origin + 1e-6 else timestamp - skip_until))
+
+    def _run_silence_graph(self, graph, frames, skip_until, limit):
+        """Feed frames through the filter graph, collecting the silence events it attaches to them.
+
+        :param skip_until: Timestamp, in seconds, to start at. Reported times are relative to it.
+        :param limit: How many seconds past the start to stop at, or None to go to the end.
+        """
+        events = list()
+        origin = None
+        end = 0.0
+        for frame in frames:
+            if frame.time is None or frame.time < skip_until:
+                continue
+            origin = frame.time if origin is None else origin
+            if limit and frame.time - skip_until >= limit:
+                break
+            end = max(end, frame.time + frame.samples / frame.sample_rate - skip_until)
+            graph.push(frame)
+            self._pull_silence_events(graph, events, skip_until, origin)
+        if origin is not None:
+            graph.push(None)
+            self._pull_silence_events(graph, events, skip_until, origin)
+        events.append(("duration", end))
+        return events
+
+
+BACKENDS = {
+    SubprocessBackend.name: SubprocessBackend,
+    PyAVBackend.name: PyAVBackend,
+}
+
+
+def make_backend(name):
+    """Create a backend by name, falling back to the subprocess backend if PyAV was asked for but isn't installed.
+
+    :param name: One of BACKENDS.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown media backend '{name}'. Expected one of {', '.join(BACKENDS)}.")
+    if name == PyAVBackend.name and av is None:
+        print("[bold yellow]Warning:[/] PyAV is not installed. Falling back to the ffmpeg command line tools.")
+        name = SubprocessBackend.name
+    return BACKENDS[name]()
+
+
+def get_backend():
+    """Get the process-wide backend, chosen by M4B_UTIL_BACKEND. Defaults to the subprocess backend."""
+    global _backend
+    if _backend is None:
+        _backend = make_backend(os.environ.get("M4B_UTIL_BACKEND", SubprocessBackend.name))
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the process-wide backend.
+
+    :param backend: A MediaBackend, the name of one, or None to go back to choosing via M4B_UTIL_BACKEND.
+    """
+    global _backend
+    _backend = make_backend(backend) if isinstance(backend, str) else backend
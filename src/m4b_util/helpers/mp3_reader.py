@@ -0,0 +1,357 @@
+"""Read duration and tags straight from MP3 files, without running ffprobe."""
+import mmap
+import struct
+
+# File extensions we will attempt to read.
+EXTENSIONS = (".mp3",)
+
+# Time base ffmpeg uses for MP3 streams. Every MPEG audio sample rate divides it evenly.
+_TIME_BASE = 14112000
+
+# The most frames we will count one at a time before deciding ffprobe is the better tool for the job.
+MAX_WALK_FRAMES = 200000
+
+# Bitrates in kbps, indexed by [version is MPEG-1][layer][bitrate index].
+_BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+# Sample rates, indexed by [version bits][sample rate index].
+_SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),  # MPEG-1
+    0b10: (22050, 24000, 16000),  # MPEG-2
+    0b00: (11025, 12000, 8000),  # MPEG-2.5
+}
+
+# ID3v2 text frames, and the names ffmpeg gives them.
+_ID3_TAGS = {
+    "TIT2": "title",
+    "TALB": "album",
+    "TPE1": "artist",
+    "TPE2": "album_artist",
+    "TPE3": "performer",
+    "TCOM": "composer",
+    "TCON": "genre",
+    "TCOP": "copyright",
+    "TENC": "encoded_by",
+    "TLAN": "language",
+    "TPOS": "disc",
+    "TPUB": "publisher",
+    "TRCK": "track",
+    "TSSE": "encoder",
+    "TDRC": "date",
+    "TYER": "date",
+    "TIT1": "grouping",
+    "TIT3": "TIT3",
+    "TT2": "title",
+    "TAL": "album",
+    "TP1": "artist",
+    "TP2": "album_artist",
+    "TCM": "composer",
+    "TCO": "genre",
+    "TRK": "track",
+    "TYE": "date",
+    "TEN": "encoded_by",
+    "TSS": "encoder",
+}
+
+# ID3v2 text encodings
+_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+
+class UnsupportedFileError(Exception):
+    """Raised when we can't be sure of our answers, and ffprobe should be used instead."""
+
+
+class _FrameHeader:
+    """A single MPEG audio frame header."""
+
+    def __init__(self, header):
+        """Decode a header from its 32-bit integer form. Raises ValueError if it isn't valid."""
+        if header >> 21 != 0x7FF:
+            raise ValueError("No frame sync")
+        self.version = (header >> 19) & 0b11
+        layer_bits = (header >> 17) & 0b11
+        bitrate_index = (header >> 12) & 0xF
+        rate_index = (header >> 10) & 0b11
+        if self.version == 0b01 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+            raise ValueError("Reserved or free-format header")
+        self.layer = 4 - layer_bits
+        self.mpeg1 = self.version == 0b11
+        self.bitrate = _BITRATES[self.mpeg1][self.layer][bitrate_index] * 1000
+        self.sample_rate = _SAMPLE_RATES[self.version][rate_index]
+        self.padding = (header >> 9) & 1
+        self.channels = 1 if (header >> 6) & 0b11 == 0b11 else 2
+
+        if self.layer == 1:
+            self.samples = 384
+            self.length = (12 * self.bitrate // self.sample_rate + self.padding) * 4
+        else:
+            self.samples = 1152 if self.layer == 2 or self.mpeg1 else 576
+            self.length = (self.samples // 8) * self.bitrate // self.sample_rate + self.padding
+
+    @property
+    def side_info_size(self):
+        """Size of the layer III side info, which comes right after the header."""
+        if self.mpeg1:
+            return 17 if self.channels == 1 else 32
+        return 9 if self.channels == 1 else 17
+
+    def same_stream(self, other):
+        """Check that another header could belong to the same stream."""
+        return (self.version, self.layer, self.sample_rate) == (other.version, other.layer, other.sample_rate)
+
+
+def _read_header(buf, offset):
+    """Read the frame header at offset, or None if there isn't a valid one."""
+    if offset + 4 > len(buf):
+        return None
+    try:
+        return _FrameHeader(struct.unpack_from(">I", buf, offset)[0])
+    except ValueError:
+        return None
+
+
+def _syncsafe(data):
+    """Decode an ID3v2 'syncsafe' integer, which only uses the lower 7 bits of each byte."""
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7F)
+    return value
+
+
+def _decode_text(data, first_only=True):
+    """Decode an ID3v2 text field, which starts with an encoding byte. Multiple values are null-separated."""
+    if not data:
+        return ""
+    encoding = _ENCODINGS[data[0]] if data[0] < len(_ENCODINGS) else "latin-1"
+    text = data[1:].decode(encoding, errors="replace")
+    return text.split("\0")[0] if first_only else text
+
+
+class _ID3v2:
+    """The parts of an ID3v2 tag that ffprobe would report."""
+
+    def __init__(self, buf):
+        """Parse the tag at the start of buf, if there is one."""
+        self.size = 0
+        self.tags = dict()
+        self.chapters = list()
+        self.has_cover = False
+        if len(buf) < 10 or buf[:3] != b"ID3":
+            return
+
+        version, flags = buf[3], buf[5]
+        self.size = 10 + _syncsafe(buf[6:10]) + (10 if flags & 0x10 else 0)
+        if version not in (2, 3, 4) or flags & 0x80:
+            raise UnsupportedFileError("Unsupported ID3v2 version, or unsynchronized tag")
+        offset = 10
+        if flags & 0x40:  # Extended header
+            extended_size = struct.unpack_from(">I", buf, offset)[0]
+            offset += _syncsafe(buf[offset:offset + 4]) if version == 4 else extended_size + 4
+
+        end = min(self.size - (10 if flags & 0x10 else 0), len(buf))
+        for frame_id, frame_flags, data in self._frames(buf, offset, end, version):
+            if frame_flags & 0x00FF and version != 2:
+                raise UnsupportedFileError("Compressed, encrypted, or unsynchronized frame")
+            self._read_frame(frame_id, data, version)
+
+    @staticmethod
+    def _frames(buf, offset, end, version):
+        """Iterate over (frame id, flags, data) for each frame."""
+        header_size = 6 if version == 2 else 10
+        while offset + header_size <= end and buf[offset] != 0:
+            if version == 2:
+                frame_id = bytes(buf[offset:offset + 3]).decode("latin-1")
+                size = int.from_bytes(buf[offset + 3:offset + 6], "big")
+                frame_flags = 0
+            else:
+                frame_id = bytes(buf[offset:offset + 4]).decode("latin-1")
+                raw_size = buf[offset + 4:offset + 8]
+                size = _syncsafe(raw_size) if version == 4 else int.from_bytes(raw_size, "big")
+                frame_flags = struct.unpack_from(">H", buf, offset + 8)[0]
+            offset += header_size
+            if offset + size > end:
+                raise UnsupportedFileError(f"ID3v2 frame '{frame_id}' runs past the end of the tag")
+            yield frame_id, frame_flags, bytes(buf[offset:offset + size])
+            offset += size
+
+    def _read_frame(self, frame_id, data, version):
+        """Record the info from a single frame."""
+        if frame_id in _ID3_TAGS:
+            self.tags.setdefault(_ID3_TAGS[frame_id], _decode_text(data))
+        elif frame_id in ("TXXX", "TXX") and data:
+            # User defined text: a description, then the value.
+            description, _, value = _decode_text(data, first_only=False).partition("\0")
+            self.tags.setdefault(description, value.split("\0")[0])
+        elif frame_id in ("COMM", "COM") and len(data) > 4:
+            # Encoding, language, then a null-terminated description before the text.
+            encoding = _ENCODINGS[data[0]] if data[0] < len(_ENCODINGS) else "latin-1"
+            text = data[4:].decode(encoding, errors="replace").split("\0", 1)
+            self.tags.setdefault("comment", text[-1].split("\0")[0])
+        elif frame_id in ("APIC", "PIC"):
+            self.has_cover = True
+        elif frame_id == "CHAP":
+            self._read_chapter(data, version)
+
+    def _read_chapter(self, data, version):
+        """Read a CHAP frame: an element ID, start and end times in ms, byte offsets, then sub-frames."""
+        element_end = data.index(b"\0")
+        start, end = struct.unpack_from(">II", data, element_end + 1)
+        title = None
+        sub_frames = self._frames(data, element_end + 17, len(data), version)
+        for frame_id, _, sub_data in sub_frames:
+            if frame_id == "TIT2":
+                title = _decode_text(sub_data)
+        self.chapters.append((start, end, title))
+
+
+def _find_first_frame(buf, offset):
+    """Find the first frame at or after offset that is followed by another valid frame."""
+    limit = min(len(buf), offset + 65536)
+    while offset < limit:
+        offset = buf.find(b"\xff", offset, limit)
+        if offset < 0:
+            break
+        header = _read_header(buf, offset)
+        if header is not None:
+            following = _read_header(buf, offset + header.length)
+            if following is not None and header.same_stream(following):
+                return offset, header
+            if following is None and offset + header.length == len(buf):
+                return offset, header  # A single-frame file
+        offset += 1
+    raise UnsupportedFileError("No MPEG audio frames found")
+
+
+def _read_vbr_header(buf, offset, header):
+    """Read a Xing/Info or VBRI header from the first frame.
+
+    :return: (frame count, encoder delay) from the header, or None if there isn't a usable one.
+    """
+    xing = offset + 4 + header.side_info_size
+    if bytes(buf[xing:xing + 4]) in (b"Xing", b"Info"):
+        flags = struct.unpack_from(">I", buf, xing + 4)[0]
+        if not flags & 0x1:
+            return None
+        frames = struct.unpack_from(">I", buf, xing + 8)[0]
+        # The LAME tag follows whichever Xing fields are present.
+        lame = xing + 8 + (4 if flags & 0x1 else 0) + (4 if flags & 0x2 else 0) + (100 if flags & 0x4 else 0)
+        lame += 4 if flags & 0x8 else 0
+        delay = None
+        if bytes(buf[lame:lame + 4]) in (b"LAME", b"Lavf", b"Lavc") and lame + 24 <= len(buf):
+            delay = int.from_bytes(buf[lame + 21:lame + 24], "big") >> 12
+        return frames, delay
+    vbri = offset + 36
+    if bytes(buf[vbri:vbri + 4]) == b"VBRI":
+        frames = struct.unpack_from(">I", buf, vbri + 14)[0]
+        return frames, None
+    return None
+
+
+def _walk_frames(buf, offset, first):
+    """Count frames by hopping from header to header. Only trust the count if we land cleanly on the end."""
+    frames = 0
+    end = len(buf)
+    if end >= 128 and bytes(buf[end - 128:end - 125]) == b"TAG":
+        end -= 128  # ID3v1 tag
+    while offset < end:
+        header = _read_header(buf, offset)
+        if header is None or not header.same_stream(first):
+            raise UnsupportedFileError("Lost frame sync")
+        if frames >= MAX_WALK_FRAMES:
+            raise UnsupportedFileError("Too many frames to count")
+        frames += 1
+        offset += header.length
+    if offset > end + 1:  # A single byte of slop is common in the final frame.
+        raise UnsupportedFileError("Truncated final frame")
+    return frames
+
+
+def _parse(buf, file):
+    """Parse an MP3 file that has been loaded into buf."""
+    id3 = _ID3v2(buf)
+    offset, header = _find_first_frame(buf, id3.size)
+
+    vbr = _read_vbr_header(buf, offset, header) if header.layer == 3 else None
+    start_time = 0.0
+    if vbr:
+        frames, delay = vbr
+        if delay is not None:
+            start_time = (delay + 528 + 1) / header.sample_rate
+    else:
+        frames = _walk_frames(buf, offset, header)
+    duration_ts = frames * header.samples * (_TIME_BASE // header.sample_rate)
+    duration = f"{duration_ts * (1 / _TIME_BASE):f}"
+
+    streams = [{
+        "index": 0,
+        "codec_type": "audio",
+        "codec_name": f"mp{header.layer}",
+        "sample_rate": str(header.sample_rate),
+        "channels": header.channels,
+        "time_base": f"1/{_TIME_BASE}",
+        "start_time": f"{start_time:f}",
+        "duration_ts": duration_ts,
+        "duration": duration,
+        "disposition": {"attached_pic": 0},
+    }]
+    if id3.has_cover:
+        # ffprobe presents cover art as an extra video stream.
+        streams.append({"index": 1, "codec_type": "video", "disposition": {"attached_pic": 1}})
+
+    chapters = list()
+    for i, (start, end, title) in enumerate(id3.chapters):
+        chapter = {
+            "id": i,
+            "time_base": "1/1000",
+            "start": start,
+            "start_time": f"{start / 1000:f}",
+            "end": end,
+            "end_time": f"{end / 1000:f}",
+        }
+        if title is not None:
+            chapter["tags"] = {"title": title}
+        chapters.append(chapter)
+
+    data = {
+        "streams": streams,
+        "chapters": chapters,
+        "format": {
+            "filename": str(file),
+            "nb_streams": len(streams),
+            "format_name": "mp3",
+            "start_time": f"{start_time:f}",
+            "duration": duration,
+            "size": str(len(buf)),
+        }
+    }
+    if id3.tags:
+        data["format"]["tags"] = id3.tags
+    return data
+
+
+def read_mp3(file):
+    """Read an MP3 file's duration and tags, laid out the same way as ffprobe's JSON output.
+
+    The frame count comes from a Xing/Info/VBRI header if there is one, and otherwise from walking every frame
+    header in the file.
+
+    :param file: Path to the file to read.
+    :return: A dictionary matching ffprobe's output, or None if we aren't confident in the results.
+    """
+    try:
+        with open(file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _parse(buf, file)
+    except (OSError, ValueError, BufferError, struct.error, IndexError, UnsupportedFileError):
+        return None
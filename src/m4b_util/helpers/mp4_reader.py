@@ -0,0 +1,489 @@
+"""Read duration, tags, and chapters straight from MP4/M4A/M4B files, without running ffprobe."""
+import mmap
+import struct
+
+# File extensions we will attempt to read.
+EXTENSIONS = (".m4a", ".m4b", ".mp4")
+
+# iTunes metadata atoms, and the names ffmpeg gives them.
+_ILST_TAGS = {
+    b"\xa9nam": "title",
+    b"\xa9ART": "artist",
+    b"aART": "album_artist",
+    b"\xa9alb": "album",
+    b"\xa9day": "date",
+    b"\xa9gen": "genre",
+    b"\xa9too": "encoder",
+    b"\xa9cmt": "comment",
+    b"\xa9wrt": "composer",
+    b"\xa9grp": "grouping",
+    b"\xa9lyr": "lyrics",
+    b"cprt": "copyright",
+    b"desc": "description",
+    b"ldes": "synopsis",
+    b"tvsh": "show",
+}
+
+# Handler types, and the matching ffprobe codec_type.
+_HANDLERS = {
+    b"soun": "audio",
+    b"vide": "video",
+    b"text": "subtitle",
+    b"sbtl": "subtitle",
+    b"subt": "subtitle",
+}
+
+
+class UnsupportedFileError(Exception):
+    """Raised when a file uses features this reader doesn't handle, and ffprobe should be used instead."""
+
+
+def _rescale(value, numerator, denominator):
+    """Rescale value by numerator/denominator, rounding to nearest like ffmpeg's av_rescale."""
+    return (value * numerator + denominator // 2) // denominator
+
+
+def _format_time(ts, timescale):
+    """Format a timestamp the same way ffprobe does."""
+    return f"{ts * (1 / timescale):f}"
+
+
+class _Box:
+    """A single box within the file."""
+
+    def __init__(self, buf, box_type, start, end):
+        self.buf = buf
+        self.type = box_type
+        self.start = start  # First byte of the payload
+        self.end = end
+
+    @property
+    def payload(self):
+        return self.buf[self.start:self.end]
+
+    def children(self, offset=0):
+        """Iterate over the boxes contained in this one."""
+        return _iter_boxes(self.buf, self.start + offset, self.end)
+
+    def child(self, *path):
+        """Find the first descendant matching a path of box types, or None."""
+        box = self
+        for box_type in path:
+            for candidate in box.children(4 if box.type == b"meta" else 0):
+                if candidate.type == box_type:
+                    box = candidate
+                    break
+            else:
+                return None
+        return box
+
+
+def _iter_boxes(buf, start, end):
+    """Iterate over the boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise UnsupportedFileError("Truncated box header")
+            size = struct.unpack_from(">Q", buf, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise UnsupportedFileError(f"Invalid size for box '{box_type}'")
+        yield _Box(buf, box_type, offset + header, offset + size)
+        offset += size
+
+
+def _full_box(box):
+    """Get the version of a 'full' box, and the offset of the rest of its payload."""
+    return box.buf[box.start], box.start + 4
+
+
+def _read_header_duration(box):
+    """Read the timescale and duration from an mvhd or mdhd box."""
+    version, offset = _full_box(box)
+    if version == 1:
+        return struct.unpack_from(">IQ", box.buf, offset + 16)
+    return struct.unpack_from(">II", box.buf, offset + 8)
+
+
+def _read_elst(box):
+    """Read edit list entries as a list of (segment_duration, media_time) tuples."""
+    version, offset = _full_box(box)
+    count = struct.unpack_from(">I", box.buf, offset)[0]
+    entry_format = ">Qq" if version == 1 else ">Ii"
+    entry_size = struct.calcsize(entry_format) + 4  # Plus the media rate
+    entries = list()
+    for i in range(count):
+        entries.append(struct.unpack_from(entry_format, box.buf, offset + 4 + i * entry_size))
+    return entries
+
+
+def _read_stts(stbl):
+    """Read the duration of every sample."""
+    box = stbl.child(b"stts")
+    if box is None:
+        raise UnsupportedFileError("Missing stts")
+    _, offset = _full_box(box)
+    count = struct.unpack_from(">I", box.buf, offset)[0]
+    durations = list()
+    for i in range(count):
+        sample_count, delta = struct.unpack_from(">II", box.buf, offset + 4 + i * 8)
+        durations.extend([delta] * sample_count)
+    return durations
+
+
+def _read_sample_offsets(stbl, sample_count):
+    """Calculate the file offset and size of the first sample_count samples."""
+    stsz, stsc = stbl.child(b"stsz"), stbl.child(b"stsc")
+    stco, co64 = stbl.child(b"stco"), stbl.child(b"co64")
+    if stsz is None or stsc is None or (stco is None and co64 is None):
+        raise UnsupportedFileError("Missing sample table")
+
+    # Sample sizes
+    _, offset = _full_box(stsz)
+    fixed_size, size_count = struct.unpack_from(">II", stsz.buf, offset)
+    if fixed_size:
+        sizes = [fixed_size] * size_count
+    else:
+        sizes = list(struct.unpack_from(f">{size_count}I", stsz.buf, offset + 8))
+
+    # Chunk offsets
+    chunk_box, chunk_format = (stco, "I") if stco is not None else (co64, "Q")
+    _, offset = _full_box(chunk_box)
+    chunk_count = struct.unpack_from(">I", chunk_box.buf, offset)[0]
+    chunks = struct.unpack_from(f">{chunk_count}{chunk_format}", chunk_box.buf, offset + 4)
+
+    # Samples per chunk. Each entry applies until the next entry's first chunk.
+    _, offset = _full_box(stsc)
+    stsc_count = struct.unpack_from(">I", stsc.buf, offset)[0]
+    runs = [struct.unpack_from(">III", stsc.buf, offset + 4 + i * 12) for i in range(stsc_count)]
+
+    samples = list()
+    sample = 0
+    for i, (first_chunk, per_chunk, _) in enumerate(runs):
+        last_chunk = runs[i + 1][0] - 1 if i + 1 < len(runs) else chunk_count
+        for chunk in range(first_chunk - 1, last_chunk):
+            position = chunks[chunk]
+            for _ in range(per_chunk):
+                if sample >= min(sample_count, len(sizes)):
+                    return samples
+                samples.append((position, sizes[sample]))
+                position += sizes[sample]
+                sample += 1
+    return samples
+
+
+def _decode_text_sample(buf, position, size):
+    """Decode a QuickTime text sample: a 16-bit length, followed by the text."""
+    if size < 2:
+        return ""
+    length = min(struct.unpack_from(">H", buf, position)[0], size - 2)
+    raw = buf[position + 2:position + 2 + length]
+    if raw.startswith(b"\xfe\xff") or raw.startswith(b"\xff\xfe"):
+        return raw.decode("utf-16", errors="replace")
+    return raw.decode("utf-8", errors="replace")
+
+
+class _Track:
+    """Everything we need to know about a single trak box."""
+
+    def __init__(self, trak, movie_timescale):
+        self.box = trak
+        tkhd, mdhd, hdlr = trak.child(b"tkhd"), trak.child(b"mdia", b"mdhd"), trak.child(b"mdia", b"hdlr")
+        if tkhd is None or mdhd is None or hdlr is None:
+            raise UnsupportedFileError("Incomplete trak")
+
+        # Track ID
+        version, offset = _full_box(tkhd)
+        self.track_id = struct.unpack_from(">I", tkhd.buf, offset + (16 if version == 1 else 8))[0]
+
+        # Handler and name
+        _, offset = _full_box(hdlr)
+        self.handler = hdlr.buf[offset + 4:offset + 8]
+        self.handler_name = bytes(hdlr.buf[offset + 20:hdlr.end]).split(b"\0")[0].decode("utf-8", errors="replace")
+
+        self.language = self._read_language(mdhd)
+        self._read_duration(mdhd, movie_timescale)
+        self._read_sample_description()
+
+        # Chapter track references
+        chap = trak.child(b"tref", b"chap")
+        self.chapter_track_ids = list()
+        if chap is not None:
+            count = (chap.end - chap.start) // 4
+            self.chapter_track_ids = list(struct.unpack_from(f">{count}I", chap.buf, chap.start))
+
+    @staticmethod
+    def _read_language(mdhd):
+        """Read the track language, packed as three 5-bit characters.
+
+        Small values are old Macintosh language codes, where 0 is English and the rest aren't worth the lookup table.
+        """
+        version, offset = _full_box(mdhd)
+        lang = struct.unpack_from(">H", mdhd.buf, offset + (28 if version == 1 else 16))[0]
+        if 0x400 <= lang < 0x7FFF:
+            return "".join(chr(((lang >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+        if lang == 0:
+            return "eng"
+        return None
+
+    def _read_duration(self, mdhd, movie_timescale):
+        """Read the track duration, accounting for any edit list."""
+        self.timescale, self.duration_ts = _read_header_duration(mdhd)
+        if self.timescale == 0:
+            raise UnsupportedFileError("Zero timescale")
+        elst = self.box.child(b"edts", b"elst")
+        if elst is None:
+            return
+        entries = _read_elst(elst)
+        if len(entries) != 1 or entries[0][1] < 0:
+            raise UnsupportedFileError("Complex edit list")
+        segment_duration = entries[0][0]
+        if segment_duration:
+            self.duration_ts = min(self.duration_ts, _rescale(segment_duration, self.timescale, movie_timescale))
+
+    def _read_sample_description(self):
+        """Read the codec, and for audio, the sample rate and channel count."""
+        self.codec_tag = None
+        self.sample_rate = None
+        self.channels = None
+        stsd = self.box.child(b"mdia", b"minf", b"stbl", b"stsd")
+        entries = list(stsd.children(8)) if stsd is not None else []
+        if not entries:
+            return
+        entry = entries[0]
+        self.codec_tag = entry.type.decode("latin-1")
+        if self.handler == b"soun" and entry.end - entry.start >= 28:
+            self.channels = struct.unpack_from(">H", entry.buf, entry.start + 16)[0]
+            self.sample_rate = struct.unpack_from(">I", entry.buf, entry.start + 24)[0] >> 16
+
+    @property
+    def duration(self):
+        return self.duration_ts / self.timescale
+
+    def stream(self, index, codec_type):
+        """Describe this track the way ffprobe describes a stream."""
+        stream = {
+            "index": index,
+            "codec_type": codec_type,
+            "codec_tag_string": self.codec_tag,
+            "time_base": f"1/{self.timescale}",
+            "start_pts": 0,
+            "start_time": _format_time(0, self.timescale),
+            "duration_ts": self.duration_ts,
+            "duration": _format_time(self.duration_ts, self.timescale),
+            "disposition": {"attached_pic": 0},
+            "tags": {"handler_name": self.handler_name},
+        }
+        if self.language:
+            stream["tags"]["language"] = self.language
+        if self.sample_rate is not None:
+            stream["sample_rate"] = str(self.sample_rate)
+            stream["channels"] = self.channels
+        return stream
+
+    def text_samples(self):
+        """Read a text track as a list of (start, end, text), in the track's timescale."""
+        stbl = self.box.child(b"mdia", b"minf", b"stbl")
+        if stbl is None:
+            raise UnsupportedFileError("Missing stbl")
+        durations = _read_stts(stbl)
+        samples = _read_sample_offsets(stbl, len(durations))
+        result = list()
+        time = 0
+        for duration, (position, size) in zip(durations, samples):
+            if position + size > len(self.box.buf):
+                raise UnsupportedFileError("Sample outside of file")
+            result.append((time, time + duration, _decode_text_sample(self.box.buf, position, size)))
+            time += duration
+        return result
+
+
+def _read_ftyp_tags(ftyp):
+    """Read the brand info, which ffmpeg reports as tags."""
+    payload = ftyp.payload
+    if len(payload) < 8:
+        return dict()
+    major_brand, minor_version = struct.unpack_from(">4sI", payload)
+    compatible = [payload[i:i + 4] for i in range(8, len(payload) - 3, 4)]
+    return {
+        "major_brand": major_brand.decode("latin-1"),
+        "minor_version": str(minor_version),
+        "compatible_brands": b"".join(compatible).decode("latin-1"),
+    }
+
+
+def _read_data_atom(atom):
+    """Read the value of an ilst item's data atom. Returns a (type, bytes) tuple, or None."""
+    for data in atom.children():
+        if data.type == b"data" and data.end - data.start >= 8:
+            data_type = struct.unpack_from(">I", data.buf, data.start)[0] & 0xFFFFFF
+            return data_type, bytes(data.buf[data.start + 8:data.end])
+    return None
+
+
+def _read_ilst(ilst):
+    """Read iTunes-style metadata. Returns the tags, and the data type of the cover image (if any)."""
+    tags = dict()
+    cover_type = None
+    for atom in ilst.children():
+        if atom.type == b"covr":
+            value = _read_data_atom(atom)
+            cover_type = value[0] if value else None
+            continue
+        if atom.type == b"----":
+            # Free-form tags are named by their own 'name' atom.
+            name = None
+            for child in atom.children():
+                if child.type == b"name":
+                    name = bytes(child.buf[child.start + 4:child.end]).decode("utf-8", errors="replace")
+            value = _read_data_atom(atom)
+            if name and value and value[0] == 1:
+                tags[name] = value[1].decode("utf-8", errors="replace")
+            continue
+
+        value = _read_data_atom(atom)
+        if value is None:
+            continue
+        data_type, payload = value
+        if atom.type in (b"trkn", b"disk") and len(payload) >= 6:
+            number, total = struct.unpack_from(">HH", payload, 2)
+            tags["track" if atom.type == b"trkn" else "disc"] = f"{number}/{total}" if total else str(number)
+        elif atom.type in _ILST_TAGS and data_type == 1:
+            tags[_ILST_TAGS[atom.type]] = payload.decode("utf-8", errors="replace")
+    return tags, cover_type
+
+
+def _read_chpl(chpl, duration):
+    """Read Nero-style chapters. Chapter ends aren't stored, so use the next chapter's start."""
+    version, offset = _full_box(chpl)
+    if version:
+        offset += 4
+    count = chpl.buf[offset]
+    offset += 1
+    starts = list()
+    for _ in range(count):
+        start, length = struct.unpack_from(">QB", chpl.buf, offset)
+        title = bytes(chpl.buf[offset + 9:offset + 9 + length]).decode("utf-8", errors="replace")
+        starts.append((start, title))
+        offset += 9 + length
+    timescale = 10000000
+    end_of_file = round(duration * timescale)
+    chapters = list()
+    for i, (start, title) in enumerate(starts):
+        end = starts[i + 1][0] if i + 1 < len(starts) else max(start, end_of_file)
+        chapters.append((start, end, title, timescale))
+    return chapters
+
+
+def _chapter_list(chapters):
+    """Describe chapters the way ffprobe does."""
+    result = list()
+    for i, (start, end, title, timescale) in enumerate(chapters):
+        result.append({
+            "id": i,
+            "time_base": f"1/{timescale}",
+            "start": start,
+            "start_time": _format_time(start, timescale),
+            "end": end,
+            "end_time": _format_time(end, timescale),
+            "tags": {"title": title},
+        })
+    return result
+
+
+def _read_streams(tracks):
+    """Describe each track as an ffprobe stream."""
+    chapter_ids = {track_id for track in tracks for track_id in track.chapter_track_ids}
+    streams = list()
+    for track in tracks:
+        if track.track_id in chapter_ids:
+            codec_type = "data"
+        else:
+            codec_type = _HANDLERS.get(track.handler)
+        if codec_type is None:
+            raise UnsupportedFileError(f"Unknown handler '{track.handler}'")
+        streams.append(track.stream(len(streams), codec_type))
+    return streams
+
+
+def _read_chapters(moov, tracks, duration):
+    """Read chapters. Like ffmpeg, prefer a QuickTime chapter track over Nero chapters."""
+    chapter_ids = {track_id for track in tracks for track_id in track.chapter_track_ids}
+    chapter_tracks = [track for track in tracks if track.track_id in chapter_ids]
+    if chapter_tracks:
+        track = chapter_tracks[0]
+        return [(start, end, title, track.timescale) for start, end, title in track.text_samples()]
+    chpl = moov.child(b"udta", b"chpl")
+    if chpl is not None:
+        return _read_chpl(chpl, duration)
+    return list()
+
+
+def _parse(buf, file):
+    """Parse an MP4 file that has been loaded into buf."""
+    top_level = {box.type: box for box in _iter_boxes(buf, 0, len(buf))}
+    moov, ftyp = top_level.get(b"moov"), top_level.get(b"ftyp")
+    if moov is None or ftyp is None:
+        raise UnsupportedFileError("Missing moov or ftyp")
+    if ftyp.payload[:4] == b"qt  ":
+        raise UnsupportedFileError("QuickTime files store their metadata differently")
+    if moov.child(b"mvex") is not None:
+        raise UnsupportedFileError("Fragmented MP4")
+    mvhd = moov.child(b"mvhd")
+    if mvhd is None:
+        raise UnsupportedFileError("Missing mvhd")
+    movie_timescale, _ = _read_header_duration(mvhd)
+    if movie_timescale == 0:
+        raise UnsupportedFileError("Zero timescale")
+
+    tracks = [_Track(box, movie_timescale) for box in moov.children() if box.type == b"trak"]
+    streams = _read_streams(tracks)
+    duration = max((track.duration for track in tracks), default=0.0)
+
+    # Tags
+    tags = _read_ftyp_tags(ftyp)
+    ilst = moov.child(b"udta", b"meta", b"ilst")
+    if ilst is not None:
+        ilst_tags, cover_type = _read_ilst(ilst)
+        tags.update(ilst_tags)
+        if cover_type is not None:
+            # ffprobe presents cover art as an extra video stream.
+            streams.append({
+                "index": len(streams),
+                "codec_type": "video",
+                "codec_name": {13: "mjpeg", 14: "png", 27: "bmp"}.get(cover_type),
+                "disposition": {"attached_pic": 1},
+            })
+
+    return {
+        "streams": streams,
+        "chapters": _chapter_list(_read_chapters(moov, tracks, duration)),
+        "format": {
+            "filename": str(file),
+            "nb_streams": len(streams),
+            "format_name": "mov,mp4,m4a,3gp,3g2,mj2",
+            "start_time": "0.000000",
+            "duration": f"{duration:f}",
+            "size": str(len(buf)),
+            "tags": tags,
+        }
+    }
+
+
+def read_mp4(file):
+    """Read an MP4 file's streams, tags, and chapters, laid out the same way as ffprobe's JSON output.
+
+    :param file: Path to the file to read.
+    :return: A dictionary matching ffprobe's output, or None if the file couldn't be understood.
+    """
+    try:
+        with open(file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _parse(buf, file)
+    except (OSError, ValueError, BufferError, struct.error, IndexError, UnsupportedFileError):
+        return None
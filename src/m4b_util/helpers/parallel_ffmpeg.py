@@ -1,149 +1,718 @@
 """Handle processsing audio files in parallel."""
+import argparse
+import concurrent.futures
+from dataclasses import dataclass
+import heapq
+import math
 import multiprocessing as mp
 import os
+from pathlib import Path
 import queue
+import threading
+import time
 
-from rich.progress import Progress, SpinnerColumn
+from . import child_processes, governor
+from .ffprogress import FFmpegCancelledError, FFmpegTimeoutError, FFProgress
+from .progress import make_progress
 
-from .ffprogress import FFProgress
+# How often, in seconds, to read the progress board and redraw. News of jobs starting and finishing arrives as soon as
+# it is sent, whatever this is set to.
+PROGRESS_REFRESH = 0.25
+
+# Statuses that mean a job is done, one way or another.
+FINAL_STATUSES = ("finished", "failed", "timed out", "cancelled")
+
+# Ways to run the workers. Each one only waits on ffmpeg, so threads are plenty, but separate processes are still
+# available in case a job ever needs to do real work in Python.
+EXECUTORS = ("thread", "process")
+
+# Where to look for cgroup CPU limits.
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+# Where to read how busy the CPUs are.
+PROC_STAT = Path("/proc/stat")
+
+# How often, in seconds, adaptive concurrency measures throughput and decides how many jobs to run.
+ADAPT_INTERVAL = 5.0
+
+# How much, as a fraction, an extra job has to raise throughput by for adaptive concurrency to keep it.
+ADAPT_GAIN = 0.05
+
+# How much adaptive concurrency cuts back by when an extra job doesn't pay off.
+ADAPT_BACKOFF = 0.75
+
+# How busy the CPUs may be, as a fraction, before adaptive concurrency stops adding jobs.
+ADAPT_CPU_LIMIT = 0.9
+
+
+def _cgroup_cpu_limit():
+    """Find how many CPUs' worth of time our cgroup is allowed, if it is limited at all.
+
+    :return: The limit, rounded up to a whole number of CPUs, or None if there isn't one.
+    """
+    try:
+        # cgroup v2 puts the quota and period together, e.g. "200000 100000", or "max 100000" for no limit.
+        quota, period = (CGROUP_ROOT / "cpu.max").read_text().split()[:2]
+        if quota == "max":
+            return None
+    except (OSError, ValueError):
+        try:
+            # cgroup v1 has them in separate files, with a quota of -1 for no limit.
+            quota = (CGROUP_ROOT / "cpu" / "cpu.cfs_quota_us").read_text().strip()
+            period = (CGROUP_ROOT / "cpu" / "cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return None
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return max(1, math.ceil(quota / period))
+
+
+def available_cpus():
+    """Count the CPUs we can actually use, taking CPU affinity, cgroup quotas, and the governor's CPU list into account.
+
+    os.cpu_count() counts every CPU on the machine, even in a container that is only allowed a couple of them.
+    """
+    try:
+        cpus = len(governor.get_limits().cpus or os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover - Not every platform has sched_getaffinity.
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(1, cpus)
+
+
+def positive_int(value):
+    """Read a whole number of at least one, for argparse options like --jobs.
+
+    :raises argparse.ArgumentTypeError: If value isn't a whole number, or is less than one.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a whole number, not '{value}'.") from None
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"Must be at least 1, not {number}.")
+    return number
+
+
+def plan_jobs(jobs=None, threads_per_job=None):
+    """Split the available CPUs between parallel ffmpeg jobs and the threads each one may use.
+
+    Since every job writes a file, there are never more jobs than the governor's max_writers. The CPUs are shared out
+    between the jobs that can actually run instead.
+
+    :param jobs: How many ffmpeg processes to run at once. By default, as many as fit in the CPU budget.
+    :param threads_per_job: How many threads each ffmpeg may use. By default, an even share of the CPUs.
+    :raises ValueError: If jobs or threads_per_job is less than one.
+    :return: A tuple of (jobs, threads_per_job).
+    """
+    for name, value in (("jobs", jobs), ("threads per job", threads_per_job)):
+        if value is not None and value < 1:
+            raise ValueError(f"Need at least 1 for {name}, not {value}.")
+    cpus = available_cpus()
+    if not jobs:
+        jobs = max(1, cpus // threads_per_job) if threads_per_job else cpus
+    max_writers = governor.get_limits().max_writers
+    if max_writers:
+        jobs = min(jobs, max_writers)
+    if not threads_per_job:
+        threads_per_job = max(1, cpus // jobs)
+    return jobs, threads_per_job
+
+
+class CpuMeter:
+    """Measures how busy the CPUs have been between one reading and the next."""
+
+    def __init__(self):
+        """Take a first reading."""
+        self._last = self._times()
+
+    @staticmethod
+    def _times():
+        """Read how much CPU time has gone by, as a tuple of (busy, total), or None if we can't tell."""
+        try:
+            fields = [int(field) for field in PROC_STAT.read_text().splitlines()[0].split()[1:]]
+        except (OSError, ValueError, IndexError):
+            return None
+        total = sum(fields)
+        idle = sum(fields[3:5])  # Idle, and waiting on I/O.
+        return total - idle, total
+
+    def busy(self):
+        """How busy the CPUs have been since the last reading, from 0 to 1, or None if we can't tell."""
+        now, last = self._times(), self._last
+        self._last = now
+        if now is None or last is None or now[1] <= last[1]:
+            return None
+        return (now[0] - last[0]) / (now[1] - last[1])
+
+
+class AdaptiveConcurrency:
+    """Finds how many jobs to run at once, by watching total throughput.
+
+    This is AIMD, as used for network congestion control. For as long as each extra job raises throughput by at least
+    ADAPT_GAIN, and the CPUs have room to spare, add another. As soon as one doesn't pay off, cut back by
+    ADAPT_BACKOFF, and start climbing again from there.
+    """
+
+    def __init__(self, ceiling, start=None):
+        """Start somewhere in the middle.
+
+        :param ceiling: The most jobs to ever run at once.
+        :param start: How many jobs to start with. Defaults to half the ceiling.
+        """
+        self.ceiling = max(1, ceiling)
+        self.limit = min(self.ceiling, start or max(1, self.ceiling // 2))
+        self._previous = None
+        self._samples = dict()
+
+    def update(self, throughput, cpu_busy=None):
+        """Take a new measurement, and decide how many jobs to run until the next one.
+
+        :param throughput: How much work got done, per second, while running limit jobs.
+        :param cpu_busy: How busy the CPUs were, from 0 to 1, if we know.
+        :return: The new limit.
+        """
+        self._samples.setdefault(self.limit, list()).append(throughput)
+        previous, self._previous = self._previous, (self.limit, throughput)
+        if previous and self.limit > previous[0] and throughput < previous[1] * (1 + ADAPT_GAIN):
+            self.limit = max(1, min(self.limit - 1, int(self.limit * ADAPT_BACKOFF)))
+        elif cpu_busy is None or cpu_busy < ADAPT_CPU_LIMIT:
+            self.limit = min(self.ceiling, self.limit + 1)
+        return self.limit
+
+    @property
+    def settled(self):
+        """The number of jobs that gave the best throughput on average, not counting extra jobs that didn't pay off."""
+        best, best_throughput = self.limit, None
+        for limit in sorted(self._samples):
+            throughput = sum(self._samples[limit]) / len(self._samples[limit])
+            if best_throughput is None or throughput >= best_throughput * (1 + ADAPT_GAIN):
+                best, best_throughput = limit, throughput
+        return best
+
+
+def task_costs(tasks):
+    """Get the cost of each task, for scheduling and progress.
+
+    A task's cost is its 'cost' key, usually the length of audio it will write, in seconds. Tasks without one are
+    assumed to cost as much as the average task that has one, or 1 if none do.
+
+    :param tasks: A list of task dictionaries, as given to ParallelFFmpeg.process.
+    :return: A list of costs, in the same order as tasks.
+    """
+    known = [task["cost"] for task in tasks if task.get("cost") is not None]
+    default = sum(known) / len(known) if known else 1
+    costs = [task.get("cost") for task in tasks]
+    return [max(default if cost is None else cost, 0) for cost in costs]
+
+
+class ProgressBoard:
+    """Where workers post the progress of their jobs, for the coordinator to read at its own pace.
+
+    Each worker has one slot, holding the job it is running (0 when idle), how far along it is, and ffmpeg's speed.
+    Posting costs a worker a few stores in shared memory, however often ffmpeg reports, and the coordinator only looks
+    every PROGRESS_REFRESH seconds.
+    """
+
+    def __init__(self, slots, shared=False):
+        """Set up an empty board.
+
+        :param slots: How many workers will post to it.
+        :param shared: Put the board in shared memory, so worker processes can post to it.
+        """
+        self._values = mp.Array("d", slots * 3, lock=False) if shared else [0.0] * (slots * 3)
+
+    def post(self, slot, job_id, percent, speed=None):
+        """Post the progress of a worker's job.
+
+        :param slot: The worker's slot.
+        :param job_id: The job it is running.
+        :param percent: How far along the job is.
+        :param speed: ffmpeg's speed, if it has said.
+        """
+        i = slot * 3
+        if self._values[i] != job_id:  # Clear the slot first, so nobody reads this job with the last one's progress.
+            self._values[i] = 0
+        self._values[i + 1] = percent
+        self._values[i + 2] = math.nan if speed is None else speed
+        self._values[i] = job_id
+
+    def clear(self, slot=None):
+        """Mark a worker as idle, or every worker if no slot is given."""
+        slots = range(len(self._values) // 3) if slot is None else [slot]
+        for i in slots:
+            self._values[i * 3] = 0
+
+    def read(self):
+        """Yield (job_id, percent, speed) for every job that has posted its progress.
+
+        A slot that changed hands while we were reading it is skipped, to be picked up next time.
+        """
+        for i in range(0, len(self._values), 3):
+            job_id, percent, speed = self._values[i:i + 3]
+            if job_id and self._values[i] == job_id:
+                yield int(job_id), percent, None if math.isnan(speed) else speed
+
+
+@dataclass
+class TaskResult:
+    """How a single task went."""
+
+    name: str
+    status: str = "pending"  # One of FINAL_STATUSES, once the task is done.
+    returncode: int = None  # ffmpeg's exit code, if it got far enough to have one.
+    log_tail: str = None  # The last lines ffmpeg wrote to stderr, or why it couldn't be run.
+    elapsed: float = 0.0  # Seconds spent on the task, including any retries.
+    retries: int = 0  # How many times the watchdog had to restart it.
+
+    @property
+    def ok(self):
+        """Whether the task finished successfully."""
+        return self.status == "finished"
 
 
 class ParallelFFmpeg:
-    """Process audio files in parallel."""
+    """Process audio files in parallel.
+
+    Either hand process() a whole list of tasks, or keep the pool open and submit() them one at a time, collecting
+    results as they finish with as_completed(). Workers are started as they are needed, and stopped by shutdown(), or
+    on leaving a with block.
+    """
 
-    def __init__(self, purpose):
+    def __init__(self, purpose, watchdog=None, jobs=None, threads_per_job=None, executor="thread", fail_fast=False,
+                 adaptive=False):
         """Initialize everything.
 
         :param purpose: Description of overall purpose. Printed in front of the overall progress bar.
+        :param watchdog: A Watchdog, to kill and retry jobs that take too long or stop making progress.
+        :param jobs: How many ffmpeg processes to run at once. Defaults to the number of CPUs we may use, divided by
+                     threads_per_job.
+        :param threads_per_job: How many threads each ffmpeg should use. Defaults to an even share of the CPUs. Pass
+                                it on to ffmpeg by adding threads_args to each command.
+        :param executor: Run the workers as threads ('thread'), or as separate Python processes ('process').
+        :param fail_fast: As soon as one task fails, kill the running ones and skip the rest, including any submitted
+                          later, until the pool is shut down.
+        :param adaptive: Work out how many jobs to run at once while running them, up to jobs, by watching how fast the
+                         audio gets processed. See AdaptiveConcurrency. What it settled on is reported on shutdown.
+        :raises ValueError: If the executor isn't one of EXECUTORS.
         """
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor '{executor}'. Choose from: {', '.join(EXECUTORS)}")
         # Store our parameters
         self._purpose = purpose
+        self._watchdog = watchdog
+        self.jobs, self.threads_per_job = plan_jobs(jobs, threads_per_job)
+        self.executor = executor
+        self.fail_fast = fail_fast
+        self.adaptive = AdaptiveConcurrency(self.jobs) if adaptive else None
+        self._limit = self.adaptive.limit if adaptive else self.jobs
+        self._cpu_meter = CpuMeter() if adaptive else None
+        self._last_adapt = None
 
-        # Set up our member variables
-        num_cores = os.cpu_count()
-        self._input_q = mp.Queue(maxsize=num_cores)
-        self._status_q = mp.Queue(maxsize=100)
+        # Set up our member variables. Jobs are held back in _pending until a worker is free, so the input queue never
+        # has more than one job per worker in it.
+        # Threads can share plain queues, which saves pickling everything that goes through them.
+        queue_type = mp.Queue if executor == "process" else queue.Queue
+        self._input_q = queue_type()
+        self._status_q = queue_type(maxsize=100)
+        self._cancel = mp.Event() if executor == "process" else threading.Event()
+        self._board = ProgressBoard(self.jobs, shared=executor == "process")
+        self._lock = threading.RLock()  # Guards the pool state, which both the caller and the coordinator change.
         self._tasklist = list()
+        self._pending = list()  # A heap of (-cost, job_id), so the most costly job comes off first.
+        self._in_flight = 0
+        self._workers = list()
+        self._coordinator = None
+        self._closing = False
+        self._total_cost = 0
+        self._done_cost = 0
         self.temp_files = list()
 
         # Progress Tracker
-        self.progress = Progress(SpinnerColumn(), *Progress.get_default_columns())
+        self.progress = make_progress()
 
-    def _read_status_queue(self):
-        """Read info from the status queue and update the display."""
+    @property
+    def threads_args(self):
+        """The ffmpeg arguments that keep a job within its share of the CPUs."""
+        return ["-threads", str(self.threads_per_job)]
+
+    def _read_status_queue(self, timeout=None):
+        """Read info from the status queue and update the display.
+
+        :param timeout: How long to wait for something to arrive, in seconds. By default, don't wait at all.
+        :return: The status that was read, or None if there wasn't one.
+        """
         try:
-            master_task = self._tasklist[0]["task_id"]
-            (job_id, job_status) = self._status_q.get_nowait()
+            if timeout is None:
+                (job_id, job_status, *details) = self._status_q.get_nowait()
+            else:
+                (job_id, job_status, *details) = self._status_q.get(timeout=timeout)
+            if job_id is None:  # Just a wake-up call.
+                return job_status
             task_name = self._tasklist[job_id]["name"]
             if job_status == "started":
                 self._tasklist[job_id]["task_id"] = self.progress.add_task(
                     f"[dark_cyan]|- Processing '[white]{task_name}[/]'.",
                     total=100
                 )
-            elif job_status == "finished":
-                self.progress.update(self._tasklist[job_id]["task_id"], completed=100, visible=False)
-                self.progress.update(master_task, advance=1)
-            elif job_status == "failed":
-                name = self._tasklist[job_id]["name"]
-                self.progress.console.print(f"[red]Error:[/] Failed to process {name}")
-                self.progress.update(self._tasklist[job_id]["task_id"], visible=False)
-                self.progress.update(master_task, advance=1)
-            else:  # No matching text means it is an update on percentage.
-                self.progress.update(self._tasklist[job_id]["task_id"], completed=job_status)
+            elif job_status == "retrying":
+                retries = self._tasklist[job_id]["retries"] = self._tasklist[job_id].get("retries", 0) + 1
+                self.progress.update(self._tasklist[job_id]["task_id"], completed=0,
+                                     description=f"[dark_cyan]|- Processing '[white]{task_name}[/]' (retry {retries}).")
+            elif job_status in FINAL_STATUSES:
+                with self._lock:
+                    self._job_done(job_id, job_status, details[0] if details else dict())
+                    self._in_flight -= 1
+                    self._dispatch()
+            else:  # No matching text means it is an update on percentage, and ffmpeg's speed, from a worker without a board.
+                (percent, speed) = job_status
+                self.progress.update(self._tasklist[job_id]["task_id"], completed=percent, speed=speed)
+                self._update_master(job_id, percent)
         except queue.Empty:
-            pass  # We don't actually care if the finished queue is empty
+            return None  # We don't actually care if the finished queue is empty
+        return job_status
 
-    def _insert_into_input_q(self, args):
-        while True:
-            # Check the status
-            self._read_status_queue()
-            # See if there is space in the queue
-            try:
-                self._input_q.put_nowait(args)
-                break  # No need to keep looping once we have successfully written the queue
-            except queue.Full:
-                pass  # We will just try again.
+    def _job_done(self, job_id, job_status, details):
+        """Record how a job ended, tell the user about it, and take it off the display.
+
+        :param job_id: The job's index in the task list.
+        :param job_status: One of FINAL_STATUSES.
+        :param details: The other TaskResult fields, as sent by the worker.
+        """
+        job = self._tasklist[job_id]
+        job["result"] = TaskResult(job["name"], job_status, retries=job.get("retries", 0), **details)
+        future = job.get("future")
+        if future is not None and not future.cancelled():
+            future.set_result(job["result"])
+        if job_status == "finished":
+            if job.get("retries"):
+                self.progress.console.print(f"[bold yellow]Warning:[/] Processed {job['name']}{self._retry_note(job_id)}")
+            self.progress.update(job["task_id"], completed=100, visible=False)
+        else:
+            if job_status != "cancelled":
+                reason = "Timed out processing" if job_status == "timed out" else "Failed to process"
+                self.progress.console.print(f"[red]Error:[/] {reason} {job['name']}{self._retry_note(job_id)}")
+                if self.fail_fast:
+                    self._cancel.set()
+            if job["task_id"] is not None:  # Jobs cancelled before they started never got a progress bar.
+                self.progress.update(job["task_id"], visible=False)
+        self._update_master(job_id, 100)
+
+    def _read_board(self):
+        """Update the display with the progress the workers have posted to the board."""
+        with self._lock:
+            for job_id, percent, speed in self._board.read():
+                job = self._tasklist[job_id]
+                if job["task_id"] is None or job["result"].status != "pending":
+                    continue  # News of it starting hasn't reached us yet, or it has already finished.
+                self.progress.update(job["task_id"], completed=percent, speed=speed)
+                self._update_master(job_id, percent)
+
+    def _update_master(self, job_id, percent):
+        """Move the overall progress bar along by however much of a job's cost has been done since we last looked."""
+        job = self._tasklist[job_id]
+        done = job.get("cost", 1) * min(percent, 100) / 100
+        self._done_cost += done - job.get("done", 0)
+        job["done"] = done
+        self.progress.update(self._tasklist[0]["task_id"], completed=self._done_cost)
+
+    def _retry_note(self, job_id):
+        """Describe how many times a job was retried, for its final status."""
+        retries = self._tasklist[job_id].get("retries", 0)
+        if not retries:
+            return ""
+        return f" after {retries} {'retry' if retries == 1 else 'retries'}"
+
+    @staticmethod
+    def _job_details(ff, started, error=None):
+        """Gather what a worker knows about how a job went, to send back with its final status."""
+        return {
+            "returncode": ff.returncode,
+            "log_tail": ff.output or (str(error) if error else None),
+            "elapsed": round(time.monotonic() - started, 3),
+        }
+
+    @staticmethod
+    def _progress_reporter(status_q, board, slot, job_id):
+        """Make a function that passes a job's percent and speed on to the board, or the status queue without one."""
+        if board is None:
+            return lambda percent, speed: status_q.put((job_id, (percent, speed)))
+        return lambda percent, speed: board.post(slot, job_id, percent, speed)
+
+    @staticmethod
+    def _process_worker(limits, writer_slots, *args):
+        """Run _ffmpeg_job in a worker process, under our limits, making sure that being terminated stops its ffmpeg too."""
+        child_processes.install()
+        governor.configure(limits, writer_slots)
+        ParallelFFmpeg._ffmpeg_job(*args)
 
     @staticmethod
-    def _ffmpeg_job(q, status_q):
-        """Multiprocessing worker that runs an ffmpeg command."""
+    def _ffmpeg_job(q, status_q, watchdog=None, cancel=None, board=None, slot=0):
+        """Worker thread or process that runs ffmpeg commands until it is told to stop.
+
+        Jobs starting and finishing are reported on the status queue. Their progress is posted to the board, in the
+        worker's own slot, or sent on the status queue too if there is no board.
+
+        Once cancel is set, the running ffmpeg is killed, and every job left in the queue is reported as cancelled.
+        """
         while True:
             args = q.get()
             if args is None:
                 break
 
             (job_id, cmd) = args
+            if cancel is not None and cancel.is_set():
+                status_q.put((job_id, "cancelled", dict()))
+                continue
 
             # Let the outside world know we started
             status_q.put((job_id, "started"))
+            started = time.monotonic()
 
+            ff = FFProgress(cmd, watchdog=watchdog, cancel=cancel,
+                            on_retry=lambda retry, error, job_id=job_id: status_q.put((job_id, "retrying")))
+            report = ParallelFFmpeg._progress_reporter(status_q, board, slot, job_id)
+            error = None
             try:
-                ff = FFProgress(cmd)
                 for percent in ff.run():
-                    status_q.put((job_id, percent))
-                status_q.put((job_id, "finished"))
+                    report(percent, ff.last_event and ff.last_event.speed)
+                job_status = "finished"
+            except FFmpegTimeoutError as e:
+                job_status, error = "timed out", e
+            except FFmpegCancelledError as e:
+                job_status, error = "cancelled", e
             # Since we need these workers to stay up until we close them, we will catch all but the most
             # dire exceptions.
             except Exception as e:  # noqa: See comment above.
-                status_q.put((job_id, "failed"))
-                continue
+                job_status, error = "failed", e
+            if board is not None:
+                board.clear(slot)
+            status_q.put((job_id, job_status, ParallelFFmpeg._job_details(ff, started, error)))
 
-    def process(self, tasks):
-        """Use multiprocessing to run all ffmpeg commands.
+    def _start(self):
+        """Start the progress display and the coordinator, unless they are already running."""
+        if self._coordinator is not None:
+            return
+        self.progress.start()
+        self._tasklist = [{
+            "name": "Master",
+            "task_id": None  # Added along with the first tasks, so it starts out with the right total.
+        }]
+        self._pending = list()
+        self._in_flight = 0
+        self._total_cost = 0
+        self._done_cost = 0
+        self._closing = False
+        self._cancel.clear()
+        self._board.clear()
+        self._last_adapt = None
+        self._coordinator = threading.Thread(target=self._coordinate, daemon=True)
+        self._coordinator.start()
 
-        :param tasks: A list of dictionaries with two keys: 'name' and 'command'. Name will be printed by the progress
-                      tracker while command is being run.
+    def _start_worker(self):
+        """Add another worker to the pool."""
+        args = (self._input_q, self._status_q, self._watchdog, self._cancel, self._board, len(self._workers))
+        if self.executor == "process":
+            limits = (governor.get_limits(), governor.get_writer_slots())
+            worker = mp.Process(target=self._process_worker, args=(*limits, *args), daemon=True)
+        else:
+            worker = threading.Thread(target=self._ffmpeg_job, args=args, daemon=True)
+        worker.start()
+        self._workers.append(worker)
+
+    def _dispatch(self):
+        """Hand the most costly waiting jobs to the workers, for as long as there are workers free.
+
+        Once the pool has been cancelled, waiting jobs are marked as cancelled instead.
         """
-        # Make sure we have tasks
-        if len(tasks) == 0:
-            return None
+        with self._lock:
+            while self._pending and (self._in_flight < self._limit or self._cancel.is_set()):
+                _, job_id = heapq.heappop(self._pending)
+                job = self._tasklist[job_id]
+                if self._cancel.is_set() or not job["future"].set_running_or_notify_cancel():
+                    self._job_done(job_id, "cancelled", dict())
+                    continue
+                self._in_flight += 1
+                if len(self._workers) < self._in_flight:
+                    self._start_worker()
+                self._input_q.put((job_id, job["command"]))
 
-        # Start up our progress tracker
-        self.progress.start()
+    def _coordinate(self):
+        """Keep the display and the futures up to date until the pool is shut down, and every job is done.
+
+        The coordinator sleeps while waiting on the workers, and only reads their progress every PROGRESS_REFRESH
+        seconds, so it uses next to no CPU of its own, however many workers there are.
+        """
+        next_refresh = time.monotonic() + PROGRESS_REFRESH
+        while not (self._closing and not self._pending and not self._in_flight):
+            job_status = self._read_status_queue(timeout=max(next_refresh - time.monotonic(), 0))
+            if time.monotonic() >= next_refresh:
+                self._read_board()
+                self._adapt()
+                next_refresh = time.monotonic() + PROGRESS_REFRESH
+            if job_status is None and self._in_flight and not any(worker.is_alive() for worker in self._workers):
+                self._abandon()  # nocover: Only happens if something outside kills our workers.
+                break
 
-        # Set up our processing pool
-        num_cores = os.cpu_count()
-        pool = mp.Pool(num_cores, initializer=self._ffmpeg_job, initargs=(self._input_q, self._status_q))
+    def _adapt(self):
+        """Every ADAPT_INTERVAL seconds, let adaptive concurrency decide how many jobs to run.
 
-        master_task = self.progress.add_task(
-            f"[cyan]{self._purpose}",
-            total=len(tasks)
-        )
-        self._tasklist.append({
-            "name": "Master",
-            "task_id": master_task
-        })
-
-        for task in tasks:
-            # Mark a new task as beginning.
-            self._tasklist.append({
-                "name": task.get("name", "unknown"),
-                "task_id": None
-            })
-            job_id = len(self._tasklist) - 1
-
-            # Send the info to our workers
-            args = (job_id, task["command"])
-            self._insert_into_input_q(args)
-
-        # Tell the workers we are all done
-        for _ in range(num_cores):
-            self._insert_into_input_q(None)
-        pool.close()
-
-        # Wait for all the jobs to finish
-        while not (self._input_q.empty() and self._status_q.empty()):
-            self._read_status_queue()
-        pool.join()
+        Throughput is how many seconds of audio got processed per second, across all the jobs. That is the same as
+        adding up ffmpeg's speeds, but measured over the interval, rather than since each job started.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.adaptive is None:
+                return
+            if self._last_adapt is None or not self._pending or self._in_flight != self._limit:
+                # Only measure while exactly limit jobs are running. With fewer, we would be measuring a lack of work.
+                # With more, after a backoff, the throughput would belong to the old limit, not the new one.
+                self._last_adapt = (now, self._done_cost)
+                return
+            last_time, last_done = self._last_adapt
+            if now - last_time < ADAPT_INTERVAL:
+                return
+            self._last_adapt = (now, self._done_cost)
+            self._limit = self.adaptive.update((self._done_cost - last_done) / (now - last_time), self._cpu_meter.busy())
+            self._dispatch()
+
+    def _abandon(self):
+        """Give up on every job that hasn't finished yet."""
+        with self._lock:
+            self._pending = list()
+            self._in_flight = 0
+            for job_id, job in enumerate(self._tasklist[1:], start=1):
+                if job["result"].status == "pending":
+                    self._job_done(job_id, "failed", {"log_tail": "The worker running this job died."})
+
+    def submit(self, name, cmd, cost=None):
+        """Queue up a single ffmpeg command, to be run as soon as there is a worker free.
+
+        :param name: Printed by the progress tracker while the command is being run.
+        :param cmd: The ffmpeg command, as a list.
+        :param cost: How expensive the command is, such as the length of audio it will write, in seconds. Defaults to
+                     the average of the tasks submitted so far. Of the tasks waiting for a worker, the most costly go
+                     first.
+        :return: A Future, which will be given the command's TaskResult. It can be cancelled until the command starts.
+        """
+        return self.submit_many([{"name": name, "command": cmd, "cost": cost}])[0]
+
+    def submit_many(self, tasks):
+        """Queue up several ffmpeg commands at once, so that the most costly of them are started first.
+
+        :param tasks: A list of dictionaries with two keys: 'name' and 'command', and optionally 'cost', as for
+                      submit().
+        :return: A list of Futures, in the same order as tasks.
+        """
+        with self._lock:
+            self._start()
+            known = self._tasklist[1:]
+            costs = task_costs(known + list(tasks))[len(known):]
+            futures = list()
+            for task, cost in zip(tasks, costs):
+                name = task.get("name", "unknown")
+                future = concurrent.futures.Future()
+                self._tasklist.append({
+                    "name": name,
+                    "task_id": None,
+                    "command": task["command"],
+                    "cost": cost,
+                    "result": TaskResult(name),
+                    "future": future
+                })
+                heapq.heappush(self._pending, (-cost, len(self._tasklist) - 1))
+                futures.append(future)
+            self._total_cost += sum(costs)
+            if self._tasklist[0]["task_id"] is None:
+                self._tasklist[0]["task_id"] = self.progress.add_task(f"[cyan]{self._purpose}", total=self._total_cost)
+            else:
+                self.progress.update(self._tasklist[0]["task_id"], total=self._total_cost)
+            self._dispatch()
+        return futures
+
+    def as_completed(self, futures=None, timeout=None):
+        """Iterate over futures as their commands finish, whatever order they were submitted in.
+
+        :param futures: The futures to wait on. Defaults to every one submitted since the pool was started.
+        :param timeout: The most seconds to wait, as for concurrent.futures.as_completed.
+        """
+        if futures is None:
+            with self._lock:
+                futures = [job["future"] for job in self._tasklist[1:]]
+        return concurrent.futures.as_completed(futures, timeout)
+
+    def cancel(self):
+        """Kill every running command, and skip every waiting one, including any submitted later.
+
+        Their futures are given TaskResults with a status of 'cancelled'. The pool stays cancelled until it is shut
+        down.
+        """
+        self._cancel.set()
+        self._dispatch()
+
+    def shutdown(self):
+        """Wait for every submitted command to finish, then stop the workers and the progress display.
+
+        The pool can be used again afterwards, and will start afresh.
+        """
+        if self._coordinator is None:
+            return
+        with self._lock:
+            self._closing = True
+        self._status_q.put((None, "closing"))  # Wake up the coordinator, in case it has nothing left to wait on.
+        self._coordinator.join()
+        for _ in self._workers:
+            self._input_q.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = list()
+        self._coordinator = None
 
         # Make sure the master task shows as completed
-        # Yes, we need to doublecheck the status_q again, because the process of verifying the status_q is empty
-        # and joining the pool is not atomic.
-        while not self._status_q.empty():
-            self._read_status_queue()  # nocover: This is just a timing thing, and can't be tested reliably.
-        self.progress.update(master_task, completed=len(tasks))
+        self.progress.update(self._tasklist[0]["task_id"], completed=self._total_cost)
+
+        cancelled = sum(job["result"].status == "cancelled" for job in self._tasklist[1:])
+        if cancelled and self._cancel.is_set():
+            self.progress.console.print(f"[bold yellow]Warning:[/] Cancelled {cancelled} job(s).")
+        if self.adaptive is not None:
+            self.progress.console.print(f"[yellow]Info:[/] Adaptive concurrency settled on {self.adaptive.settled} "
+                                        "job(s) at a time.")
 
         # Shut down the progress tracker
         self.progress.stop()
 
-        return True
+    def __enter__(self):
+        """Use the pool in a with block, so it is always shut down."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Shut down the pool. If we're leaving because of an error, or an interrupt, cancel what's left first."""
+        if exc_type is not None:
+            self.cancel()
+        self.shutdown()
+
+    def process(self, tasks):
+        """Run all ffmpeg commands, a few at a time, on worker threads or processes, and wait for them to finish.
+
+        Jobs are started longest first, by cost, so that one long job doesn't end up running on its own after all the
+        others are done. The overall progress bar is weighted by cost, too. With fail_fast, the first failure cancels
+        everything that hasn't finished yet.
+
+        :param tasks: A list of dictionaries with two keys: 'name' and 'command'. Name will be printed by the progress
+                      tracker while command is being run. They may also have a 'cost', such as the length of audio the
+                      command will write, in seconds. See task_costs().
+        :return: A TaskResult for each task, in the same order as tasks. None if there were no tasks.
+        """
+        # Make sure we have tasks
+        if len(tasks) == 0:
+            return None
+
+        with self:
+            futures = self.submit_many(tasks)
+        return [future.result() for future in futures]
@@ -0,0 +1,190 @@
+"""Persistent, on-disk cache of ffprobe results."""
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+# Default upper bound on the amount of probe output kept on disk.
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+# Bump this whenever the table layout, or what the probe profiles ask for, changes. Old caches are simply dropped.
+_SCHEMA_VERSION = 3
+
+# Process-wide cache, created on first use.
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def default_cache_dir():
+    """Find the directory the probe cache should live in.
+
+    Honors M4B_UTIL_CACHE_DIR, then the platform's usual per-user cache location.
+    """
+    if os.environ.get("M4B_UTIL_CACHE_DIR"):
+        return Path(os.environ["M4B_UTIL_CACHE_DIR"])
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "m4b-util"
+
+
+def get_cache():
+    """Get the shared probe cache, or None if caching has been turned off with M4B_UTIL_PROBE_CACHE=0."""
+    global _shared_cache
+    if os.environ.get("M4B_UTIL_PROBE_CACHE", "1").lower() in ("0", "false", "no", "off"):
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ProbeCache(default_cache_dir() / "probe_cache.sqlite")
+    return _shared_cache
+
+
+class ProbeCache:
+    """Store ffprobe output, keyed by a file's path, size, modification time, inode, and the probe profile used.
+
+    Entries are evicted least-recently-used first once the total stored output grows past max_bytes. Any problem with
+    the database (read-only home dir, corrupt file, etc.) silently disables the cache, since it is only an
+    optimization.
+    """
+
+    def __init__(self, db_path, max_bytes=DEFAULT_MAX_BYTES):
+        """Open (or create) the cache database.
+
+        :param db_path: Location of the sqlite database.
+        :param max_bytes: Upper bound on the total size of cached probe output.
+        """
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        try:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path), timeout=5, check_same_thread=False)
+            self._init_schema()
+        except (OSError, sqlite3.Error):
+            self._disable()
+
+    def _init_schema(self):
+        """Create the table, throwing away any cache written with a different layout."""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != _SCHEMA_VERSION:
+            self._conn.execute("DROP TABLE IF EXISTS probes")
+            self._conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            " path TEXT NOT NULL,"
+            " profile TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " inode INTEGER NOT NULL,"
+            " output TEXT NOT NULL,"
+            " nbytes INTEGER NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (path, profile))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS probes_last_used ON probes (last_used)")
+        self._conn.commit()
+
+    def _disable(self):
+        """Stop using the database."""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:  # pragma: no cover - Nothing more we can do.
+                pass
+        self._conn = None
+
+    @property
+    def enabled(self):
+        """Whether the cache is usable."""
+        return self._conn is not None
+
+    @staticmethod
+    def _key(file):
+        """Generate the lookup key for a file, or None if it can't be stat'd."""
+        path = os.path.abspath(os.fspath(file))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return path, stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, file, profile="full"):
+        """Look up the cached ffprobe output for a file.
+
+        :param file: Path to the probed file.
+        :param profile: The probe profile the output was gathered with.
+        :return: The cached output text, or None if there isn't a current entry.
+        """
+        key = self._key(file)
+        if key is None or not self.enabled:
+            return None
+        path, size, mtime_ns, inode = key
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT output FROM probes"
+                    " WHERE path = ? AND profile = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                    (path, profile, size, mtime_ns, inode)
+                ).fetchone()
+                if row is None:
+                    return None
+                self._conn.execute("UPDATE probes SET last_used = ? WHERE path = ? AND profile = ?",
+                                   (time.time(), path, profile))
+                self._conn.commit()
+            except sqlite3.Error:
+                self._disable()
+                return None
+        return row[0]
+
+    def put(self, file, output, profile="full"):
+        """Store the ffprobe output for a file, replacing any older entry for the same path and profile.
+
+        :param file: Path to the probed file.
+        :param output: ffprobe's output text.
+        :param profile: The probe profile the output was gathered with.
+        """
+        key = self._key(file)
+        if key is None or not self.enabled:
+            return
+        nbytes = len(output.encode("utf-8"))
+        if nbytes > self.max_bytes:
+            return  # It would just evict everything, including itself.
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO probes (path, profile, size, mtime_ns, inode, output, nbytes, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key[0], profile, *key[1:], output, nbytes, time.time())
+                )
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error:
+                self._disable()
+
+    def _evict(self):
+        """Drop least-recently-used entries until we are under our size cap. Caller must hold the lock."""
+        total = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM probes").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = list()
+        for path, profile, nbytes in self._conn.execute(
+                "SELECT path, profile, nbytes FROM probes ORDER BY last_used ASC"):
+            if total <= self.max_bytes:
+                break
+            stale.append((path, profile))
+            total -= nbytes
+        self._conn.executemany("DELETE FROM probes WHERE path = ? AND profile = ?", stale)
+
+    def clear(self):
+        """Remove all entries."""
+        if not self.enabled:
+            return
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM probes")
+                self._conn.commit()
+            except sqlite3.Error:
+                self._disable()
@@ -0,0 +1,220 @@
+"""Progress reporting, as rich widgets, machine-readable JSON lines, or not at all.
+
+Every progress bar and status message goes through make_progress() and make_status(), so that one setting (the
+global --progress option, or M4B_UTIL_PROGRESS) decides how they are shown:
+
+- rich: Draw progress bars and spinners on the console.
+- jsonl: Write throttled JSON events to stderr, one per line, for another program to read.
+- none: Show nothing but messages.
+"""
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from rich.console import Console
+from rich.progress import Progress, SpinnerColumn
+from rich.status import Status
+from rich.text import Text
+
+PROGRESS_MODES = ("rich", "jsonl", "none")
+
+# The shortest time, in seconds, between two jsonl progress events for the same task.
+JSONL_INTERVAL = 0.5
+
+# Process-wide mode, picked on first use.
+_mode = None
+
+# Job IDs for jsonl events. They are handed out process-wide, since every progress tracker writes to the same stderr.
+_job_ids = itertools.count()
+_job_ids_lock = threading.Lock()
+
+
+def get_mode():
+    """Get the progress mode, reading it from M4B_UTIL_PROGRESS if it hasn't been set yet."""
+    if _mode is None:
+        set_mode(os.environ.get("M4B_UTIL_PROGRESS", "rich"))
+    return _mode
+
+
+def set_mode(mode):
+    """Set the progress mode for the rest of the process.
+
+    :param mode: One of PROGRESS_MODES.
+    :raises ValueError: If mode isn't one we know.
+    """
+    global _mode
+    if mode not in PROGRESS_MODES:
+        raise ValueError(f"Unknown progress mode '{mode}'. Choose from: {', '.join(PROGRESS_MODES)}")
+    _mode = mode
+
+
+def _plain(text):
+    """Strip rich markup from text."""
+    return Text.from_markup(str(text)).plain
+
+
+def _emit(event, **fields):
+    """Write one jsonl event to stderr."""
+    sys.stderr.write(json.dumps({"event": event, **fields}) + "\n")
+    sys.stderr.flush()
+
+
+class _JsonlConsole:
+    """Stands in for a rich Console, turning printed messages into jsonl events."""
+
+    def print(self, *objects, **_):
+        """Emit a message event."""
+        _emit("message", text=" ".join(_plain(o) for o in objects))
+
+
+class _JsonlTask:
+    """What we know about a single task."""
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.completed = 0
+        self.speed = None
+        self.finished = False
+        self.started_at = time.monotonic()
+        self.last_emit = None
+
+
+class JsonlProgress:
+    """A drop-in for rich's Progress that reports to stderr as JSON lines instead of drawing on the console.
+
+    Events are throttled to one every JSONL_INTERVAL seconds per task, except for the first and last. Task IDs are
+    unique across every tracker in the process, so a reader can tell the jobs apart.
+    """
+
+    def __init__(self):
+        """Set up an empty task list."""
+        self.console = _JsonlConsole()
+        self._tasks = dict()
+        self._lock = threading.Lock()  # Tasks may be added and updated from worker threads.
+
+    def start(self):
+        """Nothing to start, since there is no display to refresh."""
+
+    def stop(self):
+        """Nothing to stop, since there is no display to refresh."""
+
+    def add_task(self, description, total=100, **fields):
+        """Add a task, and emit a 'start' event for it.
+
+        :return: The task's ID.
+        """
+        with _job_ids_lock:
+            task_id = next(_job_ids)
+        with self._lock:
+            self._tasks[task_id] = _JsonlTask(_plain(description), total)
+            _emit("start", job=task_id, name=self._tasks[task_id].name, total=total)
+        return task_id
+
+    def update(self, task_id, completed=None, advance=None, total=None, visible=None, speed=None, **fields):
+        """Update a task, and emit a 'progress' event if it has been long enough since the last one.
+
+        A task that is completed, or hidden, is treated as finished, and always gets a final event.
+        """
+        with self._lock:
+            task = self._tasks[task_id]
+            if task.finished:
+                return
+            if total is not None:
+                task.total = total
+            if completed is not None:
+                task.completed = completed
+            if advance is not None:
+                task.completed += advance
+            if speed is not None:
+                task.speed = speed
+
+            task.finished = visible is False or bool(task.total and task.completed >= task.total)
+            now = time.monotonic()
+            if not task.finished and task.last_emit is not None and now - task.last_emit < JSONL_INTERVAL:
+                return
+            task.last_emit = now
+            percent = min(task.completed / task.total * 100, 100) if task.total else None
+            _emit("progress", job=task_id, name=task.name, percent=percent, speed=task.speed,
+                  elapsed=round(now - task.started_at, 3), finished=task.finished)
+
+
+class QuietProgress:
+    """A drop-in for rich's Progress that shows nothing but printed messages."""
+
+    def __init__(self):
+        """Set up the console, for messages."""
+        self.console = Console()
+        self._task_count = 0
+
+    def start(self):
+        """Nothing to start."""
+
+    def stop(self):
+        """Nothing to stop."""
+
+    def add_task(self, description, total=100, **fields):
+        """Hand out a task ID, and nothing else."""
+        self._task_count += 1
+        return self._task_count - 1
+
+    def update(self, task_id, **fields):
+        """Ignore the update."""
+
+
+class _JsonlStatus:
+    """A drop-in for rich's Status that emits a 'status' event whenever the message changes."""
+
+    def __init__(self, status):
+        self.status = status
+
+    def start(self):
+        """Emit the current message."""
+        _emit("status", text=_plain(self.status))
+
+    def stop(self):
+        """Nothing to stop."""
+
+    def update(self, status):
+        """Emit the new message."""
+        self.status = status
+        self.start()
+
+
+class _QuietStatus(_JsonlStatus):
+    """A drop-in for rich's Status that shows nothing."""
+
+    def start(self):
+        """Show nothing."""
+
+
+def make_progress(mode=None):
+    """Make a progress tracker for the current progress mode.
+
+    :param mode: One of PROGRESS_MODES, to override the current mode.
+    :return: A rich Progress, or something that can be used just like one.
+    """
+    mode = mode or get_mode()
+    if mode == "jsonl":
+        return JsonlProgress()
+    if mode == "none":
+        return QuietProgress()
+    return Progress(SpinnerColumn(), *Progress.get_default_columns())
+
+
+def make_status(status, mode=None):
+    """Make a status message for the current progress mode.
+
+    :param status: The message to start with.
+    :param mode: One of PROGRESS_MODES, to override the current mode.
+    :return: A rich Status, or something that can be used just like one.
+    """
+    mode = mode or get_mode()
+    if mode == "jsonl":
+        return _JsonlStatus(status)
+    if mode == "none":
+        return _QuietStatus(status)
+    return Status(status)
@@ -1,4 +1,6 @@
 """The Splitter Class."""
+from rich import print
+
 from m4b_util.helpers import cover_utils
 from m4b_util.helpers.parallel_ffmpeg import ParallelFFmpeg
 
@@ -7,13 +9,25 @@ def split(
         input_path,
         output_dir_path,
         segment_list,
-        output_pattern="segment_{i:04d}.mp3"
+        output_pattern="segment_{i:04d}.mp3",
+        jobs=None,
+        threads_per_job=None,
+        adaptive_jobs=False,
 ):
-    """Split a file into multiple, based on segments."""
+    """Split a file into multiple, based on segments.
+
+    :param jobs: How many segments to split out at once. Defaults to what fits in the CPUs we may use.
+    :param threads_per_job: How many threads each ffmpeg may use. Defaults to an even share of the CPUs.
+    :param adaptive_jobs: Work out how many segments to split out at once while splitting, up to jobs.
+    """
     cover_utils.extract_cover(input_path, output_dir_path / "cover.png")
+    p = ParallelFFmpeg(f"Splitting '{input_path.name}'", jobs=jobs, threads_per_job=threads_per_job,
+                       adaptive=adaptive_jobs)
 
-    # Generate task list
-    tasks = list()
+    # Generate task list. If the naming pattern gives two segments the same output file, the later one wins, with a
+    # warning. Jobs don't run in order, so the earlier one isn't run at all.
+    tasks = dict()
+    segment_for = dict()
     for i, segment in enumerate(segment_list):
         time = segment.end_time - segment.start_time
 
@@ -21,7 +35,7 @@ def split(
         output_path = output_dir_path / output_pattern.format(i, i=i, title=segment.title)
 
         cmd = ["ffmpeg", "-ss", str(segment.start_time), "-t", str(time), "-i", input_path,
-               "-map", "0:a", "-map_chapters", "-1", "-y"]
+               "-map", "0:a", "-map_chapters", "-1", *p.threads_args, "-y"]
         if segment.title:
             cmd.extend(["-metadata", f"title={segment.title}"])
         cmd.append(output_path)
@@ -29,11 +43,16 @@ def split(
         name = f"Splitting segment {i}"
         if segment.title:
             name += f" - {segment.title}"
-        tasks.append({
+        if output_path in tasks:
+            print(f"[bold yellow]Warning:[/] Segments {segment_for[output_path]} and {i} would both be written to "
+                  f"'{output_path.name}'. Only segment {i} will be kept.")
+            del tasks[output_path]
+        segment_for[output_path] = i
+        tasks[output_path] = {
             "name": name,
-            "command": cmd
-        })
+            "command": cmd,
+            "cost": time
+        }
 
     # Process splits in parallel
-    p = ParallelFFmpeg(f"Splitting '{input_path.name}'")
-    p.process(tasks)
+    p.process(list(tasks.values()))
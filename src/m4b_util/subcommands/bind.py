@@ -5,7 +5,8 @@ import sys
 
 from rich import print
 
-from m4b_util.helpers import Audiobook
+from m4b_util.helpers import Audiobook, ffprobe, ffprogress
+from m4b_util.helpers.parallel_ffmpeg import positive_int
 
 
 def _parse_args():
@@ -22,8 +23,28 @@ def _parse_args():
                                                               " is '[Author] - [Title].m4b'.")
     parser.add_argument('-t', "--title", type=str, help="Title of the audiobook.")
     parser.add_argument("--date", type=str, help="Date to include in metadata.")
-    parser.add_argument("--decode-durations", "--decode-duration", action='store_true',
-                        help="Fully decode each file to determine its duration (Slower, but more accurate).")
+    parser.add_argument("--duration-mode", choices=ffprobe.DURATION_MODES, default="metadata",
+                        help="How to determine each file's duration. 'metadata' trusts the file's headers, 'decode' "
+                             "fully decodes each file (slow, but accurate), and 'demux' reads every packet without "
+                             "decoding (as accurate as 'decode', at close to disk speed). 'adaptive' uses the "
+                             "metadata, but decodes any file whose metadata looks unreliable, and reports how far off "
+                             "it was. Default is 'metadata'.")
+    parser.add_argument("--decode-durations", "--decode-duration", action='store_const', dest="duration_mode",
+                        const="decode", help="Same as '--duration-mode decode'.")
+    parser.add_argument("--job-timeout", type=float, metavar="SECONDS",
+                        help="Kill any ffmpeg job that runs for longer than this.")
+    parser.add_argument("--stall-timeout", type=float, metavar="SECONDS",
+                        help="Kill any ffmpeg job that goes this long without making progress.")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="How many times to retry an ffmpeg job that was killed for taking too long. Each retry "
+                             "waits twice as long as the one before, starting at one second. Default is 0.")
+    parser.add_argument('-j', "--jobs", type=positive_int,
+                        help="How many files to convert at once. Default is as many as the CPU budget allows.")
+    parser.add_argument("--threads-per-job", type=positive_int,
+                        help="How many threads each ffmpeg may use. Default is an even share of the CPUs.")
+    parser.add_argument("--adaptive-jobs", action='store_true',
+                        help="Work out how many files to convert at once while converting them, up to --jobs, and "
+                             "report the best number found, so it can be given to --jobs next time.")
     parser.add_argument("--show-order", action='store_true',
                         help="Show the order the files would be read in, then exit.")
     parser.add_argument("--keep-temp-files", action='store_true', help="Skip cleanup. (Debugging)")
@@ -50,6 +71,10 @@ def run():
         title=args.title,
         date=args.date,
         keep_temp_files=args.keep_temp_files,
+        watchdog=ffprogress.Watchdog(timeout=args.job_timeout, stall_timeout=args.stall_timeout, retries=args.retries),
+        jobs=args.jobs,
+        threads_per_job=args.threads_per_job,
+        adaptive_jobs=args.adaptive_jobs,
     )
 
     # Print order, if applicable
@@ -59,7 +84,7 @@ def run():
         return 0
 
     # Add the files to the binder
-    book.add_chapters_from_directory(args.input_folder)
+    book.add_chapters_from_directory(args.input_folder, decode_durations=args.duration_mode)
 
     # Run the binder
     output_path = Path()
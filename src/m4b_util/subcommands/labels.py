@@ -77,7 +77,9 @@ def run():
     """Run the subcommand."""
     # Set up variables
     args = _parse_args()
-    book = Audiobook()
+    # Share probe results between books, in case they are backed by the same file.
+    session = ffprobe.ProbeSession()
+    book = Audiobook(probe_session=session)
 
     # Handle input
     if args.from_label_file:
@@ -98,9 +100,9 @@ def run():
             f.write(book.metadata)
 
     if args.to_book:
-        new_book = Audiobook()
+        new_book = Audiobook(probe_session=session)
         new_book.add_chapters_from_chaptered_file(args.to_book)
-        new_book_dur = ffprobe.get_file_duration(args.to_book)
+        new_book_dur = ffprobe.get_file_duration(args.to_book, session=session)
         new_chapters = list()
         for chapter in book.chapters:
             # Check to see if a chapter is straddling the cutoff. If so, set the chapter's end equal to the cutoff.
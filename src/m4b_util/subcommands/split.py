@@ -6,6 +6,7 @@ from rich import print
 
 from ..helpers import splitter
 from ..helpers.finders import find_chapters, find_silence
+from ..helpers.parallel_ffmpeg import positive_int
 
 
 def _parse_args():
@@ -24,6 +25,13 @@ def _parse_args():
                         help="Output filename pattern (e.g. `segment_{i:04d}.mp3`), use '{i}' for sequence and "
                              "'{title}' for chapter title.")
     parser.add_argument('-s', "--start-time", type=float, help='Start time (seconds)')
+    parser.add_argument('-j', "--jobs", type=positive_int,
+                        help="How many segments to split out at once. Default is as many as the CPU budget allows.")
+    parser.add_argument("--threads-per-job", type=positive_int,
+                        help="How many threads each ffmpeg may use. Default is an even share of the CPUs.")
+    parser.add_argument("--adaptive-jobs", action='store_true',
+                        help="Work out how many segments to split out at once while splitting, up to --jobs, and "
+                             "report the best number found, so it can be given to --jobs next time.")
 
     silence_options = parser.add_argument_group('split-by-silence options')
     silence_options.add_argument("--silence-threshold", default=-35, type=int, help='Silence threshold (in dB)')
@@ -80,5 +88,8 @@ def run():
         input_path=input_path,
         output_dir_path=output_path,
         output_pattern=args.output_pattern,
-        segment_list=segment_list
+        segment_list=segment_list,
+        jobs=args.jobs,
+        threads_per_job=args.threads_per_job,
+        adaptive_jobs=args.adaptive_jobs,
     )
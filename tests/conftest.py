@@ -1,11 +1,14 @@
 """PyTest Configuration."""
 from pathlib import Path
 from subprocess import run
+import sys
 
 import pytest
 
 from expected_data import expected_data  # noqa
 
+from m4b_util.helpers import governor, probe_cache
+
 # Let pytest know we would like them to handle asserts in our helper code
 pytest.register_assert_rewrite("testhelpers")
 
@@ -28,6 +31,21 @@ def _generate_tone_files(dir_path, extension):
         run(cmd, capture_output=True, check=True)
 
 
+@pytest.fixture(autouse=True)
+def isolated_probe_cache(tmp_path_factory, monkeypatch):
+    """Keep each test's probe cache out of the user's cache dir, and away from other tests."""
+    cache = probe_cache.ProbeCache(tmp_path_factory.mktemp("cache") / "probe_cache.sqlite")
+    monkeypatch.setattr(probe_cache, "_shared_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_governor(monkeypatch):
+    """Start each test without limits on ffmpeg, and don't let one test's limits leak into the next."""
+    monkeypatch.setattr(governor, "_limits", governor.Limits())
+    monkeypatch.setattr(governor, "_writer_slots", None)
+
+
 @pytest.fixture(scope='session')
 def test_data_path():
     """Path to the test data directory."""
@@ -223,3 +241,29 @@ def fake_file(tmp_path):
     file = tmp_path / "fake.file"
     open(file, 'a').close()
     return file
+
+
+@pytest.fixture()
+def fake_ffmpeg(tmp_path):
+    """Make a stand-in for ffmpeg that prints what it is told to, on the pipes ffmpeg would use.
+
+    If asked to, it then hangs for a while, either every time it is run or only the first time.
+    """
+    def _make(stderr=(), progress=(), returncode=0, hang=0, hang_once=False):
+        script = tmp_path / "fake_ffmpeg"
+        marker = tmp_path / "fake_ffmpeg.hung"
+        script.write_text(
+            f"#!{sys.executable}\n"
+            "import os, sys, time\n"
+            f"for line in {list(stderr)!r}:\n"
+            "    print(line, file=sys.stderr, flush=True)\n"
+            f"for line in {list(progress)!r}:\n"
+            "    print(line, flush=True)\n"
+            f"if {hang!r} and not ({hang_once!r} and os.path.exists({str(marker)!r})):\n"
+            f"    open({str(marker)!r}, 'w').close()\n"
+            f"    time.sleep({hang!r})\n"
+            f"sys.exit({returncode})\n"
+        )
+        script.chmod(0o755)
+        return str(script)
+    return _make
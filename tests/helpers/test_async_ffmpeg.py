@@ -0,0 +1,133 @@
+"""Async ffmpeg tests."""
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+
+from m4b_util.helpers import async_ffmpeg, ffprobe
+from m4b_util.helpers.ffprogress import FFmpegTimeoutError, Watchdog
+
+
+def test_gather_limited():
+    """Never run more than the limit at once, and keep results in order."""
+    running = list()
+    most_running = 0
+
+    async def job(i):
+        nonlocal most_running
+        running.append(i)
+        most_running = max(most_running, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(i)
+        return i * 2
+
+    results = asyncio.run(async_ffmpeg.gather_limited((job(i) for i in range(20)), 3))
+    assert results == [i * 2 for i in range(20)]
+    assert most_running == 3
+
+
+def test_run_probe(m4a_file_path, chaptered_audio_file_path, fake_file):
+    """Probe files without blocking the event loop."""
+    probes = asyncio.run(async_ffmpeg.run_probe_many([m4a_file_path, fake_file, chaptered_audio_file_path]))
+    assert probes[0].format == ffprobe.run_probe(m4a_file_path).format
+    assert probes[1] is None
+    assert probes[2].chapters == ffprobe.run_probe(chaptered_audio_file_path).chapters
+
+    # Everything we probed is cached for next time.
+    with mock.patch("asyncio.create_subprocess_exec") as create:
+        assert asyncio.run(async_ffmpeg.run_probe(m4a_file_path)).format == probes[0].format
+    create.assert_not_called()
+
+
+def test_async_ffprogress(fake_ffmpeg):
+    """Read progress and logs from the event loop."""
+    progress = ["out_time_us=15000000", "speed=2x", "progress=continue", "out_time_us=30000000", "progress=end"]
+    ff = async_ffmpeg.AsyncFFProgress([fake_ffmpeg(stderr=["Duration: 00:01:00.00"], progress=progress), "-t", "30"])
+
+    async def collect():
+        return [percent async for percent in ff.run()]
+
+    assert asyncio.run(collect()) == [0, 50, 100, 100]
+    assert ff.last_event.finished
+    assert ff.output == "Duration: 00:01:00.00"
+
+
+def test_async_run(fake_ffmpeg):
+    """Pass progress events along, and raise if ffmpeg fails."""
+    events = list()
+    ff = asyncio.run(async_ffmpeg.run([fake_ffmpeg(progress=["out_time_us=1000000", "progress=end"])], events.append))
+    assert len(events) == 1
+    assert events[0].out_time == 1.0
+    assert ff.output is None
+
+    with pytest.raises(RuntimeError) as e:
+        asyncio.run(async_ffmpeg.run([fake_ffmpeg(stderr=["Something broke"], returncode=1)]))
+    assert str(e.value).endswith("Something broke")
+
+
+def test_async_run_real(tmp_path):
+    """Run a real ffmpeg command."""
+    output_path = tmp_path / "tone.m4a"
+    cmd = ["ffmpeg", "-f", "lavfi", "-i", "sine=frequency=110:sample_rate=48000:duration=2.5", output_path]
+    asyncio.run(async_ffmpeg.run(cmd))
+    assert ffprobe.run_probe(output_path).format['duration'] == "2.500000"
+
+
+@mock.patch("m4b_util.helpers.async_ffmpeg.make_progress")
+def test_process(progress):
+    """Run a batch of jobs, some of which fail."""
+    tasks = [{"name": str(i), "command": ["ffmpeg", "-version"]} for i in range(10)]
+    tasks.append({"name": "crash", "command": ["not-a-command"]})
+    tasks.append({"name": "fail", "command": ["ffmpeg", "-not-a-real-option"]})
+
+    p = async_ffmpeg.AsyncParallelFFmpeg("Testing", limit=4)
+    results = asyncio.run(p.process(tasks))
+    assert [result.ok for result in results] == [True] * 10 + [False, False]
+    assert [result.name for result in results] == [task["name"] for task in tasks]
+    assert results[11].status == "failed"
+    assert results[11].returncode != 0
+    assert "not-a-real-option" in results[11].log_tail
+    progress().add_task.assert_has_calls([mock.call("[cyan]Testing", total=12)])
+    progress().console.print.assert_has_calls([
+        mock.call("[red]Error:[/] Failed to process crash"),
+        mock.call("[red]Error:[/] Failed to process fail"),
+    ], any_order=True)
+    progress().stop.assert_called()
+
+    assert asyncio.run(p.process(list())) is None
+
+
+def test_async_watchdog(fake_ffmpeg):
+    """Kill and retry stuck jobs from the event loop."""
+    watchdog = Watchdog(stall_timeout=0.25, retries=1, backoff=0)
+    ff = asyncio.run(async_ffmpeg.run([fake_ffmpeg(hang=30, hang_once=True)], watchdog=watchdog))
+    assert ff.attempts == 2
+
+    with pytest.raises(FFmpegTimeoutError):
+        asyncio.run(async_ffmpeg.run([fake_ffmpeg(hang=30)], watchdog=watchdog))
+
+
+@mock.patch("m4b_util.helpers.async_ffmpeg.make_progress")
+def test_process_timeout(progress, fake_ffmpeg):
+    """Report jobs that were stuck for good."""
+    p = async_ffmpeg.AsyncParallelFFmpeg("Testing", watchdog=Watchdog(timeout=0.25, retries=1, backoff=0))
+    results = asyncio.run(p.process([{"name": "stuck", "command": [fake_ffmpeg(hang=30)]}]))
+    assert results[0].status == "timed out"
+    assert results[0].retries == 1
+    progress().console.print.assert_called_with("[red]Error:[/] Timed out processing stuck after 1 retry")
+
+
+@mock.patch("m4b_util.helpers.async_ffmpeg.make_progress")
+def test_process_fail_fast(progress, fake_ffmpeg):
+    """Start the longest jobs first, and cancel everything else once one fails."""
+    tasks = [{"name": "stuck", "command": [fake_ffmpeg(hang=30)], "cost": 2},
+             {"name": "fail", "command": ["ffmpeg", "-not-a-real-option"], "cost": 3},
+             {"name": "waiting", "command": ["ffmpeg", "-version"], "cost": 1}]
+    p = async_ffmpeg.AsyncParallelFFmpeg("Testing", limit=2, fail_fast=True)
+    start = time.monotonic()
+    results = asyncio.run(p.process(tasks))
+    assert time.monotonic() - start < 10
+    assert [result.status for result in results] == ["cancelled", "failed", "cancelled"]
+    progress().add_task.assert_has_calls([mock.call("[cyan]Testing", total=6)])
+    progress().console.print.assert_called_with("[bold yellow]Warning:[/] Cancelled 2 job(s).")
@@ -1,13 +1,16 @@
 """Test the Audiobook class."""
+from concurrent.futures import Future
 from pathlib import Path
 import shutil
 from subprocess import run
 from tempfile import TemporaryDirectory
+from unittest import mock
 
 from natsort import natsorted
 import testhelpers
 
 from m4b_util.helpers import Audiobook, ffprobe, SegmentData
+from m4b_util.helpers.parallel_ffmpeg import ParallelFFmpeg, TaskResult
 
 
 def _do_dir_scan(book, in_dir, use_filenames=False, decode_durations=False, **kwargs):
@@ -532,6 +535,23 @@ def test_bind_non_backed_segment(tmp_path, mp3_path, capsys):
     assert "Cannot bind a non-backed segment." in output.out
 
 
+def test_bind_failed_conversion(tmp_path, mp3_path, capsys):
+    """Stop, rather than binding a broken book, if any file fails to convert."""
+    out_file_path = tmp_path / "Book.m4b"
+    b = Audiobook()
+    b.add_chapters_from_directory(mp3_path)
+    futures = [Future() for _ in b.chapters]
+    for i, (chapter, future) in enumerate(zip(b.chapters, futures)):
+        future.set_result(TaskResult(chapter.title, "failed" if i == 1 else "finished"))
+    with mock.patch.object(ParallelFFmpeg, "submit_many", return_value=futures) as submit_many, \
+            mock.patch.object(Audiobook, "_concatenate_files") as concatenate:
+        assert b.bind(out_file_path) is False
+    assert [task["cost"] for task in submit_many.call_args.args[0]] == [c.end_time - c.start_time for c in b.chapters]
+    concatenate.assert_not_called()
+    assert "Could not convert every file" in capsys.readouterr().out
+    assert not out_file_path.exists()
+
+
 def test_filelist_duration_failure(mkv_file_path, capsys):
     """Warn user if we fail to find duration of a file while adding chapters."""
     b = Audiobook()
@@ -540,6 +560,23 @@ def test_filelist_duration_failure(mkv_file_path, capsys):
     assert "Failed to determine duration" in output.out
 
 
+def test_adaptive_durations(mp3_path, mkv_file_path, capsys):
+    """Only decode the files with unreliable durations, and report how far off they were."""
+    b = Audiobook()
+    with mock.patch("m4b_util.helpers.ffprobe._run_for_duration", return_value=4.0) as run_for_duration:
+        b.add_chapters_from_filelist(sorted(mp3_path.glob("*.mp3")) + [mkv_file_path], decode_durations="adaptive")
+    run_for_duration.assert_called_once()
+    assert run_for_duration.call_args.args[:2] == (mkv_file_path, "decode")
+    assert len(b.chapters) == 9
+    assert b.chapters[-1].end_time - b.chapters[-1].start_time == 4.0
+
+    output = capsys.readouterr()
+    assert "Decoded 1 file(s) with unreliable durations" in output.out
+    assert "no_duration.mkv" in output.out
+    assert "no duration in metadata; duration could not be compared" in output.out
+    assert b.duration_checks[0].file == mkv_file_path
+
+
 def test_add_fake_chaptered_file(fake_file, capsys):
     """Warn user if we cannot read the chaptered file while adding."""
     b = Audiobook()
@@ -597,3 +634,14 @@ def test_tmp_path():
     new_tmp_path = b._tmp_path
     assert new_tmp_path == tmp_path
     assert tmp_path.is_dir()
+
+
+def test_chaptered_file_probed_once(chaptered_audio_file_path):
+    """Read a chaptered file only once, even though we need both its chapters and its tags."""
+    b = Audiobook()
+    with mock.patch("m4b_util.helpers.ffprobe.read_native", wraps=ffprobe.read_native) as read_native, \
+            mock.patch("m4b_util.helpers.ffprobe.run_probe", wraps=ffprobe.run_probe) as run_probe:
+        b.add_chapters_from_chaptered_file(chaptered_audio_file_path)
+        b.add_chapters_from_filelist([chaptered_audio_file_path])
+    read_native.assert_called_once_with(chaptered_audio_file_path)
+    run_probe.assert_not_called()  # m4b files don't need ffprobe at all.
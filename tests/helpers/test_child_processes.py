@@ -0,0 +1,134 @@
+"""Child process tests."""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from m4b_util.helpers import child_processes
+from m4b_util.helpers.parallel_ffmpeg import ParallelFFmpeg
+
+# A child that ignores SIGTERM, so has to be killed.
+STUBBORN = [sys.executable, "-c", "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)"]
+
+
+@pytest.fixture(autouse=True)
+def clean_registry(monkeypatch):
+    """Keep every test's children and temporary directories to itself."""
+    monkeypatch.setattr(child_processes, "_children", set())
+    monkeypatch.setattr(child_processes, "_temp_dirs", set())
+    monkeypatch.setattr(child_processes, "_stopping", False)
+
+
+def test_popen():
+    """Keep track of a child until it has been waited for, in a process group of its own."""
+    p = child_processes.Popen([sys.executable, "-c", "import time; time.sleep(0.1)"])
+    assert p in child_processes._children
+    if sys.platform != "win32":
+        assert os.getpgid(p.pid) == p.pid
+    assert p.wait() == 0
+    assert p not in child_processes._children
+
+
+def test_run():
+    """Work like subprocess.run."""
+    result = child_processes.run([sys.executable, "-c", "print('hello')"], capture_output=True)
+    assert result.returncode == 0
+    assert result.stdout.strip() == b"hello"
+    assert not child_processes._children
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Windows has no SIGTERM to ignore.")
+def test_stop():
+    """Ask nicely first, then kill anything that doesn't listen."""
+    polite = child_processes.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    stubborn = child_processes.Popen(STUBBORN)
+    time.sleep(0.5)  # Give the stubborn one time to start ignoring SIGTERM.
+
+    start = time.monotonic()
+    assert child_processes.stop_all(grace=0.5) == 2
+    assert time.monotonic() - start < 5
+    assert polite.returncode == -signal.SIGTERM
+    assert stubborn.returncode == -signal.SIGKILL
+    assert not child_processes._children
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Windows has no waitid.")
+def test_stop_async_child():
+    """See an asyncio child stop straight away, even when its event loop isn't running to tell us."""
+    async def start():
+        return await asyncio.create_subprocess_exec(sys.executable, "-c", "import time; time.sleep(30)",
+                                                    **child_processes.popen_kwargs())
+
+    loop = asyncio.new_event_loop()
+    try:
+        child = child_processes.AsyncChild(loop.run_until_complete(start()))
+        assert child.poll() is None
+        began = time.monotonic()
+        child_processes.stop([child], grace=5)
+        assert time.monotonic() - began < 4
+        assert child.poll() is not None
+    finally:
+        loop.close()
+
+
+def test_shutdown(tmp_path):
+    """Stop every child, remove temporary directories, and stop anything started on the way out."""
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    (temp_dir / "part.m4a").touch()
+    child_processes.remove_on_exit(temp_dir)
+    p = child_processes.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+
+    child_processes.shutdown()
+    assert p.returncode is not None
+    assert not temp_dir.exists()
+
+    late = child_processes.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    assert late.wait(timeout=5) != 0
+
+
+def test_unregister_temp(tmp_path):
+    """Leave a temporary directory alone on the way out once it has been forgotten."""
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    child_processes.remove_on_exit(temp_dir)
+    child_processes.unregister_temp(str(temp_dir))
+    assert not child_processes._temp_dirs
+
+    child_processes.shutdown()
+    assert temp_dir.exists()
+
+
+def test_sigterm():
+    """Turn SIGTERM into an ordinary exit, so the child that was running is stopped too."""
+    script = ("import sys, time\n"
+              "from m4b_util.helpers import child_processes\n"
+              "child_processes.install()\n"
+              "p = child_processes.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])\n"
+              "print(p.pid, flush=True)\n"
+              "time.sleep(30)\n")
+    parent = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE)
+    child_pid = int(parent.stdout.readline())
+    parent.terminate()
+    assert parent.wait(timeout=10) == 128 + signal.SIGTERM
+    parent.stdout.close()
+    with pytest.raises(ProcessLookupError):
+        os.kill(child_pid, 0)
+
+
+def test_cancel_on_error(fake_ffmpeg):
+    """Kill every running job, and skip the rest, if we leave a pool because of an error."""
+    cmd = [fake_ffmpeg(hang=30)]
+    start = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        with ParallelFFmpeg("Testing", jobs=2, executor="thread") as p:
+            futures = [p.submit(str(i), cmd) for i in range(4)]
+            time.sleep(0.5)
+            raise KeyboardInterrupt
+    assert time.monotonic() - start < 10
+    assert {future.result().status for future in futures} == {"cancelled"}
+    assert not child_processes._children
@@ -1,7 +1,9 @@
 """ffprobe tests."""
+from unittest import mock
+
 import pytest
 
-from m4b_util.helpers import ffprobe
+from m4b_util.helpers import ffprobe, media_backend
 
 
 def test_video_only(video_only_file):
@@ -97,6 +99,24 @@ def test_decode_durations(m4a_file_path):
     assert (meta_duration == pytest.approx(decoded_duration, 0.05) == 5.0)
 
 
+def test_demux_duration(m4a_file_path, mkv_file_path):
+    """Read the duration of a file by demuxing it."""
+    decoded_duration = ffprobe.get_file_duration(m4a_file_path, decode_duration="decode")
+    assert ffprobe.get_file_duration(m4a_file_path, decode_duration="demux") == decoded_duration
+    assert (ffprobe.get_file_duration(mkv_file_path, decode_duration="demux")
+            == ffprobe.get_file_duration(mkv_file_path, decode_duration="decode"))
+    with mock.patch("m4b_util.helpers.media_backend.Popen", wraps=media_backend.Popen) as popen:
+        ffprobe.get_file_duration(m4a_file_path, decode_duration="demux")
+    assert "copy" in popen.call_args.args[0]
+
+
+def test_unknown_duration_mode(m4a_file_path):
+    """Reject duration modes we don't know."""
+    with pytest.raises(ValueError) as e:
+        ffprobe.get_file_duration(m4a_file_path, decode_duration="guess")
+    assert "Unknown duration mode 'guess'" in str(e.value)
+
+
 def test_decode_duration_fake_file(fake_file):
     """Read the duration of a file by decoding it."""
     with pytest.raises(RuntimeError) as e:
@@ -113,3 +133,147 @@ def test_get_duration_no_metadata(mkv_file_path, capsys):
     with pytest.raises(RuntimeError) as e:
         ffprobe.get_file_duration(mkv_file_path)
     assert ("Cannot parse duration listed in file." in str(e.value))
+
+
+def test_run_probe_many(mp3_path, fake_file):
+    """Probe a batch of files, keeping the input order."""
+    files = sorted(mp3_path.glob("*.mp3"))
+    files.insert(3, fake_file)
+    probes = ffprobe.run_probe_many(files, max_workers=4)
+    assert len(probes) == len(files)
+    assert probes[3] is None
+    for file, probe in zip(files, probes):
+        if file != fake_file:
+            assert probe.data['format']['filename'] == str(file)
+
+    # Serial mode should give the same answer
+    serial = ffprobe.run_probe_many(files, max_workers=1)
+    assert [p and p.data for p in serial] == [p and p.data for p in probes]
+    assert ffprobe.run_probe_many([]) == []
+
+
+def test_probe_session(mp3_path):
+    """Only probe each file once per session."""
+    files = sorted(mp3_path.glob("*.mp3"))
+    session = ffprobe.ProbeSession()
+    with mock.patch("m4b_util.helpers.ffprobe.run_probe", wraps=ffprobe.run_probe) as run_probe, \
+            mock.patch("m4b_util.helpers.ffprobe.read_native", return_value=None):
+        first = session.run_probe(files[0])
+        assert session.run_probe(str(files[0])) is first
+        probes = session.run_probe_many(files + files[:2])
+        assert probes[0] is first
+        assert probes[-2] is first
+        assert len(probes) == len(files) + 2
+        assert ffprobe.get_file_duration(files[1], session=session) == float(probes[1].audio['duration'])
+        assert run_probe.call_count == len(files)
+
+        # Forgotten files are probed again
+        session.forget(files[0])
+        assert session.run_probe(files[0]) is not first
+        assert run_probe.call_count == len(files) + 1
+
+
+def test_probe_profiles(chaptered_audio_file_path):
+    """Only ask ffprobe for what the profile needs."""
+    duration = ffprobe.run_probe(chaptered_audio_file_path, profile="duration")
+    assert duration.audio['duration'] == "20.000000"
+    assert duration.tags is None
+    assert duration.chapters is None
+    assert 'codec_long_name' not in duration.audio
+
+    tags = ffprobe.run_probe(chaptered_audio_file_path, profile="tags")
+    assert tags.tags['title'] == "Chaptered Audio"
+    assert tags.chapters is None
+
+    chapters = ffprobe.run_probe(chaptered_audio_file_path, profile="chapters")
+    assert chapters.chapters == ffprobe.run_probe(chaptered_audio_file_path).chapters
+    assert 'codec_long_name' in ffprobe.run_probe(chaptered_audio_file_path).audio
+
+
+def test_probe_lazy():
+    """Don't parse anything until it is used."""
+    probe = ffprobe.Probe("not json")
+    with pytest.raises(ValueError):
+        assert probe.audio
+    assert ffprobe.Probe('{"format": {}}').audio is None
+
+
+def test_probe_session_profiles(mp3_file_path):
+    """Reuse broader probes for narrower requests, but not the other way around."""
+    session = ffprobe.ProbeSession()
+    with mock.patch("m4b_util.helpers.ffprobe.run_probe", wraps=ffprobe.run_probe) as run_probe, \
+            mock.patch("m4b_util.helpers.ffprobe.read_native", return_value=None):
+        duration = session.run_probe(mp3_file_path, profile="duration")
+        assert session.run_probe(mp3_file_path, profile="duration") is duration
+        tags = session.run_probe(mp3_file_path, profile="tags")
+        assert tags is not duration
+        assert session.run_probe(mp3_file_path, profile="duration") is tags
+        assert session.run_probe_many([mp3_file_path], profile="tags") == [tags]
+    assert [c.args[1] for c in run_probe.call_args_list] == ["duration", "tags"]
+
+
+def test_adaptive_duration(m4a_file_path, mp3_file_path, mkv_file_path):
+    """Only decode files whose metadata can't be trusted."""
+    checks = list()
+    with mock.patch("m4b_util.helpers.ffprobe._run_for_duration", return_value=4.5) as run_for_duration:
+        assert ffprobe.get_file_duration(m4a_file_path, "adaptive", checks=checks) == 5.0
+        run_for_duration.assert_not_called()
+
+        # Without the native reader, all we have is ffprobe's estimate.
+        with mock.patch("m4b_util.helpers.ffprobe.read_native", return_value=None):
+            assert ffprobe.get_file_duration(mp3_file_path, "adaptive", checks=checks) == 4.5
+        assert ffprobe.get_file_duration(mkv_file_path, "adaptive", checks=checks) == 4.5
+
+    assert len(checks) == 2
+    assert checks[0].file == mp3_file_path
+    assert checks[0].reason == "mp3 without a usable VBR header"
+    assert checks[0].drift == pytest.approx(checks[0].metadata_duration - 4.5)
+    assert checks[1].reason == "no duration in metadata"
+    assert checks[1].drift is None
+
+
+def test_duration_suspect_reason():
+    """Spot durations that don't match the file size."""
+    data = {
+        "streams": [{"codec_type": "audio", "duration": "100.000000", "bit_rate": "128000"}],
+        "format": {"format_name": "wav", "nb_streams": 1, "size": str(128000 // 8 * 100)},
+    }
+    assert ffprobe.duration_suspect_reason(ffprobe.Probe(data=data)) is None
+    data["format"]["size"] = str(128000 // 8 * 200)
+    assert ffprobe.duration_suspect_reason(ffprobe.Probe(data=data)) == "duration doesn't match file size at 128kbps"
+    assert ffprobe.duration_suspect_reason(ffprobe.Probe(data=data, native=True)) is None
+
+
+def test_streamed_progress(m4a_file_path):
+    """Report progress while decoding, and keep the final time."""
+    updates = list()
+    assert ffprobe._run_for_duration(m4a_file_path, "decode", on_progress=updates.append) == pytest.approx(5.0, 0.05)
+    assert updates
+    assert updates == sorted(updates)
+
+
+def test_prefetch_durations(mp3_path, m4a_file_path, capsys):
+    """Measure durations in parallel up front, so later lookups are instant."""
+    files = sorted(mp3_path.glob("*.mp3"))
+    session = ffprobe.ProbeSession()
+    ffprobe.prefetch_durations(files, "decode", session, max_workers=4)
+    assert "Decoding durations" in capsys.readouterr().out
+    with mock.patch("m4b_util.helpers.ffprobe._run_for_duration") as run_for_duration:
+        durations = [ffprobe.get_file_duration(file, "decode", session=session) for file in files]
+    run_for_duration.assert_not_called()
+    assert durations == [pytest.approx(5.0, 0.05)] * len(files)
+
+    # Nothing to do in metadata mode, or adaptive mode with trustworthy metadata.
+    with mock.patch("m4b_util.helpers.ffprobe._run_for_duration") as run_for_duration:
+        ffprobe.prefetch_durations([m4a_file_path], "metadata", session)
+        ffprobe.prefetch_durations([m4a_file_path], "adaptive", session)
+    run_for_duration.assert_not_called()
+
+
+def test_decode_workers_follow_cpus(mp3_path, monkeypatch):
+    """Run as many decoders as we have CPUs to use, worked out when they are needed."""
+    files = sorted(mp3_path.glob("*.mp3"))[:4]
+    monkeypatch.setattr(ffprobe, "available_cpus", lambda: 3)
+    with mock.patch("m4b_util.helpers.ffprobe.ThreadPoolExecutor", wraps=ffprobe.ThreadPoolExecutor) as executor:
+        ffprobe.prefetch_durations(files, "demux", ffprobe.ProbeSession())
+    executor.assert_called_once_with(max_workers=3)
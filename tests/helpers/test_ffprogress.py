@@ -1,5 +1,7 @@
 """ffprogress tests."""
-import io
+from pathlib import Path
+import threading
+import time
 from unittest import mock
 
 import pytest
@@ -7,6 +9,15 @@ import pytest
 from m4b_util.helpers import ffprobe, ffprogress
 
 
+def _progress_blocks(*seconds):
+    """Build the -progress output ffmpeg would send as it reaches each of the given times."""
+    lines = list()
+    for i, second in enumerate(seconds):
+        lines.append(f"out_time_us={int(second * 1000000)}")
+        lines.append("progress=" + ("end" if i == len(seconds) - 1 else "continue"))
+    return lines
+
+
 def test_to_ms():
     """Convert hr:min:sec.ms to milliseconds."""
     assert ffprogress.to_ms() == 0
@@ -14,48 +25,27 @@ def test_to_ms():
     assert ffprogress.to_ms(hour=5, min=5, sec=5, ms=555) == 18305555
 
 
-@mock.patch("subprocess.Popen")
-def test_ffprogress_class(popen):
+def test_ffprogress_class(fake_ffmpeg):
     """Use the FFProgress class."""
     # Make sure output is initialized to None
-    ff = ffprogress.FFProgress(["mocked_cmd"])
+    ff = ffprogress.FFProgress([fake_ffmpeg(stderr=["Duration: 01:00:00.00"], progress=_progress_blocks(0, 900, 1800, 2700, 3600))])
     assert ff.output is None
 
-    # Set up Mock
-    type(popen()).stdout = mock.PropertyMock(side_effect=[
-        None,
-        io.BytesIO(b"Duration: 01:00:00.00"),
-        None,
-        io.BytesIO(b""),
-        io.BytesIO(b"out_time=00:00:00.00"),
-        io.BytesIO(b"out_time=00:15:00.00"),
-        io.BytesIO(b"out_time=00:30:00.00"),
-        io.BytesIO(b"out_time=00:45:00.00"),
-        io.BytesIO(b"out_time=01:00:00.00"),
-        io.BytesIO(b"")
-    ])
-    popen().returncode = 0
-    popen().poll.side_effect = [None, 0]
-
     expected = [0, 0, 25, 50, 75, 100, 100]
     for percent in ff.run():
         assert percent == expected.pop(0)
+    assert ff.output == "Duration: 01:00:00.00"
 
 
-@mock.patch("subprocess.Popen")
-def test_ffprogress_class_fail(popen):
+def test_ffprogress_class_fail(fake_ffmpeg):
     """Handle a command that fails."""
-    ff = ffprogress.FFProgress(["mocked_cmd"])
-
-    # Set up Mock
-    popen().stdout = io.BytesIO(b"")
-    popen().returncode = -1
-    popen().poll.return_value = 0
+    cmd = [fake_ffmpeg(returncode=1)]
+    ff = ffprogress.FFProgress(cmd)
 
     with pytest.raises(RuntimeError) as e:
         for percent in ff.run():
             assert percent == 0
-    assert ("Error running command ['mocked_cmd']:" in str(e.value))
+    assert (f"Error running command {cmd}:" in str(e.value))
 
 
 def test_run(tmp_path, capsys):
@@ -95,3 +85,165 @@ def test_run_no_printing_errors():
     with pytest.raises(RuntimeError) as e:
         ffprogress.run(cmd, print_errors=False)
     assert "Error running command" in str(e.value)
+
+
+def test_ffprogress_bounded_output(fake_ffmpeg):
+    """Only keep the most recent lines, unless asked for the full log."""
+    lines = [f"line {i}" for i in range(1000)]
+    cmd = [fake_ffmpeg(stderr=lines)]
+
+    ff = ffprogress.FFProgress(cmd, tail_lines=10)
+    list(ff.run())
+    assert list(ff.lines()) == lines[-10:]
+    assert ff.output == "\n".join(lines[-10:])
+
+    # The full log spills over into a temp file once it gets big.
+    with mock.patch("m4b_util.helpers.ffprogress.LOG_SPOOL_BYTES", 100):
+        ff = ffprogress.FFProgress(cmd, keep_log=True, tail_lines=10)
+        list(ff.run())
+    assert ff._log._rolled
+    assert list(ff.lines()) == lines
+    assert list(ff.lines()) == lines  # Can be read more than once.
+    ff.close()
+    assert list(ff.lines()) == lines[-10:]
+
+
+def test_ffprogress_fail_shows_tail(fake_ffmpeg):
+    """Include the last lines of output in the error."""
+    ff = ffprogress.FFProgress([fake_ffmpeg(stderr=[f"line {i}" for i in range(500)], returncode=1)], tail_lines=2)
+    with pytest.raises(RuntimeError) as e:
+        list(ff.run())
+    assert str(e.value).endswith("line 498\nline 499")
+
+
+def test_progress_events(fake_ffmpeg):
+    """Read every field of the progress reports, and keep them out of the log."""
+    progress = [
+        "out_time_us=-23220", "total_size=N/A", "bitrate=N/A", "speed=N/A", "progress=continue",
+        "out_time_us=1500000", "total_size=48", "bitrate=   0.3kbits/s", "speed=2.5x", "progress=continue",
+        "out_time_us=3000000", "total_size=98304", "bitrate= 262.1kbits/s", "speed=3x", "progress=end",
+    ]
+    ff = ffprogress.FFProgress([fake_ffmpeg(stderr=["Duration: 00:00:03.00, start: 0.000000"], progress=progress)])
+    events = list(ff.events())
+    assert events == [
+        ffprogress.ProgressEvent(percent=0),
+        ffprogress.ProgressEvent(1.5, 2.5, 0.3, 48, False, 50),
+        ffprogress.ProgressEvent(3.0, 3.0, 262.1, 98304, True, 100),
+    ]
+    assert ff.last_event is events[-1]
+    assert ff.output == "Duration: 00:00:03.00, start: 0.000000"
+
+
+@pytest.mark.parametrize("args, expected", [
+    (["-t", "30"], [25, 50, 100]),
+    (["-ss", "00:00:40", "-t", "00:00:15"], [50, 100, 100]),
+    (["-ss", "20", "-to", "50"], [25, 50, 100]),
+    (["-ss", "30", "-i", "input.m4a"], [25, 50, 100]),
+    ([], [12.5, 25, 50]),
+])
+def test_progress_requested_duration(fake_ffmpeg, args, expected):
+    """Measure progress against the part of the input we asked for, not all of it."""
+    ff = ffprogress.FFProgress([fake_ffmpeg(stderr=["Duration: 00:01:00.00"], progress=_progress_blocks(7.5, 15, 30))])
+    ff.cmd = ff.cmd + args
+    assert [event.percent for event in ff.events()] == expected
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("90", 90), ("1.5", 1.5), ("1:30.5", 90.5), ("01:01:30", 3690), ("1500ms", 1.5), ("250000us", 0.25),
+    ("-2", -2), ("2s", 2), ("soon", None),
+])
+def test_parse_time(spec, expected):
+    """Understand ffmpeg's time duration syntax."""
+    assert ffprogress.parse_time(spec) == expected
+
+
+def test_read_lines_threaded(fake_ffmpeg):
+    """Read both pipes without select(), the way we have to on Windows."""
+    with mock.patch("m4b_util.helpers.ffprogress.os.name", "nt"):
+        ff = ffprogress.FFProgress([fake_ffmpeg(stderr=["Duration: 00:01:00.00"], progress=_progress_blocks(30))])
+        assert list(ff.run()) == [0, 50, 100]
+    assert ff.output == "Duration: 00:01:00.00"
+
+
+def test_watchdog_settings():
+    """Back off exponentially, and only poll when there is something to check."""
+    watchdog = ffprogress.Watchdog(backoff=0.5)
+    assert watchdog.poll is None
+    assert [watchdog.delay(retry) for retry in (1, 2, 3)] == [0.5, 1.0, 2.0]
+    assert ffprogress.Watchdog(timeout=30, stall_timeout=0.25).poll == 0.25
+    assert ffprogress.Watchdog(timeout=30).poll == ffprogress.WATCHDOG_POLL
+
+
+def test_watchdog_timeout(fake_ffmpeg):
+    """Kill ffmpeg when it runs too long, even if it is still making progress."""
+    ff = ffprogress.FFProgress([fake_ffmpeg(hang=30)], watchdog=ffprogress.Watchdog(timeout=0.25))
+    start = time.monotonic()
+    with pytest.raises(ffprogress.FFmpegTimeoutError) as e:
+        list(ff.run())
+    assert time.monotonic() - start < 10
+    assert "timed out after 0.25 seconds" in str(e.value)
+
+
+def test_watchdog_stall(fake_ffmpeg):
+    """Kill ffmpeg when it stops making progress."""
+    cmd = [fake_ffmpeg(stderr=["Duration: 00:01:00.00"], progress=_progress_blocks(1, 2, 3, 4)[:-2], hang=30)]
+    ff = ffprogress.FFProgress(cmd, watchdog=ffprogress.Watchdog(stall_timeout=0.25))
+    with pytest.raises(ffprogress.FFmpegTimeoutError) as e:
+        list(ff.events())
+    assert "stalled, with no progress for 0.25 seconds" in str(e.value)
+    assert ff.last_event.out_time == 3
+    assert ff.output == "Duration: 00:01:00.00"
+
+
+def test_cancel(fake_ffmpeg):
+    """Kill ffmpeg soon after its job is cancelled, and don't retry it."""
+    cancel = threading.Event()
+    ff = ffprogress.FFProgress([fake_ffmpeg(stderr=["Started"], hang=30)], cancel=cancel,
+                               watchdog=ffprogress.Watchdog(timeout=60, retries=3))
+    threading.Timer(0.25, cancel.set).start()
+    start = time.monotonic()
+    with pytest.raises(ffprogress.FFmpegCancelledError):
+        list(ff.run())
+    assert time.monotonic() - start < 10
+    assert ff.attempts == 1
+    assert ff.returncode != 0
+    assert ff.output == "Started"
+
+
+def test_watchdog_retry(fake_ffmpeg):
+    """Retry a stuck job, and give up once we run out of retries."""
+    retries = list()
+    cmd = [fake_ffmpeg(stderr=["Duration: 00:01:00.00"], progress=_progress_blocks(30, 60), hang=30, hang_once=True)]
+    ff = ffprogress.FFProgress(cmd, watchdog=ffprogress.Watchdog(timeout=0.25, retries=2, backoff=0),
+                               on_retry=lambda retry, error: retries.append(retry))
+    assert list(ff.run()) == [0, 50, 100, 0, 50, 100, 100]
+    assert ff.attempts == 2
+    assert retries == [1]
+
+    retries.clear()
+    ff = ffprogress.FFProgress([fake_ffmpeg(hang=30)], watchdog=ffprogress.Watchdog(timeout=0.25, retries=1, backoff=0),
+                               on_retry=lambda retry, error: retries.append(retry))
+    with pytest.raises(ffprogress.FFmpegTimeoutError):
+        list(ff.run())
+    assert ff.attempts == 2
+    assert retries == [1]
+
+
+def test_retry_forgets_output(fake_ffmpeg):
+    """Keep only the output of the attempt that finished, not the ones that were killed."""
+    cmd = [fake_ffmpeg(stderr=["silence_start: 1.0"], hang=30, hang_once=True)]
+    watchdog = ffprogress.Watchdog(timeout=0.5, retries=1, backoff=0)
+    for keep_log in (True, False):
+        ff = ffprogress.run(cmd, "Testing", keep_log=keep_log, watchdog=watchdog)
+        assert ff.attempts == 2
+        assert list(ff.lines()) == ["silence_start: 1.0"]
+        assert ff.output == "silence_start: 1.0"
+        ff.close()
+        (Path(cmd[0]).parent / "fake_ffmpeg.hung").unlink()
+
+
+def test_run_with_watchdog(fake_ffmpeg, capsys):
+    """Let the user know when a job is being retried."""
+    watchdog = ffprogress.Watchdog(timeout=0.25, retries=1, backoff=0)
+    assert ffprogress.run([fake_ffmpeg(hang=30, hang_once=True)], "Testing", watchdog=watchdog)
+    assert "Retrying (1 of 1)" in capsys.readouterr().out
@@ -0,0 +1,174 @@
+"""Resource governor tests."""
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from m4b_util.helpers import ffprogress, governor, parallel_ffmpeg
+
+
+def test_parse_options():
+    """Read limits the way they are given on the command line."""
+    assert governor.from_options() == governor.Limits()
+    assert governor.from_options(nice="10", ionice="best-effort:7", cpus="0-2,5", max_writers="2") == governor.Limits(
+        nice=10, io_class="best-effort", io_level=7, cpus=frozenset({0, 1, 2, 5}), max_writers=2)
+    assert governor.parse_ionice("idle") == ("idle", None)
+
+
+@pytest.mark.parametrize("options, message", [
+    ({"nice": "low"}, "Expected a whole number for nice, not 'low'."),
+    ({"ionice": "loud"}, "Unknown I/O class 'loud'"),
+    ({"ionice": "idle:3"}, "The 'idle' I/O class has no priority levels."),
+    ({"ionice": "best-effort:8"}, "I/O priority level must be from 0 to 7, not '8'."),
+    ({"cpus": "0-"}, "Couldn't read CPU list '0-'."),
+    ({"cpus": "two"}, "Couldn't read CPU list 'two'."),
+])
+def test_bad_options(options, message):
+    """Reject options we can't read."""
+    with pytest.raises(ValueError) as e:
+        governor.from_options(**options)
+    assert message in str(e.value)
+
+
+@pytest.mark.parametrize("limits, message", [
+    (governor.Limits(nice=20), "Nice level must be from -20 to 19, not 20."),
+    (governor.Limits(cpus=frozenset({4096})), "Can't run ffmpeg on CPUs [4096]."),
+    (governor.Limits(max_writers=0), "Must allow at least one writer, not 0."),
+])
+def test_bad_limits(limits, message):
+    """Reject limits we couldn't apply, before starting anything."""
+    with pytest.raises(ValueError) as e:
+        governor.configure(limits)
+    assert message in str(e.value)
+    assert governor.get_limits() == governor.Limits()
+
+
+def test_unsupported(monkeypatch, capsys):
+    """Drop limits this platform can't apply, with a warning."""
+    monkeypatch.setattr(governor.platform, "machine", lambda: "mystery")
+    governor.configure(governor.Limits(io_class="best-effort", io_level=4, max_writers=2))
+    assert governor.get_limits() == governor.Limits(max_writers=2)
+    assert "Setting io class isn't supported here, so it will be ignored." in capsys.readouterr().out
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="Only Linux has I/O scheduling classes and CPU affinity.")
+def test_children_limited():
+    """Run every child at the nice level, in the I/O class, and on the CPUs asked for, by holding ourselves to them.
+
+    That can't be undone, so it happens in a process of its own.
+    """
+    cpu = min(os.sched_getaffinity(0))
+    nice = min(os.getpriority(os.PRIO_PROCESS, 0) + 5, 19)
+    script = ("import sys\n"
+              "from m4b_util.helpers import child_processes, governor\n"
+              f"governor.configure(governor.Limits(nice={nice}, io_class='idle', cpus=frozenset({{{cpu}}})))\n"
+              "governor.apply()\n"
+              "report = 'import os; print(os.getpriority(os.PRIO_PROCESS, 0), sorted(os.sched_getaffinity(0)))'\n"
+              "print(child_processes.run([sys.executable, '-c', report], capture_output=True).stdout.decode())\n")
+    if shutil.which("ionice") and platform.machine() in governor._IOPRIO_SET:
+        script += "print(child_processes.run(['ionice'], capture_output=True).stdout.decode())\n"
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    lines = result.stdout.split()
+    assert lines[:2] == [str(nice), f"[{cpu}]"]
+    if shutil.which("ionice") and platform.machine() in governor._IOPRIO_SET:
+        assert lines[2] == "idle"
+
+
+def test_writes_file():
+    """Tell commands that write files from ones that don't."""
+    assert governor.writes_file(["ffmpeg", "-i", "in.mp3", "out.m4a"])
+    assert not governor.writes_file(["ffmpeg", "-i", "in.mp3", "-f", "null", "-"])
+    assert not governor.writes_file(["ffmpeg", "-i", "in.mp3", "-f", "null", "/dev/null"])
+    assert not governor.writes_file(["ffmpeg", "-i", "in.mp3", "pipe:1"])
+    assert not governor.writes_file([])
+
+
+def test_writer_slots():
+    """Never let more than max_writers commands write at once, but don't hold up ones that don't write."""
+    governor.configure(governor.Limits(max_writers=2))
+    writing = list()
+    most_writing = 0
+
+    def write():
+        nonlocal most_writing
+        with governor.writer_slot(["ffmpeg", "-i", "in.mp3", "out.m4a"]):
+            writing.append(1)
+            most_writing = max(most_writing, len(writing))
+            time.sleep(0.1)
+            writing.pop()
+
+    threads = [threading.Thread(target=write) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most_writing == 2
+
+    with governor.writer_slot(["ffmpeg", "-i", "in.mp3", "a.m4a"]), governor.writer_slot(["ffmpeg", "-i", "b.m4a"]):
+        with governor.writer_slot(["ffmpeg", "-i", "in.mp3", "-f", "null", "-"]):
+            pass  # Would hang if it waited for a slot.
+
+
+def _try_to_write(limits, writer_slots, results):
+    """Report whether a worker process could get a writer slot, without waiting long for one."""
+    def give_up():
+        raise TimeoutError
+
+    governor.configure(limits, writer_slots)
+    try:
+        with governor.writer_slot(["ffmpeg", "-i", "in.mp3", "out.m4a"], give_up):
+            results.put(True)
+    except TimeoutError:
+        results.put(False)
+
+
+def test_writer_slots_shared():
+    """Count writers in worker processes against the same max_writers as our own."""
+    governor.configure(governor.Limits(max_writers=1))
+    results = multiprocessing.Queue()
+    with governor.writer_slot(["ffmpeg", "-i", "in.mp3", "out.m4a"]):
+        worker = multiprocessing.Process(target=_try_to_write,
+                                         args=(governor.get_limits(), governor.get_writer_slots(), results))
+        worker.start()
+        assert results.get(timeout=10) is False
+        worker.join()
+    worker = multiprocessing.Process(target=_try_to_write,
+                                     args=(governor.get_limits(), governor.get_writer_slots(), results))
+    worker.start()
+    assert results.get(timeout=10) is True
+    worker.join()
+
+
+def test_cancel_waiting_writer(monkeypatch, fake_ffmpeg):
+    """Give up waiting for a writer slot if the job is cancelled."""
+    monkeypatch.setattr(governor, "WRITER_POLL", 0.05)
+    governor.configure(governor.Limits(max_writers=1))
+    cancel = threading.Event()
+    cancel.set()
+    with governor.writer_slot(["ffmpeg", "-i", "in.mp3", "out.m4a"]):
+        ff = ffprogress.FFProgress([fake_ffmpeg(), "out.m4a"], cancel=cancel)
+        with pytest.raises(ffprogress.FFmpegCancelledError):
+            list(ff.run())
+    assert ff.attempts == 0
+
+
+def test_plan_within_limits(monkeypatch):
+    """Share the CPUs between the jobs that may write at once."""
+    monkeypatch.setattr(parallel_ffmpeg, "available_cpus", lambda: 8)
+    governor.configure(governor.Limits(max_writers=2))
+    assert parallel_ffmpeg.plan_jobs() == (2, 4)
+    assert parallel_ffmpeg.plan_jobs(jobs=6) == (2, 4)
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="Needs CPU affinity.")
+def test_available_cpus_within_limits(monkeypatch, tmp_path):
+    """Only count the CPUs we were given."""
+    monkeypatch.setattr(parallel_ffmpeg, "CGROUP_ROOT", tmp_path)
+    governor.configure(governor.Limits(cpus=frozenset({min(os.sched_getaffinity(0))})))
+    assert parallel_ffmpeg.available_cpus() == 1
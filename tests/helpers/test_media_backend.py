@@ -0,0 +1,89 @@
+"""Media backend tests."""
+from unittest import mock
+
+import pytest
+
+from m4b_util.helpers import ffprobe, media_backend
+from m4b_util.helpers.finders import find_silence
+
+
+@pytest.fixture()
+def pyav_backend(monkeypatch):
+    """Switch to the PyAV backend for the length of a test."""
+    pytest.importorskip("av")
+    monkeypatch.setattr(media_backend, "_backend", media_backend.make_backend("pyav"))
+
+
+def test_default_backend(monkeypatch):
+    """Use the command line tools unless told otherwise."""
+    monkeypatch.setattr(media_backend, "_backend", None)
+    monkeypatch.delenv("M4B_UTIL_BACKEND", raising=False)
+    assert isinstance(media_backend.get_backend(), media_backend.SubprocessBackend)
+
+
+def test_unknown_backend():
+    """Reject backends we don't know."""
+    with pytest.raises(ValueError) as e:
+        media_backend.make_backend("gstreamer")
+    assert "Unknown media backend 'gstreamer'" in str(e.value)
+
+
+def test_incomplete_backend():
+    """Refuse to make a backend that doesn't do everything a backend must."""
+    class ProbeOnly(media_backend.MediaBackend):
+        def probe(self, path):
+            return dict()
+
+    with pytest.raises(TypeError):
+        ProbeOnly()
+
+
+def test_pyav_missing(monkeypatch, capsys):
+    """Fall back to the command line tools if PyAV isn't installed."""
+    monkeypatch.setattr(media_backend, "av", None)
+    monkeypatch.setattr(media_backend, "_backend", None)
+    monkeypatch.setenv("M4B_UTIL_BACKEND", "pyav")
+    assert isinstance(media_backend.get_backend(), media_backend.SubprocessBackend)
+    assert "PyAV is not installed" in capsys.readouterr().out
+
+
+def test_pyav_probe(pyav_backend, chaptered_audio_file_path, covered_audio_file):
+    """Read the same info ffprobe would, without running it."""
+    with mock.patch("m4b_util.helpers.media_backend.run") as run:
+        probe = ffprobe.run_probe(chaptered_audio_file_path)
+        covered = ffprobe.run_probe(covered_audio_file)
+    run.assert_not_called()
+    expected = media_backend.SubprocessBackend().probe(chaptered_audio_file_path)
+    expected = ffprobe.Probe(expected)
+    assert probe.audio['duration'] == expected.audio['duration']
+    assert probe.format['duration'] == expected.format['duration']
+    assert probe.tags['title'] == expected.tags['title']
+    assert probe.chapters == expected.chapters
+    assert covered.streams[1]['disposition']['attached_pic'] == 1
+    assert ffprobe.run_probe(chaptered_audio_file_path.parent / "missing.m4b") is None
+
+
+def test_pyav_measure_duration(pyav_backend, m4a_file_path, mkv_file_path):
+    """Find durations by demuxing and decoding in-process."""
+    updates = list()
+    assert ffprobe.get_file_duration(m4a_file_path, "decode") == pytest.approx(5.0, abs=0.05)
+    assert ffprobe.get_file_duration(mkv_file_path, "demux") == pytest.approx(5.0, abs=0.05)
+    media_backend.get_backend().measure_duration(m4a_file_path, "demux", on_progress=updates.append)
+    assert updates == sorted(updates)
+
+
+def test_pyav_find_silence(pyav_backend, silences_file_path):
+    """Find the same silences the command line tools would."""
+    actual = find_silence(silences_file_path, silence_duration=0.25)
+    times = [time for segment in actual for time in (segment.start_time, segment.end_time)]
+    assert times == pytest.approx([0.0, 2.5, 5.0, 7.5, 10.0, 12.5, 15.0, 17.5], abs=0.05)
+
+    actual = find_silence(silences_file_path, start_time=4.0, end_time=12.6, silence_duration=0.25)
+    times = [time for segment in actual for time in (segment.start_time, segment.end_time)]
+    assert times == pytest.approx([5.0, 7.5, 10.0, 12.6], abs=0.05)
+
+
+def test_pyav_bad_file(pyav_backend, fake_file):
+    """Find nothing in files that can't be read."""
+    assert find_silence(fake_file) == []
+    assert media_backend.get_backend().measure_duration(fake_file, "decode") is None
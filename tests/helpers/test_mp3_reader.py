@@ -0,0 +1,105 @@
+"""MP3 reader tests."""
+from subprocess import run
+from unittest import mock
+
+import pytest
+
+from m4b_util.helpers import ffprobe, mp3_reader
+from m4b_util.helpers.finders import find_chapters
+
+
+def _convert(input_path, output_path, *args):
+    """Convert a file to mp3 with ffmpeg."""
+    cmd = ["ffmpeg", "-i", input_path, *args, output_path]
+    run(cmd, capture_output=True, check=True)
+    return output_path
+
+
+def _compare_to_ffprobe(file_path):
+    """Check that the native reader agrees with ffprobe on everything it reports."""
+    native = mp3_reader.read_mp3(file_path)
+    assert native is not None
+    probe = ffprobe.run_probe(file_path)
+
+    for key in ("duration", "size", "nb_streams", "tags"):
+        assert native["format"].get(key) == probe.format.get(key)
+    assert len(native["streams"]) == len(probe.streams)
+    for native_stream, stream in zip(native["streams"], probe.streams):
+        assert native_stream["disposition"]["attached_pic"] == stream["disposition"]["attached_pic"]
+        for key in ("index", "codec_type", "codec_name", "duration", "duration_ts", "time_base", "sample_rate",
+                    "channels", "start_time"):
+            if key in native_stream:
+                assert native_stream[key] == stream[key]
+    assert native["chapters"] == probe.chapters
+    return native
+
+
+def test_read_mp3(mp3_file_path):
+    """Read an mp3 with a Xing header."""
+    native = _compare_to_ffprobe(mp3_file_path)
+    assert native["streams"][0]["codec_name"] == "mp3"
+
+
+@pytest.mark.parametrize("args", [
+    ["-ar", "22050"],
+    ["-ar", "8000", "-ac", "1"],
+    ["-q:a", "4"],
+    ["-id3v2_version", "3"],
+])
+def test_read_variants(m4a_file_path, tmp_path, args):
+    """Read mp3s with different sample rates, VBR, and ID3v2.3 tags."""
+    _compare_to_ffprobe(_convert(m4a_file_path, tmp_path / "variant.mp3", *args))
+
+
+def test_read_chapters(chaptered_audio_file_path, tmp_path):
+    """Read chapters and tags from ID3v2 frames."""
+    mp3_file = _convert(chaptered_audio_file_path, tmp_path / "chaptered.mp3")
+    native = _compare_to_ffprobe(mp3_file)
+    assert len(native["chapters"]) == 8
+    assert native["chapters"][1]["tags"]["title"] == "110Hz - Soft"
+    assert native["format"]["tags"]["title"] == "Chaptered Audio"
+
+
+def test_read_cover(covered_audio_file, tmp_path):
+    """Report cover art as an attached picture, like ffprobe does."""
+    mp3_file = _convert(covered_audio_file, tmp_path / "covered.mp3", "-map", "0", "-c:v", "copy")
+    native = _compare_to_ffprobe(mp3_file)
+    assert native["streams"][1]["codec_type"] == "video"
+
+
+def test_no_xing_header(m4a_file_path, tmp_path):
+    """Count frames when there is no Xing header to tell us."""
+    mp3_file = _convert(m4a_file_path, tmp_path / "no_xing.mp3", "-write_xing", "0")
+    with_xing = _convert(m4a_file_path, tmp_path / "xing.mp3")
+    native = mp3_reader.read_mp3(mp3_file)
+    assert native["streams"][0]["duration_ts"] == mp3_reader.read_mp3(with_xing)["streams"][0]["duration_ts"]
+
+    # Walking every frame is too slow for long files, so leave those to ffprobe.
+    with mock.patch("m4b_util.helpers.mp3_reader.MAX_WALK_FRAMES", 10):
+        assert mp3_reader.read_mp3(mp3_file) is None
+
+
+@pytest.mark.parametrize("content", [b"", b"not an mp3 file at all", b"ID3\x04\x00\x00\x00\x00\x00\x20"])
+def test_unreadable(tmp_path, content):
+    """Return None for anything we can't parse."""
+    file_path = tmp_path / "bad.mp3"
+    file_path.write_bytes(content)
+    assert mp3_reader.read_mp3(file_path) is None
+    assert mp3_reader.read_mp3(tmp_path / "missing.mp3") is None
+
+
+def test_truncated(m4a_file_path, tmp_path):
+    """Return None when frames are cut off without a header to give the real length."""
+    mp3_file = _convert(m4a_file_path, tmp_path / "no_xing.mp3", "-write_xing", "0")
+    data = mp3_file.read_bytes()
+    mp3_file.write_bytes(data[:-100])
+    assert mp3_reader.read_mp3(mp3_file) is None
+
+
+def test_no_ffprobe_needed(chaptered_audio_file_path, mp3_file_path, tmp_path):
+    """Skip ffprobe entirely for durations and chapters of mp3 files."""
+    mp3_file = _convert(chaptered_audio_file_path, tmp_path / "chaptered.mp3")
+    with mock.patch("m4b_util.helpers.media_backend.run") as run_mock:
+        assert ffprobe.get_file_duration(mp3_file_path) == pytest.approx(5.0, abs=0.05)
+        assert len(find_chapters(mp3_file)) == 8
+    run_mock.assert_not_called()
@@ -0,0 +1,95 @@
+"""MP4 reader tests."""
+from unittest import mock
+
+import pytest
+
+from m4b_util.helpers import ffprobe, mp4_reader
+from m4b_util.helpers.finders import find_chapters
+
+
+def _compare_to_ffprobe(file_path):
+    """Check that the native reader agrees with ffprobe on everything it reports."""
+    native = mp4_reader.read_mp4(file_path)
+    assert native is not None
+    probe = ffprobe.run_probe(file_path)
+
+    for key in ("duration", "start_time", "size", "nb_streams", "tags"):
+        assert native["format"][key] == probe.format[key]
+    assert len(native["streams"]) == len(probe.streams)
+    for native_stream, stream in zip(native["streams"], probe.streams):
+        assert native_stream["disposition"]["attached_pic"] == stream["disposition"]["attached_pic"]
+        for key in ("index", "codec_type", "duration", "duration_ts", "time_base", "sample_rate", "channels"):
+            if key in native_stream:
+                assert native_stream[key] == stream[key]
+    assert native["chapters"] == probe.chapters
+    return native
+
+
+def test_read_m4a(m4a_file_path):
+    """Read a plain m4a file."""
+    native = _compare_to_ffprobe(m4a_file_path)
+    assert native["streams"][0]["duration"] == "5.000000"
+
+
+def test_read_chapters(chaptered_audio_file_path):
+    """Read chapters and tags from a QuickTime chapter track."""
+    native = _compare_to_ffprobe(chaptered_audio_file_path)
+    assert len(native["chapters"]) == 8
+    assert native["chapters"][1]["tags"]["title"] == "110Hz - Soft"
+    assert native["format"]["tags"]["title"] == "Chaptered Audio"
+    assert native["format"]["tags"]["artist"] == "m4b-util"
+    assert native["format"]["tags"]["date"] == "2022"
+
+
+def test_read_nero_chapters(chaptered_audio_file_path):
+    """Fall back to Nero chapters when there's no chapter track."""
+    # Renaming the track reference hides the chapter track, leaving just the chpl box.
+    data = chaptered_audio_file_path.read_bytes()
+    chaptered_audio_file_path.write_bytes(data.replace(b"tref", b"free"))
+    native = _compare_to_ffprobe(chaptered_audio_file_path)
+    assert len(native["chapters"]) == 8
+    assert native["chapters"][0]["time_base"] == "1/10000000"
+
+
+def test_read_cover(covered_audio_file):
+    """Report cover art as an attached picture, like ffprobe does."""
+    native = _compare_to_ffprobe(covered_audio_file)
+    assert native["streams"][1]["codec_type"] == "video"
+
+
+def test_read_video(video_only_file):
+    """Read a video-only file."""
+    _compare_to_ffprobe(video_only_file)
+    assert ffprobe.read_native(video_only_file).audio is None
+
+
+@pytest.mark.parametrize("content", [b"", b"not an mp4 file at all", b"\x00\x00\x00\x10ftypM4A "])
+def test_unreadable(tmp_path, content):
+    """Return None for anything we can't parse."""
+    file_path = tmp_path / "bad.m4a"
+    file_path.write_bytes(content)
+    assert mp4_reader.read_mp4(file_path) is None
+    assert mp4_reader.read_mp4(tmp_path / "missing.m4a") is None
+
+
+def test_truncated(m4a_file_path):
+    """Return None for truncated files."""
+    data = m4a_file_path.read_bytes()
+    m4a_file_path.write_bytes(data[:-100])
+    assert mp4_reader.read_mp4(m4a_file_path) is None
+
+
+def test_no_ffprobe_needed(chaptered_audio_file_path, m4a_file_path):
+    """Skip ffprobe entirely for durations and chapters of mp4 files."""
+    with mock.patch("m4b_util.helpers.media_backend.run") as run:
+        assert ffprobe.get_file_duration(m4a_file_path) == 5.0
+        assert len(find_chapters(chaptered_audio_file_path)) == 8
+    run.assert_not_called()
+
+
+def test_fallback_to_ffprobe(fake_file):
+    """Use ffprobe for files we can't read."""
+    m4a_file = fake_file.rename(fake_file.with_suffix(".m4a"))
+    with mock.patch("m4b_util.helpers.ffprobe.run_probe", return_value=None) as run_probe:
+        assert ffprobe.ProbeSession().run_probe(m4a_file) is None
+    run_probe.assert_called_once_with(m4a_file, "full")
@@ -1,14 +1,17 @@
 """ParallelFFmpeg Tests."""
-from time import sleep
+import threading
+import time
 from unittest import mock
 
 import pytest
 
+from m4b_util.helpers import parallel_ffmpeg
+from m4b_util.helpers.ffprogress import FFmpegTimeoutError, Watchdog
 from m4b_util.helpers.parallel_ffmpeg import ParallelFFmpeg
 
 
 @pytest.fixture()
-@mock.patch("m4b_util.helpers.parallel_ffmpeg.Progress")
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
 def processor(progress):
     """Set up the processor and mock out the progress tracker."""
     p = ParallelFFmpeg("Testing")
@@ -28,7 +31,7 @@ def _add_to_q(q, message):
     """Add message to queue, and wait until the queue is not empty."""
     q.put(message)
     while q.empty():
-        sleep(0.25)  # Give time for the queue to populate
+        time.sleep(0.25)  # Give time for the queue to populate
 
 
 def test_read_status_q_empty(processor):
@@ -59,14 +62,20 @@ def test_read_status_q_update(processor):
     p._tasklist[1]["task_id"] = 24
 
     # 50% complete
-    _add_to_q(p._status_q, (1, 50))
+    _add_to_q(p._status_q, (1, (50, 1.5)))
     p._read_status_queue()
-    progress.update.assert_called_with(24, completed=50)
+    progress.update.assert_has_calls([
+        mock.call(24, completed=50, speed=1.5),  # Specified Task
+        mock.call(0, completed=0.5)  # Master Task
+    ])
 
     # 100% Complete
-    _add_to_q(p._status_q, (1, 100))
+    _add_to_q(p._status_q, (1, (100, None)))
     p._read_status_queue()
-    progress.update.assert_called_with(24, completed=100)
+    progress.update.assert_has_calls([
+        mock.call(24, completed=100, speed=None),  # Specified Task
+        mock.call(0, completed=1)  # Master Task
+    ])
 
 
 def test_read_status_finished(processor):
@@ -78,7 +87,7 @@ def test_read_status_finished(processor):
     p._read_status_queue()
     progress.update.assert_has_calls([
         mock.call(48, completed=100, visible=False),  # Specified Task
-        mock.call(0, advance=1)  # Master Task
+        mock.call(0, completed=1)  # Master Task
     ])
 
 
@@ -92,7 +101,53 @@ def test_read_status_failed(processor):
     progress.console.print.assert_called_with("[red]Error:[/] Failed to process Frist")
     progress.update.assert_has_calls([
         mock.call(12, visible=False),  # Specified Task
-        mock.call(0, advance=1)  # Master Task
+        mock.call(0, completed=1)  # Master Task
+    ])
+
+
+def test_read_status_results(processor):
+    """Keep the details of how each job ended, and cancel the rest after a failure when failing fast."""
+    p, progress = processor
+    p._tasklist.append({"name": "Secnod", "task_id": None})
+    p._tasklist[1]["task_id"] = 5
+    p.fail_fast = True
+
+    _add_to_q(p._status_q, (1, "failed", {"returncode": 1, "log_tail": "Broken", "elapsed": 2.5}))
+    p._read_status_queue()
+    assert p._tasklist[1]["result"] == parallel_ffmpeg.TaskResult("Frist", "failed", 1, "Broken", 2.5)
+    assert not p._tasklist[1]["result"].ok
+    assert p._cancel.is_set()
+
+    # A job that was cancelled before it started has no progress bar to hide.
+    progress.update.reset_mock()
+    _add_to_q(p._status_q, (2, "cancelled", dict()))
+    p._read_status_queue()
+    assert p._tasklist[2]["result"].status == "cancelled"
+    progress.update.assert_called_once_with(0, completed=2)
+    progress.console.print.assert_called_once()  # Only for the failure.
+
+
+def test_read_status_retries(processor):
+    """Show retries, and include them in the final status."""
+    p, progress = processor
+    p._tasklist[1]["task_id"] = 7
+
+    _add_to_q(p._status_q, (1, "retrying"))
+    p._read_status_queue()
+    progress.update.assert_called_with(7, completed=0, description="[dark_cyan]|- Processing '[white]Frist[/]' (retry 1).")
+
+    _add_to_q(p._status_q, (1, "finished"))
+    p._read_status_queue()
+    progress.console.print.assert_called_with("[bold yellow]Warning:[/] Processed Frist after 1 retry")
+
+    _add_to_q(p._status_q, (1, "retrying"))
+    p._read_status_queue()
+    _add_to_q(p._status_q, (1, "timed out"))
+    p._read_status_queue()
+    progress.console.print.assert_called_with("[red]Error:[/] Timed out processing Frist after 2 retries")
+    progress.update.assert_has_calls([
+        mock.call(7, visible=False),  # Specified Task
+        mock.call(0, completed=1)  # Master Task
     ])
 
 
@@ -101,6 +156,7 @@ def test_ffmpeg_job(ff, processor):
     """Run a single worker job."""
     # Mock out the run command so we don't have to be dependent on system configurations.
     ff().run.return_value = [0, 50, 100]
+    ff().last_event = None
     p, _ = processor
     status_q = mock.MagicMock()
 
@@ -113,15 +169,67 @@ def test_ffmpeg_job(ff, processor):
     p._ffmpeg_job(p._input_q, status_q)
     status_q.put.assert_has_calls([
         mock.call((60, "started")),
-        mock.call((60, 0)),
-        mock.call((60, 50)),
-        mock.call((60, 100)),
-        mock.call((60, "finished")),
+        mock.call((60, (0, None))),
+        mock.call((60, (50, None))),
+        mock.call((60, (100, None))),
+        mock.call((60, "finished", mock.ANY)),
         mock.call((72, "started")),
-        mock.call((72, 0)),
-        mock.call((72, 50)),
-        mock.call((72, 100)),
-        mock.call((72, "finished"))
+        mock.call((72, (0, None))),
+        mock.call((72, (50, None))),
+        mock.call((72, (100, None))),
+        mock.call((72, "finished", mock.ANY))
+    ])
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.FFProgress")
+def test_ffmpeg_job_board(ff, processor):
+    """Post progress to the board, leaving only the start and finish for the status queue."""
+    ff().run.return_value = [0, 50, 100]
+    ff().last_event.speed = 2.0
+    p, _ = processor
+    status_q = mock.MagicMock()
+    board = mock.MagicMock()
+
+    p._input_q.put((60, ["should-pass"]))
+    p._input_q.put(None)  # Shuts down worker
+
+    p._ffmpeg_job(p._input_q, status_q, board=board, slot=3)
+    assert status_q.put.call_args_list == [mock.call((60, "started")), mock.call((60, "finished", mock.ANY))]
+    assert board.post.call_args_list == [mock.call(3, 60, percent, 2.0) for percent in (0, 50, 100)]
+    board.clear.assert_called_once_with(3)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_progress_board(shared):
+    """Keep the latest progress of each worker's job."""
+    board = parallel_ffmpeg.ProgressBoard(3, shared=shared)
+    assert list(board.read()) == []
+    board.post(0, 5, 10)
+    board.post(2, 7, 20, 1.5)
+    board.post(2, 7, 30, 1.75)
+    assert list(board.read()) == [(5, 10, None), (7, 30, 1.75)]
+    board.clear(2)
+    assert list(board.read()) == [(5, 10, None)]
+    board.post(0, 8, 0)
+    assert list(board.read()) == [(8, 0, None)]
+    board.clear()
+    assert list(board.read()) == []
+
+
+def test_read_board(processor):
+    """Show the progress on the board, but only for jobs we know are running."""
+    p, progress = processor
+    p._tasklist[1]["result"] = parallel_ffmpeg.TaskResult("Frist")
+    p._board.post(0, 1, 50, 3.0)
+
+    p._read_board()  # It hasn't started, as far as we know.
+    progress.update.assert_not_called()
+
+    p._tasklist[1]["task_id"] = 24
+    p._read_board()
+    progress.update.assert_has_calls([
+        mock.call(24, completed=50, speed=3.0),  # Specified Task
+        mock.call(0, completed=0.5)  # Master Task
     ])
 
 
@@ -132,6 +240,8 @@ def test_ffmpeg_job_fail(ff, processor):
     def ffrun():
         raise RuntimeError("FAIL!")
     ff().run.side_effect = ffrun
+    ff().returncode = 1
+    ff().output = None
     p, _ = processor
     status_q = mock.MagicMock()
 
@@ -143,23 +253,266 @@ def test_ffmpeg_job_fail(ff, processor):
     p._ffmpeg_job(p._input_q, status_q)
     status_q.put.assert_has_calls([
         mock.call((84, "started")),
-        mock.call((84, "failed")),
+        mock.call((84, "failed", {"returncode": 1, "log_tail": "FAIL!", "elapsed": mock.ANY})),
+    ])
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.FFProgress")
+def test_ffmpeg_job_cancelled(ff, processor):
+    """Skip queued jobs once they are cancelled."""
+    p, _ = processor
+    status_q = mock.MagicMock()
+    cancel = threading.Event()
+    cancel.set()
+
+    p._input_q.put((42, ["should-not-run"]))
+    p._input_q.put(None)  # Shuts down worker
+
+    p._ffmpeg_job(p._input_q, status_q, cancel=cancel)
+    status_q.put.assert_called_once_with((42, "cancelled", dict()))
+    ff.assert_not_called()
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.FFProgress")
+def test_ffmpeg_job_timeout(ff, processor):
+    """Run a single worker job, with a task that gets stuck, and is retried."""
+    def ffrun():
+        ff.call_args.kwargs["on_retry"](1, None)
+        raise FFmpegTimeoutError("STUCK!")
+    ff().run.side_effect = ffrun
+    p, _ = processor
+    status_q = mock.MagicMock()
+
+    p._input_q.put((96, ["should-time-out"]))
+    p._input_q.put(None)  # Shuts down worker
+
+    p._ffmpeg_job(p._input_q, status_q, Watchdog(timeout=1, retries=1))
+    assert ff.call_args.kwargs["watchdog"] == Watchdog(timeout=1, retries=1)
+    status_q.put.assert_has_calls([
+        mock.call((96, "started")),
+        mock.call((96, "retrying")),
+        mock.call((96, "timed out", mock.ANY)),
     ])
 
 
+def test_task_costs():
+    """Fill in missing costs with the average, and never go below zero."""
+    assert parallel_ffmpeg.task_costs([{"cost": 10}, {}, {"cost": 20}, {"cost": -5}]) == [10, 25 / 3, 20, 0]
+    assert parallel_ffmpeg.task_costs([{}, {"cost": None}]) == [1, 1]
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_longest_first(progress):
+    """Start the most costly jobs first, and weight the overall progress by cost."""
+    p = ParallelFFmpeg("Testing", jobs=1)
+    tasks = [{"name": name, "command": ["ffmpeg", "-version"], "cost": cost}
+             for name, cost in [("short", 10), ("long", 3600), ("medium", 600), ("unknown", None)]]
+    assert all(result.ok for result in p.process(tasks))
+
+    # With a single worker, the jobs' progress bars show up in the order they were started.
+    started = [c.args[0] for c in progress().add_task.call_args_list[1:]]
+    assert started == [f"[dark_cyan]|- Processing '[white]{name}[/]'." for name in ("long", "unknown", "medium", "short")]
+    progress().add_task.assert_any_call("[cyan]Testing", total=3600 + 600 + 10 + (3600 + 600 + 10) / 3)
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_results(progress):
+    """Report how every task went."""
+    p = ParallelFFmpeg("Testing")
+    results = p.process([
+        {"name": "Version", "command": ["ffmpeg", "-version"]},
+        {"name": "Crash", "command": ["not-a-command"]},
+        {"name": "Fail", "command": ["ffmpeg", "-not-a-real-option"]},
+    ])
+    assert [result.name for result in results] == ["Version", "Crash", "Fail"]
+    assert [result.status for result in results] == ["finished", "failed", "failed"]
+    assert results[0].ok and results[0].returncode == 0
+    assert results[1].returncode is None and "not-a-command" in results[1].log_tail
+    assert results[2].returncode != 0 and "not-a-real-option" in results[2].log_tail
+    assert all(result.elapsed >= 0 for result in results)
+
+
+@pytest.mark.parametrize("executor", parallel_ffmpeg.EXECUTORS)
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_fail_fast(progress, fake_ffmpeg, executor):
+    """Kill running jobs, and skip queued ones, as soon as one fails."""
+    p = ParallelFFmpeg("Testing", jobs=2, executor=executor, fail_fast=True)
+    tasks = [
+        {"name": "Stuck", "command": [fake_ffmpeg(hang=30)], "cost": 100},
+        {"name": "Crash", "command": ["not-a-command"], "cost": 10},
+        {"name": "Queued", "command": [fake_ffmpeg(hang=30)], "cost": 1},
+    ]
+    start = time.monotonic()
+    results = p.process(tasks)
+    assert time.monotonic() - start < 15
+    assert [result.status for result in results] == ["cancelled", "failed", "cancelled"]
+    progress().console.print.assert_called_with("[bold yellow]Warning:[/] Cancelled 2 job(s).")
+
+    # The next batch starts afresh.
+    assert p.process([{"name": "Version", "command": ["ffmpeg", "-version"]}])[0].ok
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_submit(progress, fake_ffmpeg):
+    """Hand back results as soon as each command finishes, rather than waiting for them all."""
+    with ParallelFFmpeg("Testing", jobs=2) as p:
+        slow = p.submit("Slow", [fake_ffmpeg(hang=1)])
+        fast = p.submit("Fast", ["ffmpeg", "-version"], cost=5)
+        assert list(p.as_completed()) == [fast, slow]
+        assert fast.result().ok and fast.result().name == "Fast"
+
+        # The pool stays open until we leave the with block.
+        late = p.submit("Late", ["ffmpeg", "-version"])
+        assert next(p.as_completed([late])).result().ok
+    assert p._coordinator is None and not p._workers
+    progress().stop.assert_called_once()
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_submit_cancel(progress, fake_ffmpeg):
+    """Let a job be cancelled until it has started."""
+    with ParallelFFmpeg("Testing", jobs=1) as p:
+        running = p.submit("Running", [fake_ffmpeg(hang=1)])
+        waiting = p.submit("Waiting", ["ffmpeg", "-version"])
+        assert waiting.cancel()
+        assert not running.cancel()
+    assert running.result().ok
+    assert waiting.cancelled()
+    assert p._tasklist[2]["result"].status == "cancelled"
+    progress().console.print.assert_not_called()
+
+
+def test_adaptive_concurrency():
+    """Keep adding jobs while they pay off, and back off when they don't."""
+    adaptive = parallel_ffmpeg.AdaptiveConcurrency(8)
+    assert adaptive.limit == 4
+    assert adaptive.update(4.0) == 5
+    assert adaptive.update(5.0) == 6
+    assert adaptive.update(5.1) == 4  # Two percent better isn't worth another job.
+    assert adaptive.update(4.0) == 5
+    assert adaptive.update(4.9, cpu_busy=0.95) == 5  # The CPUs are full, so hold.
+    assert adaptive.settled == 5  # 6 jobs were no better than 5.
+
+    adaptive = parallel_ffmpeg.AdaptiveConcurrency(2, start=2)
+    assert adaptive.settled == 2
+    assert [adaptive.update(1.0) for _ in range(3)] == [2, 2, 2]
+    assert parallel_ffmpeg.AdaptiveConcurrency(2, start=2).update(1.0, cpu_busy=0.1) == 2  # Never over the ceiling.
+    adaptive = parallel_ffmpeg.AdaptiveConcurrency(1)
+    assert [adaptive.update(1.0), adaptive.update(0.5)] == [1, 1]  # Never under one.
+
+
+def test_cpu_meter(tmp_path, monkeypatch):
+    """Measure how busy the CPUs were between readings, when we can."""
+    stat = tmp_path / "stat"
+    monkeypatch.setattr(parallel_ffmpeg, "PROC_STAT", stat)
+    stat.write_text("cpu  100 0 100 700 100 0 0 0 0 0\ncpu0 1 2 3\n")
+    meter = parallel_ffmpeg.CpuMeter()
+    stat.write_text("cpu  250 0 250 800 100 0 0 0 0 0\n")
+    assert meter.busy() == 0.75
+    assert meter.busy() is None  # No time has gone by.
+    stat.unlink()
+    assert meter.busy() is None
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_adapt(progress, monkeypatch):
+    """Measure throughput only while every job slot is full, and let the controller change how many run at once."""
+    monkeypatch.setattr(parallel_ffmpeg, "ADAPT_INTERVAL", 0)
+    p = ParallelFFmpeg("Testing", jobs=4, adaptive=True)
+    p.adaptive = mock.MagicMock(settled=3)
+    p.adaptive.update.return_value = 3
+    p._limit, p._in_flight, p._pending = 2, 2, [(-1, 1)]
+    p._dispatch = mock.MagicMock()
+
+    p._adapt()  # Starts the measurement.
+    p.adaptive.update.assert_not_called()
+    p._done_cost = 10
+    p._adapt()
+    assert p.adaptive.update.call_args.args[0] > 0
+    assert p._limit == 3
+    p._dispatch.assert_called_once()
+
+    p._pending = list()  # Running out of work isn't the same as running slowly.
+    p._adapt()
+    p.adaptive.update.assert_called_once()
+
+    p._coordinator = mock.MagicMock()
+    p._tasklist = [{"name": "Master", "task_id": 0}]
+    p.shutdown()
+    progress().console.print.assert_called_with("[yellow]Info:[/] Adaptive concurrency settled on 3 job(s) at a time.")
+
+
+def test_adapt_after_backoff(monkeypatch):
+    """Don't count throughput from the jobs still running over the limit after a backoff against the new limit."""
+    clock = iter([0, 5, 10, 15])
+    monkeypatch.setattr(parallel_ffmpeg.time, "monotonic", lambda: next(clock))
+    p = ParallelFFmpeg("Testing", jobs=8, adaptive=True)
+    p.adaptive = mock.MagicMock()
+    p.adaptive.update.return_value = 3
+    p._cpu_meter = mock.MagicMock()
+    p._cpu_meter.busy.return_value = 0.5
+    p._limit, p._in_flight, p._pending = 4, 4, [(-1, 1)]
+    p._dispatch = mock.MagicMock()
+
+    p._adapt()  # Starts the measurement.
+    p._done_cost = 10
+    p._adapt()  # Backs off to 3, but 4 jobs are still running.
+    assert p._limit == 3
+    p.adaptive.update.assert_called_once_with(2.0, 0.5)
+
+    p._done_cost = 30
+    p._adapt()  # Still 4 running, so this isn't what 3 jobs can do.
+    p.adaptive.update.assert_called_once()
+
+    p._in_flight = 3  # Now the new limit is in effect, so it is measured from the last check.
+    p._done_cost = 35
+    p._adapt()
+    p.adaptive.update.assert_called_with(1.0, 0.5)
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_adaptive(progress):
+    """Run a batch with adaptive concurrency."""
+    p = ParallelFFmpeg("Testing", jobs=4, adaptive=True)
+    assert p._limit == 2
+    assert all(result.ok for result in p.process([{"name": str(i), "command": ["ffmpeg", "-version"]}
+                                                  for i in range(6)]))
+    assert len(p._workers) == 0
+    progress().console.print.assert_called_with("[yellow]Info:[/] Adaptive concurrency settled on 2 job(s) at a time.")
+
+
+def test_unknown_executor():
+    """Reject executors we don't know."""
+    with pytest.raises(ValueError) as e:
+        ParallelFFmpeg("Testing", executor="cluster")
+    assert "Unknown executor 'cluster'" in str(e.value)
+
+
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_threads(progress):
+    """Run workers as threads by default."""
+    p = ParallelFFmpeg("Testing")
+    assert p.executor == "thread"
+    with mock.patch("m4b_util.helpers.parallel_ffmpeg.mp.Process") as process:
+        assert p.process([{"name": "Version", "command": ["ffmpeg", "-version"]}])
+    process.assert_not_called()
+    progress().update.assert_any_call(progress().add_task(), completed=100, visible=False)
+
+
 def test_process_empty_tasklist(processor):
     """Return none if task arg is empty."""
     p, _ = processor
     assert p.process(list()) is None
 
 
-@mock.patch("m4b_util.helpers.parallel_ffmpeg.Progress")
-def test_process(progress):
-    """Run a multiprocess job."""
-    p = ParallelFFmpeg("Testing")
+@pytest.mark.parametrize("executor", parallel_ffmpeg.EXECUTORS)
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process(progress, executor):
+    """Run a parallel job."""
+    p = ParallelFFmpeg("Testing", executor=executor)
 
     # Create tasklist.
-    # Because _ffmpeg_job will be run in separate processes, we can't mock out FFProgress. This means we do, actually,
+    # Because _ffmpeg_job may be run in separate processes, we can't mock out FFProgress. This means we do, actually,
     # need a real command.
     tasks = list()
     for i in range(25):
@@ -169,7 +522,7 @@ def test_process(progress):
         })
 
     # Process the job.
-    # We can't check anything that happens in _ffmpeg_job because it is run in a separate process.
+    # We can't check anything that happens in _ffmpeg_job because it may be run in a separate process.
     assert p.process(tasks)
     progress().start.assert_called()
     progress().add_task.assert_has_calls([
@@ -178,13 +531,14 @@ def test_process(progress):
     progress().stop.assert_called()
 
 
-@mock.patch("m4b_util.helpers.parallel_ffmpeg.Progress")
-def test_process_crashing_tasks(progress):
+@pytest.mark.parametrize("executor", parallel_ffmpeg.EXECUTORS)
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_crashing_tasks(progress, executor):
     """Run a job with tasks that crash.
 
     In a previous version, crashing tasks, or too few tasks would lead to an infinite loop.
     """
-    p = ParallelFFmpeg("Testing")
+    p = ParallelFFmpeg("Testing", executor=executor)
 
     # Create tasklist.
     tasks = list()
@@ -201,3 +555,67 @@ def test_process_crashing_tasks(progress):
         mock.call("[cyan]Testing", total=2)
     ])
     progress().stop.assert_called()
+
+
+@pytest.mark.parametrize("executor", parallel_ffmpeg.EXECUTORS)
+@mock.patch("m4b_util.helpers.parallel_ffmpeg.make_progress")
+def test_process_idle_coordinator(progress, fake_ffmpeg, executor):
+    """Sleep, rather than spin, while waiting on the workers."""
+    p = ParallelFFmpeg("Testing", executor=executor)
+    tasks = [{"name": str(i), "command": [fake_ffmpeg(hang=1)]} for i in range(2)]
+
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    assert p.process(tasks)
+    assert time.process_time() - cpu_start < 0.5 * (time.monotonic() - wall_start)
+
+    # Each job reported back before we finished.
+    finished = [c for c in progress().update.call_args_list if c.kwargs.get("visible") is False]
+    assert len(finished) == 2
+
+
+@pytest.mark.parametrize("files, expected", [
+    ({}, 8),
+    ({"cpu.max": "max 100000"}, 8),
+    ({"cpu.max": "250000 100000"}, 3),
+    ({"cpu.max": "50000 100000"}, 1),
+    ({"cpu/cpu.cfs_quota_us": "200000", "cpu/cpu.cfs_period_us": "100000"}, 2),
+    ({"cpu/cpu.cfs_quota_us": "-1", "cpu/cpu.cfs_period_us": "100000"}, 8),
+    ({"cpu.max": "garbage"}, 8),
+])
+def test_available_cpus(tmp_path, monkeypatch, files, expected):
+    """Respect cgroup CPU quotas, as well as CPU affinity."""
+    for name, content in files.items():
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(content + "\n")
+    monkeypatch.setattr(parallel_ffmpeg, "CGROUP_ROOT", tmp_path)
+    monkeypatch.setattr(parallel_ffmpeg.os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    assert parallel_ffmpeg.available_cpus() == expected
+
+
+@pytest.mark.parametrize("jobs, threads_per_job, expected", [
+    (None, None, (8, 1)),
+    (2, None, (2, 4)),
+    (None, 3, (2, 3)),
+    (16, 4, (16, 4)),
+    (None, 16, (1, 16)),
+])
+def test_plan_jobs(monkeypatch, jobs, threads_per_job, expected):
+    """Split the CPUs between jobs and the threads each one uses."""
+    monkeypatch.setattr(parallel_ffmpeg, "available_cpus", lambda: 8)
+    assert parallel_ffmpeg.plan_jobs(jobs, threads_per_job) == expected
+    p = ParallelFFmpeg("Testing", jobs=jobs, threads_per_job=threads_per_job)
+    assert (p.jobs, p.threads_per_job) == expected
+    assert p.threads_args == ["-threads", str(expected[1])]
+
+
+@pytest.mark.parametrize("jobs, threads_per_job, message", [
+    (-1, None, "Need at least 1 for jobs, not -1."),
+    (0, None, "Need at least 1 for jobs, not 0."),
+    (None, -2, "Need at least 1 for threads per job, not -2."),
+])
+def test_plan_jobs_bad(jobs, threads_per_job, message):
+    """Refuse to plan fewer than one job, or one thread per job, which would never run anything."""
+    with pytest.raises(ValueError) as e:
+        parallel_ffmpeg.plan_jobs(jobs, threads_per_job)
+    assert message in str(e.value)
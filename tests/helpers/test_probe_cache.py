@@ -0,0 +1,134 @@
+"""Probe cache tests."""
+import os
+from unittest import mock
+
+from m4b_util.helpers import ffprobe, probe_cache
+
+
+def _touch(path, content=b"data"):
+    """Write content to a file, and return its path."""
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def test_get_put(tmp_path):
+    """Round-trip an entry through the cache."""
+    cache = probe_cache.ProbeCache(tmp_path / "cache.sqlite")
+    file = _touch(tmp_path / "file.mp3")
+    assert cache.get(file) is None
+    cache.put(file, '{"format": {}}')
+    assert cache.get(file) == '{"format": {}}'
+    assert cache.get(str(file)) == '{"format": {}}'
+
+
+def test_persistent(tmp_path):
+    """Find entries written by a previous cache instance."""
+    file = _touch(tmp_path / "file.mp3")
+    probe_cache.ProbeCache(tmp_path / "cache.sqlite").put(file, "output")
+    assert probe_cache.ProbeCache(tmp_path / "cache.sqlite").get(file) == "output"
+
+
+def test_modified_file(tmp_path):
+    """Ignore entries for files that have changed since they were probed."""
+    cache = probe_cache.ProbeCache(tmp_path / "cache.sqlite")
+    file = _touch(tmp_path / "file.mp3")
+    cache.put(file, "output")
+
+    # Change the size
+    _touch(file, b"more data")
+    assert cache.get(file) is None
+
+    # Same size, different mtime
+    cache.put(file, "output")
+    stat = os.stat(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.get(file) is None
+
+
+def test_missing_file(tmp_path):
+    """Don't cache files that don't exist."""
+    cache = probe_cache.ProbeCache(tmp_path / "cache.sqlite")
+    cache.put(tmp_path / "nope.mp3", "output")
+    assert cache.get(tmp_path / "nope.mp3") is None
+
+
+def test_lru_eviction(tmp_path):
+    """Evict the least recently used entries once over the size cap."""
+    cache = probe_cache.ProbeCache(tmp_path / "cache.sqlite", max_bytes=20)
+    files = [_touch(tmp_path / f"{i}.mp3") for i in range(3)]
+    with mock.patch("m4b_util.helpers.probe_cache.time.time", side_effect=range(100)):
+        cache.put(files[0], "0" * 8)
+        cache.put(files[1], "1" * 8)
+        assert cache.get(files[0])  # Makes files[1] the least recently used.
+        cache.put(files[2], "2" * 8)
+    assert cache.get(files[0]) == "0" * 8
+    assert cache.get(files[1]) is None
+    assert cache.get(files[2]) == "2" * 8
+
+    # Entries bigger than the whole cache are never stored.
+    cache.put(files[1], "1" * 21)
+    assert cache.get(files[1]) is None
+    assert cache.get(files[0]) == "0" * 8
+
+
+def test_clear(tmp_path):
+    """Empty the cache."""
+    cache = probe_cache.ProbeCache(tmp_path / "cache.sqlite")
+    file = _touch(tmp_path / "file.mp3")
+    cache.put(file, "output")
+    cache.clear()
+    assert cache.get(file) is None
+
+
+def test_unusable_db(tmp_path):
+    """Quietly disable the cache if the database can't be opened."""
+    db_path = tmp_path / "not-a-db"
+    db_path.mkdir()
+    cache = probe_cache.ProbeCache(db_path)
+    assert not cache.enabled
+    file = _touch(tmp_path / "file.mp3")
+    cache.put(file, "output")
+    assert cache.get(file) is None
+    cache.clear()
+
+
+def test_get_cache_disabled(monkeypatch):
+    """Turn the cache off via environment variable."""
+    monkeypatch.setenv("M4B_UTIL_PROBE_CACHE", "0")
+    assert probe_cache.get_cache() is None
+
+
+def test_default_cache_dir(monkeypatch, tmp_path):
+    """Honor the cache dir override."""
+    monkeypatch.setenv("M4B_UTIL_CACHE_DIR", str(tmp_path))
+    assert probe_cache.default_cache_dir() == tmp_path
+
+
+def test_run_probe_uses_cache(mp3_file_path, isolated_probe_cache):
+    """Only run ffprobe once for an unchanged file."""
+    first = ffprobe.run_probe(mp3_file_path)
+    assert isolated_probe_cache.get(mp3_file_path) is not None
+    with mock.patch("m4b_util.helpers.media_backend.run") as run:
+        second = ffprobe.run_probe(mp3_file_path)
+        run.assert_not_called()
+    assert first.data == second.data
+    assert ffprobe.get_file_duration(mp3_file_path) == float(first.audio['duration'])
+
+
+def test_run_probe_failure_not_cached(fake_file, isolated_probe_cache):
+    """Don't remember failed probes."""
+    assert ffprobe.run_probe(fake_file) is None
+    assert isolated_probe_cache.get(fake_file) is None
+
+
+def test_profiles_cached_separately(tmp_path):
+    """Keep entries for each probe profile apart."""
+    cache = probe_cache.ProbeCache(tmp_path / "cache.sqlite")
+    file = _touch(tmp_path / "file.mp3")
+    cache.put(file, "duration output", "duration")
+    assert cache.get(file) is None
+    assert cache.get(file, "duration") == "duration output"
+    cache.put(file, "full output")
+    assert cache.get(file) == "full output"
+    assert cache.get(file, "duration") == "duration output"
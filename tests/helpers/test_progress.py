@@ -0,0 +1,133 @@
+"""Progress mode tests."""
+import json
+
+import pytest
+from rich.progress import Progress
+from rich.status import Status
+
+from m4b_util.helpers import ffprogress, progress
+
+
+@pytest.fixture()
+def progress_mode(monkeypatch):
+    """Set the progress mode for the length of a test."""
+    def _set(mode):
+        monkeypatch.setattr(progress, "_mode", None)
+        progress.set_mode(mode)
+    monkeypatch.setattr(progress, "_mode", None)
+    return _set
+
+
+def _events(capsys):
+    """Read the jsonl events written to stderr."""
+    return [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+
+
+def test_default_mode(monkeypatch):
+    """Draw rich widgets unless told otherwise."""
+    monkeypatch.setattr(progress, "_mode", None)
+    monkeypatch.delenv("M4B_UTIL_PROGRESS", raising=False)
+    assert isinstance(progress.make_progress(), Progress)
+    assert isinstance(progress.make_status("Testing"), Status)
+
+    monkeypatch.setattr(progress, "_mode", None)
+    monkeypatch.setenv("M4B_UTIL_PROGRESS", "none")
+    assert isinstance(progress.make_progress(), progress.QuietProgress)
+
+
+def test_unknown_mode():
+    """Reject modes we don't know."""
+    with pytest.raises(ValueError) as e:
+        progress.set_mode("fancy")
+    assert "Unknown progress mode 'fancy'" in str(e.value)
+
+
+def test_jsonl_progress(progress_mode, monkeypatch, capsys):
+    """Write throttled events, but never drop the first and last."""
+    progress_mode("jsonl")
+    monkeypatch.setattr(progress, "JSONL_INTERVAL", 60)
+    p = progress.make_progress()
+    p.start()
+    task = p.add_task("[cyan]Testing", total=200)
+    for completed in range(0, 201, 20):
+        p.update(task, completed=completed, speed=2.0)
+    p.update(task, completed=200)  # Already finished, so nothing new to say.
+    p.console.print("[red]Error:[/] Something")
+    p.stop()
+
+    events = _events(capsys)
+    assert [event["event"] for event in events] == ["start", "progress", "progress", "message"]
+    assert events[0] == {"event": "start", "job": task, "name": "Testing", "total": 200}
+    assert events[1]["percent"] == 0
+    assert events[2]["percent"] == 100
+    assert events[2]["speed"] == 2.0
+    assert events[2]["finished"]
+    assert events[2]["elapsed"] >= 0
+    assert events[3] == {"event": "message", "text": "Error: Something"}
+    assert capsys.readouterr().out == ""
+
+
+def test_jsonl_hidden_task(progress_mode, capsys):
+    """Treat a hidden task as finished, even if it never got to 100%, and handle tasks without a total."""
+    progress_mode("jsonl")
+    p = progress.make_progress()
+    task = p.add_task("Spinner", total=None)
+    p.update(task, advance=1)
+    p.update(task, visible=False)
+    events = _events(capsys)
+    assert events[1]["percent"] is None
+    assert events[2]["finished"]
+
+
+def test_jsonl_job_ids(progress_mode, capsys):
+    """Never give two jobs the same ID, even when they come from different trackers."""
+    progress_mode("jsonl")
+    first, second = progress.make_progress(), progress.make_progress()
+    ids = [first.add_task("One"), second.add_task("Two"), first.add_task("Three")]
+    assert len(set(ids)) == 3
+    second.update(ids[1], completed=100)
+    events = _events(capsys)
+    assert [event["job"] for event in events] == ids + [ids[1]]
+    assert events[-1]["name"] == "Two"
+
+
+def test_jsonl_status(progress_mode, capsys):
+    """Report status messages as events."""
+    progress_mode("jsonl")
+    status = progress.make_status("Starting")
+    status.start()
+    status.update("[bold]Scanning[/] file.mp3")
+    status.stop()
+    assert _events(capsys) == [
+        {"event": "status", "text": "Starting"},
+        {"event": "status", "text": "Scanning file.mp3"},
+    ]
+
+
+def test_no_progress(progress_mode, capsys):
+    """Show only messages."""
+    progress_mode("none")
+    p = progress.make_progress()
+    p.start()
+    task = p.add_task("Testing", total=100)
+    p.update(task, completed=100)
+    p.console.print("[red]Error:[/] Something")
+    p.stop()
+    status = progress.make_status("Starting")
+    status.start()
+    status.update("Scanning")
+    status.stop()
+    output = capsys.readouterr()
+    assert output.out == "Error: Something\n"
+    assert output.err == ""
+
+
+def test_ffprogress_jsonl(progress_mode, fake_ffmpeg, capsys):
+    """Report ffmpeg's progress and speed as events."""
+    progress_mode("jsonl")
+    cmd = [fake_ffmpeg(stderr=["Duration: 00:00:10.00"], progress=["out_time_us=10000000", "speed=4.5x", "progress=end"])]
+    assert ffprogress.run(cmd, "Testing")
+    events = _events(capsys)
+    assert events[0]["name"] == "Testing"
+    assert events[-1]["percent"] == 100
+    assert events[-1]["speed"] == 4.5
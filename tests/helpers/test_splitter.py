@@ -1,6 +1,9 @@
+from unittest import mock
+
 import testhelpers
 
 from m4b_util.helpers import ffprobe, SegmentData, splitter
+from m4b_util.helpers.parallel_ffmpeg import ParallelFFmpeg
 
 
 def test_splitter(silences_file_path, tmp_path):
@@ -52,8 +55,8 @@ def test_alternate_output_pattern(silences_file_path, tmp_path):
     testhelpers.check_output_folder(output_path=output_path, expected_files=expected_files)
 
 
-def test_overlapping_output_names(silences_file_path, tmp_path):
-    """Overwrite files, if the naming pattern causes collisions."""
+def test_overlapping_output_names(silences_file_path, tmp_path, capsys):
+    """Overwrite files, with a warning, if the naming pattern causes collisions."""
     def check_func(input_file_path):
         """Check for correct file length."""
         probe = ffprobe.run_probe(input_file_path)
@@ -77,6 +80,10 @@ def test_overlapping_output_names(silences_file_path, tmp_path):
     )
 
     testhelpers.check_output_folder(output_path=output_path, expected_files=expected_files, check_func=check_func)
+    output = " ".join(capsys.readouterr().out.split())  # Undo rich's line wrapping.
+    for earlier, later in ((0, 1), (1, 2), (2, 3)):
+        assert (f"Segments {earlier} and {later} would both be written to 'Collided_File.mp3'. Only segment {later} "
+                f"will be kept.") in output
 
 
 def test_title_metadata(silences_file_path, tmp_path):
@@ -104,3 +111,13 @@ def test_title_metadata(silences_file_path, tmp_path):
         segment_list=segment_list,
     )
     testhelpers.check_output_folder(output_path=output_path, expected_files=expected_files)
+
+
+def test_split_thread_budget(silences_file_path, tmp_path):
+    """Give each ffmpeg its share of the CPUs, and say how long each segment is, for scheduling."""
+    segment_list = [SegmentData(id=0, start_time=0.0, end_time=2.5), SegmentData(id=1, start_time=2.5, end_time=5.0)]
+    with mock.patch.object(ParallelFFmpeg, "process") as process:
+        splitter.split(silences_file_path, tmp_path / "output", segment_list, jobs=2, threads_per_job=3)
+    for task in process.call_args.args[0]:
+        assert task["command"][-4:-2] == ["-threads", "3"]
+        assert task["cost"] == 2.5
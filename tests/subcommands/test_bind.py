@@ -2,6 +2,7 @@
 from unittest.mock import patch
 
 import m4b_util
+from m4b_util.helpers.ffprogress import Watchdog
 
 
 def _run_bind_cmd(arg_list):
@@ -69,3 +70,32 @@ def test_bind_fail(tmp_path, capsys):
     _run_bind_cmd([str(fake_folder)])
     output = capsys.readouterr()
     assert "Writing" not in output.out
+
+
+def test_bind_duration_mode(mp3_path, tmp_path):
+    """Pass the duration mode through to the binder."""
+    with patch("m4b_util.helpers.ffprobe._run_for_duration", return_value=2.5) as run_for_duration:
+        _run_bind_cmd([str(mp3_path), "-o", str(tmp_path), "--duration-mode", "demux"])
+    assert run_for_duration.call_count == 8
+    assert run_for_duration.call_args.args[1] == "demux"
+
+    with patch("m4b_util.helpers.ffprobe._run_for_duration", return_value=2.5) as run_for_duration:
+        _run_bind_cmd([str(mp3_path), "-o", str(tmp_path), "--decode-durations"])
+    assert run_for_duration.call_args.args[1] == "decode"
+
+
+def test_bind_watchdog(mp3_path, tmp_path):
+    """Pass the timeout and retry options through to the binder."""
+    with patch("m4b_util.subcommands.bind.Audiobook") as audiobook:
+        _run_bind_cmd([str(mp3_path), "-o", str(tmp_path), "--job-timeout", "600", "--stall-timeout", "30",
+                       "--retries", "2"])
+    assert audiobook.call_args.kwargs["watchdog"] == Watchdog(timeout=600, stall_timeout=30, retries=2)
+
+
+def test_bind_jobs(mp3_path, tmp_path):
+    """Pass the job and thread options through to the binder."""
+    with patch("m4b_util.subcommands.bind.Audiobook") as audiobook:
+        _run_bind_cmd([str(mp3_path), "-o", str(tmp_path), "-j", "2", "--threads-per-job", "3", "--adaptive-jobs"])
+    assert audiobook.call_args.kwargs["jobs"] == 2
+    assert audiobook.call_args.kwargs["threads_per_job"] == 3
+    assert audiobook.call_args.kwargs["adaptive_jobs"]
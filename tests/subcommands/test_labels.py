@@ -235,3 +235,15 @@ def test_labels_no_output(label_file_path, tmp_path):
     _run_labels_cmd(["--from-label-file", str(label_file_path)])
     expected_files = [label_file_path.name]
     testhelpers.check_output_folder(tmp_path, expected_files, check_func=testhelpers.assert_file_path_is_file)
+
+
+def test_labels_to_book_probes_once(label_file_path, variable_volume_segments_file_path):
+    """Only read the target book once, even though several steps need its info."""
+    with mock.patch("m4b_util.helpers.ffprobe.read_native", wraps=ffprobe.read_native) as read_native, \
+            mock.patch("m4b_util.helpers.ffprobe.run_probe", wraps=ffprobe.run_probe) as run_probe:
+        _run_labels_cmd([
+            "--from-label-file", str(label_file_path),
+            "--to-book", str(variable_volume_segments_file_path)
+        ])
+    probed = [str(c.args[0]) for c in read_native.call_args_list + run_probe.call_args_list]
+    assert probed.count(str(variable_volume_segments_file_path)) == 1
@@ -4,8 +4,10 @@ import os
 from pathlib import Path
 from unittest import mock
 
+import pytest
 import testhelpers
 
+from m4b_util.helpers import SegmentData
 from m4b_util.subcommands import split
 
 
@@ -211,3 +213,21 @@ def test_minimum_segment_size(tmp_path, silences_file_path, capsys):
     ]
     with testhelpers.expect_exit_with_output(capsys, "Not enough segments found."):
         _run_split_cmd(cmd)
+
+
+@mock.patch("m4b_util.subcommands.split.splitter.split")
+@mock.patch("m4b_util.subcommands.split.find_chapters")
+def test_jobs_options(finder_mock, split_mock):
+    """Pass the job and thread options through to the splitter."""
+    finder_mock.return_value = [SegmentData(id=0, start_time=0.0, end_time=2.5)]
+    _run_split_cmd(["c", "Not-really-a-file", "--jobs", "2", "--threads-per-job", "3"])
+    assert split_mock.call_args.kwargs["jobs"] == 2
+    assert split_mock.call_args.kwargs["threads_per_job"] == 3
+    assert not split_mock.call_args.kwargs["adaptive_jobs"]
+
+
+@pytest.mark.parametrize("option", ["--jobs", "--threads-per-job"])
+def test_jobs_options_positive(option, capsys):
+    """Reject job and thread counts below one."""
+    with testhelpers.expect_exit_with_output(capsys, "Must be at least 1, not 0.", expected_code=2):
+        _run_split_cmd(["c", "Not-really-a-file", option, "0"])
@@ -4,6 +4,7 @@ from unittest.mock import patch
 import testhelpers
 
 from m4b_util.__main__ import allowed_commands, main as m4b_main
+from m4b_util.helpers import governor, progress
 
 
 def _run_main_cmd(arg_list, expected_exit=0):
@@ -37,3 +38,45 @@ def test_all_commands_help(capsys):
     """Display help menu from all commands."""
     for command in allowed_commands:
         _run_main_cmd([command, "--help"])
+
+
+def test_progress_option(monkeypatch, capsys):
+    """Pick the progress mode with a global option, before or after the command."""
+    monkeypatch.setattr(progress, "_mode", None)
+    _run_main_cmd(["--progress", "jsonl", "version"])
+    assert progress.get_mode() == "jsonl"
+
+    _run_main_cmd(["version", "--progress=none"])
+    assert progress.get_mode() == "none"
+    assert "m4b-util, Version" in capsys.readouterr().out
+
+
+def test_bad_progress_option(monkeypatch, capsys):
+    """Reject progress modes we don't know."""
+    monkeypatch.setattr(progress, "_mode", None)
+    _run_main_cmd(["--progress", "fancy", "version"], -1)
+    assert "Unknown progress mode 'fancy'" in capsys.readouterr().out
+
+
+def test_limit_options(monkeypatch):
+    """Set the limits on ffmpeg with global options, before or after the command."""
+    applied = list()
+    monkeypatch.setattr(governor, "apply", lambda: applied.append(governor.get_limits()))
+    _run_main_cmd(["--nice", "19", "version", "--max-writers=2"])
+    assert applied == [governor.Limits(nice=19, max_writers=2)]
+
+
+def test_bad_limit_options(capsys):
+    """Reject limits we can't read."""
+    _run_main_cmd(["--ionice", "loud", "version"], -1)
+    assert "Unknown I/O class 'loud'" in capsys.readouterr().out
+
+
+def test_limits_refused(monkeypatch, capsys):
+    """Explain, rather than crash, when we aren't allowed to hold ourselves to the limits."""
+    def refuse():
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(governor, "apply", refuse)
+    _run_main_cmd(["--ionice", "idle", "version"], -1)
+    assert "Couldn't apply the limits on ffmpeg: Operation not permitted" in capsys.readouterr().out